@@ -0,0 +1,144 @@
+# distutils: language = c++
+
+from libcpp cimport bool
+from libcpp.string cimport string
+from libcpp.vector cimport vector
+
+import numpy as np
+
+###########
+#""" BUNDLE ADJUSTER"""
+
+cdef extern from "SolverSettings.h":
+    cdef cppclass SolverSettings:
+        SolverSettings() except +
+        string linearSolver
+        string preconditioner
+        int numThreads
+        int maxIterations
+        double functionTolerance
+        double gradientTolerance
+        double parameterTolerance
+        string loss
+        double lossScale
+        int outlierRounds
+        double outlierThreshold
+        bool analyticJacobians
+
+
+cdef extern from "BundleAdjuster.hpp":
+    # Declares that we want to use this class here
+    cdef cppclass BundleAdjuster:
+        # constructor working directly on the given buffers
+        BundleAdjuster(bool, bool, bool, bool,
+                       double*, unsigned int,
+                       const double*, const unsigned int*, const unsigned int*, const unsigned int*, unsigned int,
+                       const double*, unsigned int,
+                       double*, unsigned int) except +
+        void setVerbose(bool)
+        void setSolverSettings(const SolverSettings&) except +
+        void optimize() except + nogil
+        void writeCameras(double*)
+        vector[unsigned int] getRejected()
+
+
+cdef class PyBundleAdjuster:
+    """ Bundle adjustment of camera parameters and object poses, running in process on NumPy buffers.
+
+        No data is copied: All arrays need to be C contiguous and of the dtypes given below, otherwise a ValueError
+        is raised. object_poses and cameras are overwritten with the optimized values.
+
+        cameras: [C, 17] float64, fx, fy, ppx, ppy, 5 dist, 3 rotation, 3 translation, width, height
+        model_points: [M, 3] float64, model points of the calibration object
+        object_poses: [F, 6] float64, rotation (Rodrigues) and translation of the object per frame
+        points2d: [N, 2] float64, observed image coordinates
+        points2d_cid, points2d_pid, points2d_fid: [N] uint32, camera, model point and frame of each observation
+    """
+    cdef BundleAdjuster* c_BundleAdjuster      # holds pointer to an C++ instance which we're wrapping
+    cdef double[:, ::1] cameras
+    cdef double[:, ::1] model_points
+    cdef double[:, ::1] object_poses
+    cdef const double[:, ::1] points2d
+    cdef const unsigned int[::1] points2d_cid
+    cdef const unsigned int[::1] points2d_pid
+    cdef const unsigned int[::1] points2d_fid
+
+    def __cinit__(self, double[:, ::1] cameras, double[:, ::1] model_points, double[:, ::1] object_poses,
+                  const double[:, ::1] points2d,
+                  const unsigned int[::1] points2d_cid,
+                  const unsigned int[::1] points2d_pid,
+                  const unsigned int[::1] points2d_fid,
+                  bool optimize_intrinsic, bool optimize_distortion, bool optimize_extrinsic,
+                  bool shared_camera_model=False, bool verbose=True):
+        assert cameras.shape[1] == 17, "Shape mismatch."
+        assert model_points.shape[1] == 3, "Shape mismatch."
+        assert object_poses.shape[1] == 6, "Shape mismatch."
+        assert points2d.shape[1] == 2, "Shape mismatch."
+        assert points2d_cid.shape[0] == points2d.shape[0], "Shape mismatch."
+        assert points2d_pid.shape[0] == points2d.shape[0], "Shape mismatch."
+        assert points2d_fid.shape[0] == points2d.shape[0], "Shape mismatch."
+        if points2d.shape[0] > 0:
+            assert np.max(points2d_cid) < cameras.shape[0], "Camera id out of range."
+            assert np.max(points2d_pid) < model_points.shape[0], "Point id out of range."
+            assert np.max(points2d_fid) < object_poses.shape[0], "Frame id out of range."
+
+        # keep references, so the buffers outlive the C++ instance
+        self.cameras = cameras
+        self.model_points = model_points
+        self.object_poses = object_poses
+        self.points2d = points2d
+        self.points2d_cid = points2d_cid
+        self.points2d_pid = points2d_pid
+        self.points2d_fid = points2d_fid
+
+        cdef unsigned int num_points2d = points2d.shape[0]
+        self.c_BundleAdjuster = new BundleAdjuster(optimize_intrinsic, optimize_distortion, optimize_extrinsic,
+                                                   shared_camera_model,
+                                                   &model_points[0, 0] if model_points.shape[0] > 0 else NULL,
+                                                   model_points.shape[0],
+                                                   &points2d[0, 0] if num_points2d > 0 else NULL,
+                                                   &points2d_cid[0] if num_points2d > 0 else NULL,
+                                                   &points2d_pid[0] if num_points2d > 0 else NULL,
+                                                   &points2d_fid[0] if num_points2d > 0 else NULL,
+                                                   num_points2d,
+                                                   &cameras[0, 0] if cameras.shape[0] > 0 else NULL,
+                                                   cameras.shape[0],
+                                                   &object_poses[0, 0] if object_poses.shape[0] > 0 else NULL,
+                                                   object_poses.shape[0])
+        self.c_BundleAdjuster.setVerbose(verbose)
+
+    def __dealloc__(self):
+        del self.c_BundleAdjuster
+
+    def set_solver_settings(self, linear_solver='DENSE_SCHUR', preconditioner='JACOBI', int num_threads=1,
+                            int max_iterations=50, double function_tolerance=1e-4,
+                            double gradient_tolerance=1e-10, double parameter_tolerance=1e-8,
+                            loss='NONE', double loss_scale=1.0, int outlier_rounds=0, double outlier_threshold=3.0,
+                            bint analytic_jacobians=False):
+        """ Options of the ceres solver, the robust loss, outlier rejection and whether hand derived jacobians are used.
+            Raises a ValueError for unknown linear solvers, preconditioners or losses. """
+        cdef SolverSettings settings
+        settings.linearSolver = linear_solver.encode('UTF-8')
+        settings.preconditioner = preconditioner.encode('UTF-8')
+        settings.numThreads = num_threads
+        settings.maxIterations = max_iterations
+        settings.functionTolerance = function_tolerance
+        settings.gradientTolerance = gradient_tolerance
+        settings.parameterTolerance = parameter_tolerance
+        settings.loss = loss.encode('UTF-8')
+        settings.lossScale = loss_scale
+        settings.outlierRounds = outlier_rounds
+        settings.outlierThreshold = outlier_threshold
+        settings.analyticJacobians = analytic_jacobians
+        self.c_BundleAdjuster.setSolverSettings(settings)
+
+    def optimize(self):
+        """ Runs the optimization, afterwards cameras and object_poses contain the optimized values. """
+        with nogil:
+            self.c_BundleAdjuster.optimize()
+        if self.cameras.shape[0] > 0:
+            self.c_BundleAdjuster.writeCameras(&self.cameras[0, 0])
+
+    def get_rejected(self):
+        """ Ids of the observations discarded by outlier rejection. """
+        return np.array(self.c_BundleAdjuster.getRejected(), dtype=np.int64)
@@ -0,0 +1,184 @@
+#ifndef H_ANALYTICPROJECTION
+#define H_ANALYTICPROJECTION
+
+#include <cmath>
+#include <cstring>
+#include <limits>
+
+// Hand derived jacobians of the camera model used by the ReprojectionError functors.
+// All jacobians are stored row-major, as ceres expects them.
+
+// 3x3 matrix product C = A*B
+inline void matMul3(const double* A, const double* B, double* C) {
+    for (int r = 0; r < 3; ++r)
+        for (int c = 0; c < 3; ++c)
+            C[r*3 + c] = A[r*3]*B[c] + A[r*3 + 1]*B[3 + c] + A[r*3 + 2]*B[6 + c];
+}
+
+// Skew symmetric cross product matrix: skew(a)*b = a x b
+inline void skew3(const double* a, double* S) {
+    S[0] = 0.0;   S[1] = -a[2]; S[2] = a[1];
+    S[3] = a[2];  S[4] = 0.0;   S[5] = -a[0];
+    S[6] = -a[1]; S[7] = a[0];  S[8] = 0.0;
+}
+
+// Rotates point p by the angle axis vector w, same as ceres::AngleAxisRotatePoint.
+// Also returns the jacobians of the result w.r.t. w and w.r.t. p (3x3 each).
+inline void angleAxisRotatePointWithJacobian(const double* w, const double* p, double* result,
+                                             double* jacobianRotation, double* jacobianPoint) {
+    const double theta2 = w[0]*w[0] + w[1]*w[1] + w[2]*w[2];
+    double Sp[9];
+    skew3(p, Sp);
+
+    if (theta2 > std::numeric_limits<double>::epsilon()) {
+        // Rodrigues formula: R = cos(t) I + sin(t) [k]x + (1 - cos(t)) k k^T
+        const double theta = std::sqrt(theta2);
+        const double cosTheta = std::cos(theta), sinTheta = std::sin(theta);
+        const double k[3] = {w[0]/theta, w[1]/theta, w[2]/theta};
+        double R[9], Sw[9], SwSw[9];
+        skew3(k, R);
+        for (int r = 0; r < 3; ++r)
+            for (int c = 0; c < 3; ++c)
+                R[r*3 + c] = sinTheta*R[r*3 + c] + (1.0 - cosTheta)*k[r]*k[c] + (r == c ? cosTheta : 0.0);
+
+        for (int r = 0; r < 3; ++r)
+            result[r] = R[r*3]*p[0] + R[r*3 + 1]*p[1] + R[r*3 + 2]*p[2];
+
+        // d(R p)/dw = -R [p]x Jr(w), with the right jacobian of SO(3)
+        // Jr(w) = I - (1 - cos(t))/t^2 [w]x + (t - sin(t))/t^3 [w]x^2
+        skew3(w, Sw);
+        matMul3(Sw, Sw, SwSw);
+        const double a = (1.0 - cosTheta) / theta2, b = (theta - sinTheta) / (theta2*theta);
+        double Jr[9], RSp[9];
+        for (int i = 0; i < 9; ++i)
+            Jr[i] = -a*Sw[i] + b*SwSw[i] + (i % 4 == 0 ? 1.0 : 0.0);
+        matMul3(R, Sp, RSp);
+        matMul3(RSp, Jr, jacobianRotation);
+        for (int i = 0; i < 9; ++i) {
+            jacobianRotation[i] = -jacobianRotation[i];
+            jacobianPoint[i] = R[i];
+        }
+    } else {
+        // Near zero the first order approximation R = I + [w]x is used
+        result[0] = p[0] + w[1]*p[2] - w[2]*p[1];
+        result[1] = p[1] + w[2]*p[0] - w[0]*p[2];
+        result[2] = p[2] + w[0]*p[1] - w[1]*p[0];
+
+        skew3(w, jacobianPoint);
+        for (int i = 0; i < 9; ++i) {
+            jacobianRotation[i] = -Sp[i];
+            jacobianPoint[i] += (i % 4 == 0 ? 1.0 : 0.0);
+        }
+    }
+}
+
+// Projection of a model point into the image: Object pose, camera pose and the pinhole model with
+// OpenCV distortion (3 radial, 2 tangential), together with the jacobians of the image point (2xN)
+// w.r.t. all inputs.
+struct AnalyticProjection {
+    double point[2];  // projected image point
+    double objectTranslation[6];
+    double objectRotation[6];
+    double cameraTranslation[6];
+    double cameraRotation[6];
+    double cameraFocal[4];
+    double cameraPrincipal[4];
+    double cameraDist[10];
+
+    AnalyticProjection(const double* modelPoint,
+                       const double* objT, const double* objR,
+                       const double* camT, const double* camR,
+                       const double* focal, const double* principal, const double* dist,
+                       bool computeJacobians) {
+        // Point in the world frame and in the camera frame
+        double pObj[3], pCam[3], dObjR[9], dObjP[9], dCamR[9], dCamP[9];
+        angleAxisRotatePointWithJacobian(objR, modelPoint, pObj, dObjR, dObjP);
+        for (int i = 0; i < 3; ++i)
+            pObj[i] += objT[i];
+        angleAxisRotatePointWithJacobian(camR, pObj, pCam, dCamR, dCamP);
+        for (int i = 0; i < 3; ++i)
+            pCam[i] += camT[i];
+
+        const double xp = pCam[0] / pCam[2];
+        const double yp = pCam[1] / pCam[2];
+
+        const double& k1 = dist[0];
+        const double& k2 = dist[1];
+        const double& p1 = dist[2];
+        const double& p2 = dist[3];
+        const double& k3 = dist[4];
+
+        const double r2 = xp*xp + yp*yp;
+        const double distortionRadial = 1.0 + r2*(k1 + r2*(k2 + r2*k3));
+        const double distortedX = xp*distortionRadial + 2.0*p1*xp*yp + p2*(r2 + 2.0*xp*xp);
+        const double distortedY = yp*distortionRadial + 2.0*p2*xp*yp + p1*(r2 + 2.0*yp*yp);
+
+        point[0] = focal[0]*distortedX + principal[0];
+        point[1] = focal[1]*distortedY + principal[1];
+        if (!computeJacobians)
+            return;
+
+        // Distortion and focal length: d(point)/d(xp, yp)
+        const double dRadial = k1 + r2*(2.0*k2 + 3.0*r2*k3);  // d(distortionRadial)/d(r2)
+        double dDistorted[4];
+        dDistorted[0] = focal[0]*(distortionRadial + 2.0*xp*xp*dRadial + 2.0*p1*yp + 6.0*p2*xp);
+        dDistorted[1] = focal[0]*(2.0*xp*yp*dRadial + 2.0*p1*xp + 2.0*p2*yp);
+        dDistorted[2] = focal[1]*(2.0*xp*yp*dRadial + 2.0*p2*yp + 2.0*p1*xp);
+        dDistorted[3] = focal[1]*(distortionRadial + 2.0*yp*yp*dRadial + 2.0*p2*xp + 6.0*p1*yp);
+
+        // Perspective division: d(xp, yp)/d(pCam)
+        const double invZ = 1.0 / pCam[2];
+        const double dNormalized[6] = {invZ, 0.0, -xp*invZ,
+                                       0.0, invZ, -yp*invZ};
+
+        // d(point)/d(pCam) equals the jacobian w.r.t. the camera translation
+        for (int r = 0; r < 2; ++r)
+            for (int c = 0; c < 3; ++c)
+                cameraTranslation[r*3 + c] = dDistorted[r*2]*dNormalized[c] + dDistorted[r*2 + 1]*dNormalized[3 + c];
+
+        // d(point)/d(pObj) equals the jacobian w.r.t. the object translation
+        for (int r = 0; r < 2; ++r)
+            for (int c = 0; c < 3; ++c)
+                objectTranslation[r*3 + c] = cameraTranslation[r*3]*dCamP[c] + cameraTranslation[r*3 + 1]*dCamP[3 + c]
+                                             + cameraTranslation[r*3 + 2]*dCamP[6 + c];
+
+        for (int r = 0; r < 2; ++r) {
+            for (int c = 0; c < 3; ++c) {
+                cameraRotation[r*3 + c] = cameraTranslation[r*3]*dCamR[c] + cameraTranslation[r*3 + 1]*dCamR[3 + c]
+                                          + cameraTranslation[r*3 + 2]*dCamR[6 + c];
+                objectRotation[r*3 + c] = objectTranslation[r*3]*dObjR[c] + objectTranslation[r*3 + 1]*dObjR[3 + c]
+                                          + objectTranslation[r*3 + 2]*dObjR[6 + c];
+            }
+        }
+
+        cameraFocal[0] = distortedX; cameraFocal[1] = 0.0;
+        cameraFocal[2] = 0.0;        cameraFocal[3] = distortedY;
+
+        cameraPrincipal[0] = 1.0; cameraPrincipal[1] = 0.0;
+        cameraPrincipal[2] = 0.0; cameraPrincipal[3] = 1.0;
+
+        // order of the distortion parameters: k1, k2, p1, p2, k3
+        const double r4 = r2*r2;
+        cameraDist[0] = focal[0]*xp*r2;
+        cameraDist[1] = focal[0]*xp*r4;
+        cameraDist[2] = focal[0]*2.0*xp*yp;
+        cameraDist[3] = focal[0]*(r2 + 2.0*xp*xp);
+        cameraDist[4] = focal[0]*xp*r4*r2;
+        cameraDist[5] = focal[1]*yp*r2;
+        cameraDist[6] = focal[1]*yp*r4;
+        cameraDist[7] = focal[1]*(r2 + 2.0*yp*yp);
+        cameraDist[8] = focal[1]*2.0*xp*yp;
+        cameraDist[9] = focal[1]*yp*r4*r2;
+    }
+};
+
+// Writes the jacobian of the projected point (2xblockSize) into the first two rows of a residual block jacobian
+// and zeros the remaining rows. Nothing is done for jacobians ceres did not ask for.
+inline void setProjectionJacobian(double* jacobian, int numResiduals, int blockSize, const double* projectionJacobian) {
+    if (jacobian == NULL)
+        return;
+    std::memcpy(jacobian, projectionJacobian, sizeof(double)*2*blockSize);
+    std::memset(jacobian + 2*blockSize, 0, sizeof(double)*(numResiduals - 2)*blockSize);
+}
+
+#endif
@@ -0,0 +1,46 @@
+#ifndef H_BINARYFORMAT
+#define H_BINARYFORMAT
+
+#include <stdint.h>
+#include <string.h>
+
+// Binary problem file, all values little-endian:
+//  header      BinaryHeader (24 bytes)
+//  float64     cameras [numCams, 17]
+//  float64     modelPoints [numModelPoints, 3]
+//  float64     objectPoses [numFrames, 6]
+//  float64     points2d [numPoints2d, 2]
+//  uint32      points2d pid [numPoints2d], cid [numPoints2d], fid [numPoints2d]
+// Optimization results are written in the same format without model points and observations. There numPoints2d
+// counts the observations discarded by outlier rejection and the file ends with their uint32 ids instead.
+#define BINARY_FORMAT_MAGIC "FCBA"
+#define BINARY_FORMAT_VERSION 1
+
+struct BinaryHeader {
+    char magic[4];
+    uint32_t version;
+    uint32_t numCams;
+    uint32_t numModelPoints;
+    uint32_t numFrames;
+    uint32_t numPoints2d;
+    
+    BinaryHeader(): version(BINARY_FORMAT_VERSION), numCams(0), numModelPoints(0), numFrames(0), numPoints2d(0) {
+        memcpy(magic, BINARY_FORMAT_MAGIC, 4);
+    }
+    
+    bool isValid(void) const {
+        return (memcmp(magic, BINARY_FORMAT_MAGIC, 4) == 0) && (version == BINARY_FORMAT_VERSION);
+    }
+    
+    // Expected file size in bytes
+    size_t fileSize(void) const {
+        return sizeof(BinaryHeader) 
+               + sizeof(double)*(17*(size_t)numCams + 3*(size_t)numModelPoints + 6*(size_t)numFrames + 2*(size_t)numPoints2d)
+               + sizeof(uint32_t)*3*(size_t)numPoints2d;
+    }
+};
+
+// The Python side (core/EstimateM.py, BAL_BIN_HEADER_SIZE) relies on this layout
+static_assert(sizeof(BinaryHeader) == 24, "BinaryHeader must be 24 bytes without padding");
+
+#endif
@@ -6,6 +6,8 @@
 #include <list>
 #include <fstream>
 #include <iostream>
+#include <memory>
+#include <cmath>
 
 #include "ceres/ceres.h"
 #include "ceres/rotation.h"
@@ -15,42 +17,18 @@
 #include "ReprojectionError.h"
 #include "ReprojectionErrorNoIntrinsic.h"
 #include "ReprojectionErrorNoIntrinsicNoExtrinsic.h"
+#include "ViewReprojectionError.h"
 #include "Camera.hpp"
+#include "BinaryFormat.h"
+#include "SolverSettings.h"
 
 using namespace nlohmann;
 
-class ObservedPoint {
-public:
-    unsigned int cid;
-    unsigned int pid;
-    unsigned int fid;
-    double u;
-    double v;
-    
-    ObservedPoint(unsigned int cid, unsigned int pid, unsigned int fid,
-                  double u, double v):
-        cid(cid),
-        pid(pid),
-        fid(fid),
-        u(u),
-        v(v)
-        { }
-};
-
-class WorldPoint {
-public:
-    double coord[3];
-    
-    WorldPoint(double x, double y, double z) { 
-            coord[0] = x;
-            coord[1] = y;
-            coord[2] = z;
-        }
-        
-    double* get(void){
-        return this->coord;
-    }
-};
+// Cost functions over all observations of a view, template arguments are #residuals per observation, #param1, #param2, ...
+typedef ViewReprojectionError<ReprojectionErrorWithRadialFull, 9, 3, 3, 3, 3, 2, 2, 5> ViewReprojectionErrorWithRadialFull;
+typedef ViewReprojectionError<ReprojectionError, 4, 3, 3, 3, 3, 2, 2> ViewReprojectionErrorIntrinsic;
+typedef ViewReprojectionError<ReprojectionErrorNoIntrinsic, 2, 3, 3, 3, 3> ViewReprojectionErrorNoIntrinsic;
+typedef ViewReprojectionError<ReprojectionErrorNoIntrinsicNoExtrinsic, 2, 3, 3> ViewReprojectionErrorNoIntrinsicNoExtrinsic;
 
 class BundleAdjuster {
 private:
@@ -58,13 +36,30 @@ private:
     bool m_optimizeRadial;
     bool m_optimizeExtrinsic;
     bool m_useSharedCameraModel;
+    bool m_verbose;
+    SolverSettings m_settings;
     
+    // Problem data is only referenced, either pointing into buffers owned by the caller
+    // or into the m_owned* containers below.
     double* m_modelPoints3d;
-    double* m_objectPoses;
+    double* m_objectPoses;  // optimized in place
+    const double* m_points2d;
+    const unsigned int* m_points2dCamId;
+    const unsigned int* m_points2dPtsId;
+    const unsigned int* m_points2dFrameId;
     unsigned int m_numFrames;
     unsigned int m_num3dPoints;
-    std::vector< ObservedPoint > m_points2d;
+    unsigned int m_numPoints2d;
     std::vector<Camera> m_camera;
+    std::vector<unsigned char> m_rejected;  // observations discarded by outlier rejection
+    
+    // Storage in case the problem was passed as std::vectors
+    std::vector<double> m_ownedModelPoints3d;
+    std::vector<double> m_ownedObjectPoses;
+    std::vector<double> m_ownedPoints2d;
+    std::vector<unsigned int> m_ownedPoints2dCamId;
+    std::vector<unsigned int> m_ownedPoints2dPtsId;
+    std::vector<unsigned int> m_ownedPoints2dFrameId;
     
 public:
     BundleAdjuster(bool optimizeIntrinsic, bool optimizeRadial, bool optimizeExtrinsic, bool useSharedCameraModel,
@@ -78,25 +73,34 @@ public:
             m_optimizeIntrinsic(optimizeIntrinsic),
             m_optimizeRadial(optimizeRadial),
             m_optimizeExtrinsic(optimizeExtrinsic),
-            m_useSharedCameraModel(useSharedCameraModel){
+            m_useSharedCameraModel(useSharedCameraModel),
+            m_verbose(true),
+            m_ownedPoints2dCamId(points2dCamId),
+            m_ownedPoints2dPtsId(points2dPtsId),
+            m_ownedPoints2dFrameId(points2dFrameId) {
         
         // Copy 3d points
         m_num3dPoints = modelPoints3d.size();
-        m_modelPoints3d = new double[m_num3dPoints*3];
+        m_ownedModelPoints3d.resize(m_num3dPoints*3);
         for (unsigned int i=0; i< m_num3dPoints; ++i) {
-            m_modelPoints3d[i*3 + 0] = modelPoints3d[i][0];
-            m_modelPoints3d[i*3 + 1] = modelPoints3d[i][1];
-            m_modelPoints3d[i*3 + 2] = modelPoints3d[i][2];
+            m_ownedModelPoints3d[i*3 + 0] = modelPoints3d[i][0];
+            m_ownedModelPoints3d[i*3 + 1] = modelPoints3d[i][1];
+            m_ownedModelPoints3d[i*3 + 2] = modelPoints3d[i][2];
         }
+        m_modelPoints3d = m_ownedModelPoints3d.data();
         
         // Copy observed points
-        for (unsigned int i=0; i< points2d.size(); ++i) {
-            m_points2d.push_back(ObservedPoint(points2dCamId[i],
-                                               points2dPtsId[i],
-                                               points2dFrameId[i],
-                                               points2d[i][0],
-                                               points2d[i][1]));
+        m_numPoints2d = points2d.size();
+        m_ownedPoints2d.resize(m_numPoints2d*2);
+        for (unsigned int i=0; i< m_numPoints2d; ++i) {
+            m_ownedPoints2d[i*2 + 0] = points2d[i][0];
+            m_ownedPoints2d[i*2 + 1] = points2d[i][1];
         }
+        m_points2d = m_ownedPoints2d.data();
+        m_points2dCamId = m_ownedPoints2dCamId.data();
+        m_points2dPtsId = m_ownedPoints2dPtsId.data();
+        m_points2dFrameId = m_ownedPoints2dFrameId.data();
+        m_rejected.resize(m_numPoints2d, 0);
         
         // Copy cameras
         for (unsigned int i=0; i< cameraList.size(); ++i) {
@@ -110,17 +114,98 @@ public:
         
         // Copy object poses
         m_numFrames = objectPosesList.size();
-        m_objectPoses = new double[m_numFrames*6];
+        m_ownedObjectPoses.resize(m_numFrames*6);
         for (unsigned int i=0; i< objectPosesList.size(); ++i)
         for (unsigned int j=0; j< 6; ++j) {
-            m_objectPoses[i*6 + j] = objectPosesList[i][j];
+            m_ownedObjectPoses[i*6 + j] = objectPosesList[i][j];
         }
-
+        m_objectPoses = m_ownedObjectPoses.data();
+    }
+    
+    // Works directly on the given row major buffers, which need to outlive the adjuster: 
+    // modelPoints3d [num3dPoints, 3], points2d [numPoints2d, 2], ids [numPoints2d],
+    // cameras [numCams, 17] and objectPoses [numFrames, 6]. Object poses are optimized in place, 
+    // the optimized camera parameters can be retrieved with writeCameras().
+    BundleAdjuster(bool optimizeIntrinsic, bool optimizeRadial, bool optimizeExtrinsic, bool useSharedCameraModel,
+                   double* modelPoints3d, unsigned int num3dPoints,
+                   const double* points2d,
+                   const unsigned int* points2dCamId,
+                   const unsigned int* points2dPtsId,
+                   const unsigned int* points2dFrameId,
+                   unsigned int numPoints2d,
+                   const double* cameras, unsigned int numCams,
+                   double* objectPoses, unsigned int numFrames):
+            m_optimizeIntrinsic(optimizeIntrinsic),
+            m_optimizeRadial(optimizeRadial),
+            m_optimizeExtrinsic(optimizeExtrinsic),
+            m_useSharedCameraModel(useSharedCameraModel),
+            m_verbose(true),
+            m_modelPoints3d(modelPoints3d),
+            m_objectPoses(objectPoses),
+            m_points2d(points2d),
+            m_points2dCamId(points2dCamId),
+            m_points2dPtsId(points2dPtsId),
+            m_points2dFrameId(points2dFrameId),
+            m_numFrames(numFrames),
+            m_num3dPoints(num3dPoints),
+            m_numPoints2d(numPoints2d) {
+        
+        m_rejected.resize(m_numPoints2d, 0);
+        
+        // Cameras are few and are being copied
+        for (unsigned int i=0; i< numCams; ++i) {
+            const double* c = &cameras[i*17];
+            m_camera.push_back(Camera(c[0], c[1], c[2], c[3],
+                                      c[4], c[5], c[6], c[7], c[8],
+                                      c[9], c[10], c[11],
+                                      c[12], c[13], c[14],
+                                      static_cast<int>(c[15]), static_cast<int>(c[16])));
+        }
+    }
+    
+    void setVerbose(bool verbose) {
+        m_verbose = verbose;
+    }
+    
+    // Throws std::invalid_argument for invalid settings
+    void setSolverSettings(const SolverSettings& settings) {
+        ceres::Solver::Options options;
+        settings.apply(options);
+        m_settings = settings;
     }
     
-    ~BundleAdjuster() {
-        delete [] m_modelPoints3d;
-        delete [] m_objectPoses;
+    // Ids of the observations discarded by outlier rejection
+    std::vector<unsigned int> getRejected(void) {
+        std::vector<unsigned int> rejected;
+        for (unsigned int i=0; i<m_numPoints2d; ++i) {
+            if (m_rejected[i])
+                rejected.push_back(i);
+        }
+        return rejected;
+    }
+    
+    // Writes the camera parameters into cameras [numCams, 17] using the same layout as the input.
+    void writeCameras(double* cameras) {
+        for (unsigned int i=0; i<m_camera.size(); ++i) {
+            unsigned int cid = i;
+            if (m_useSharedCameraModel) {
+                // In case of a shared model only the first cameras focal/pp/dist was optimized
+                cid = 0;
+            }
+            double* c = &cameras[i*17];
+            c[0] = m_camera[cid].focal[0];
+            c[1] = m_camera[cid].focal[1];
+            c[2] = m_camera[cid].principal[0];
+            c[3] = m_camera[cid].principal[1];
+            for (unsigned int j=0; j<5; ++j)
+                c[4 + j] = m_camera[cid].dist[j];
+            for (unsigned int j=0; j<3; ++j) {
+                c[9 + j] = m_camera[i].camRotation[j];
+                c[12 + j] = m_camera[i].camTranslation[j];
+            }
+            c[15] = m_camera[i].imgSize[0];
+            c[16] = m_camera[i].imgSize[1];
+        }
     }
     
     void printCameras(void) {
@@ -170,136 +255,263 @@ public:
                                           m_objectPoses[i*6+5]});
         }
         outputDict["ObjectPoses"] = objectPosesList;
+        outputDict["Rejected"] = this->getRejected();
         
         std::cout << "Wrote output file: " << outputFilePath << "\n";
         outputFile << std::setw(4) << outputDict << std::endl;
         std::cout.flush();
     }
     
-    void optimize(void) {                        
-        // Set up optimization problem
-        ceres::Problem problem;
+    void writeBinary(std::string outputFilePath) {
+        std::vector<unsigned int> rejected = this->getRejected();
+        BinaryHeader header;
+        header.numCams = m_camera.size();
+        header.numFrames = m_numFrames;
+        header.numPoints2d = rejected.size();
+        
+        std::vector<double> cameras(17*m_camera.size());
+        this->writeCameras(cameras.data());
+        
+        std::ofstream outputFile(outputFilePath, std::ios::binary);
+        outputFile.write(reinterpret_cast<const char*>(&header), sizeof(BinaryHeader));
+        outputFile.write(reinterpret_cast<const char*>(cameras.data()), sizeof(double)*cameras.size());
+        outputFile.write(reinterpret_cast<const char*>(m_objectPoses), sizeof(double)*6*m_numFrames);
+        outputFile.write(reinterpret_cast<const char*>(rejected.data()), sizeof(unsigned int)*rejected.size());
+        
+        std::cout << "Wrote output file: " << outputFilePath << "\n";
+        std::cout.flush();
+    }
+    
+    // Groups the observations that were not rejected by view (frame, camera): The observations of group g are
+    // order[offsets[g]:offsets[g+1]].
+    void groupObservations(std::vector<unsigned int>& order, std::vector<unsigned int>& offsets) {
+        order.clear();
+        offsets.assign(1, 0);
         
-        if (m_optimizeRadial && m_optimizeIntrinsic && m_optimizeExtrinsic) {
-            std::cout << "Optimizing object pose, camera intrinsics, distortion and camera extrinsics.\n";
-        } 
-        else if (!m_optimizeRadial && m_optimizeIntrinsic && m_optimizeExtrinsic) {
-            std::cout << "Optimizing object pose, camera intrinsics and extrinsics.\n";
+        // counting sort by view, keeps the order of observations within a view
+        size_t numCams = m_camera.size();
+        std::vector<unsigned int> start(m_numFrames*numCams + 1, 0);
+        for (unsigned int i = 0; i < m_numPoints2d; ++i) {
+            if (!m_rejected[i])
+                start[m_points2dFrameId[i]*numCams + m_points2dCamId[i] + 1] += 1;
         }
-        else if (!m_optimizeIntrinsic && m_optimizeExtrinsic) {
-            std::cout << "Optimizing object pose and camera extrinsics\n";
+        for (size_t k = 0; k < m_numFrames*numCams; ++k) {
+            if (start[k + 1] > 0)
+                offsets.push_back(start[k] + start[k + 1]);
+            start[k + 1] += start[k];
         }
-        else if (!m_optimizeRadial && !m_optimizeIntrinsic && !m_optimizeExtrinsic) {
-            std::cout << "Optimizing only object pose.\n";
+        order.resize(start.back());
+        for (unsigned int i = 0; i < m_numPoints2d; ++i) {
+            if (!m_rejected[i])
+                order[start[m_points2dFrameId[i]*numCams + m_points2dCamId[i]]++] = i;
         }
+    }
+    
+    // Adds one residual block per view for the observations that were not rejected. The observation ids are appended 
+    // to obsIds in the order their residuals appear in the problem.
+    // A robust loss is applied to each observation of a block separately (see PerObservationLoss).
+    void buildProblem(ceres::Problem& problem, const ceres::LossFunction* lossFunction,
+                      std::vector<ceres::ResidualBlockId>& blockIds, std::vector<unsigned int>& obsIds) {
+        std::vector<unsigned int> order, offsets;
+        this->groupObservations(order, offsets);
         
-        for (int i = 0; i < m_points2d.size(); ++i) {
-            unsigned int cid = m_points2d[i].cid;  // camera id
-            unsigned int cidShared = m_points2d[i].cid;  // camera id indicating where the shared parameters are stored
-            unsigned int pid = m_points2d[i].pid;  // point id
-            unsigned int fid = m_points2d[i].fid;  // frame id
+        for (size_t g = 0; g + 1 < offsets.size(); ++g) {
+            unsigned int first = order[offsets[g]];
+            unsigned int cid = m_points2dCamId[first];  // camera id
+            unsigned int cidShared = m_points2dCamId[first];  // camera id indicating where the shared parameters are stored
+            unsigned int fid = m_points2dFrameId[first];  // frame id
+            ceres::CostFunction* cost_function = NULL;
+            std::vector<double*> parameters;
             
             if (m_useSharedCameraModel) {
                 // In case of the shared camera model we only optimize the first set
                 cidShared = 0;
             }
             
-            // Each Residual block takes a point and a camera as input and outputs a 2
-            // dimensional residual. Internally, the cost function stores the observed
-            // image location and compares the reprojection against the observation.
+            // Each Residual block takes the points of a view and a camera as input and outputs residuals for each point. 
+            // Internally, the cost function stores the observed image locations and compares the reprojection 
+            // against the observation.
             if (m_optimizeRadial && m_optimizeIntrinsic && m_optimizeExtrinsic) {
 //                 std::cout << "Optimizing 3D points, camera intrinsics, distortion and camera extrinsics.\n";
-                ceres::CostFunction* cost_function = ReprojectionErrorWithRadialFull::Create(m_points2d[i].u,
-                                                                                             m_points2d[i].v,
-                                                                                             &m_camera[cid].imgSize[0],
-                                                                                             &m_camera[cid].imgSize[1],
-                                                                                             &m_modelPoints3d[pid*3]);
-                
-                ceres::LossFunction* loss_function = new ceres::HuberLoss(0.2);
-                problem.AddResidualBlock(cost_function,
-    //                                         loss_function, // NULL /* squared loss */,
-                                        NULL /* squared loss */,
-                                        &m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
-                                        &m_objectPoses[fid*6], // first 3 rotation
-                                        m_camera[cid].getTrans(),
-                                        m_camera[cid].getRot(),
-                                        m_camera[cidShared].getFocal(),
-                                        m_camera[cidShared].getPrincipal(),
-                                        m_camera[cidShared].getDist());
+                std::vector<ReprojectionErrorWithRadialFull> points;
+                for (unsigned int j = offsets[g]; j < offsets[g + 1]; ++j) {
+                    unsigned int i = order[j];
+                    points.push_back(ReprojectionErrorWithRadialFull(m_points2d[i*2], m_points2d[i*2 + 1],
+                                                                     &m_camera[cid].imgSize[0],
+                                                                     &m_camera[cid].imgSize[1],
+                                                                     &m_modelPoints3d[m_points2dPtsId[i]*3]));
+                }
+                cost_function = m_settings.analyticJacobians ? ViewReprojectionErrorWithRadialFull::CreateAnalytic(points) : ViewReprojectionErrorWithRadialFull::Create(points);
+                parameters = {&m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
+                              &m_objectPoses[fid*6], // first 3 rotation
+                              m_camera[cid].getTrans(),
+                              m_camera[cid].getRot(),
+                              m_camera[cidShared].getFocal(),
+                              m_camera[cidShared].getPrincipal(),
+                              m_camera[cidShared].getDist()};
             } 
             else if (!m_optimizeRadial && m_optimizeIntrinsic && m_optimizeExtrinsic) {
 //                 std::cout << "Optimizing 3D points, camera intrinsics and extrinsics.\n";
-                ceres::CostFunction* cost_function = ReprojectionError::Create(m_points2d[i].u,
-                                                                               m_points2d[i].v,
-                                                                               &m_camera[cid].imgSize[0],
-                                                                               &m_camera[cid].imgSize[1],
-                                                                               m_camera[cidShared].getDist(),
-                                                                               &m_modelPoints3d[pid*3]);
-                
-                ceres::LossFunction* loss_function = new ceres::HuberLoss(0.2);
-                problem.AddResidualBlock(cost_function,
-//                                         loss_function, // NULL /* squared loss */,
-                                        NULL /* squared loss */,
-                                        &m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
-                                        &m_objectPoses[fid*6], // first 3 rotation
-                                        m_camera[cid].getTrans(),
-                                        m_camera[cid].getRot(),
-                                        m_camera[cidShared].getFocal(),
-                                        m_camera[cidShared].getPrincipal());
+                std::vector<ReprojectionError> points;
+                for (unsigned int j = offsets[g]; j < offsets[g + 1]; ++j) {
+                    unsigned int i = order[j];
+                    points.push_back(ReprojectionError(m_points2d[i*2], m_points2d[i*2 + 1],
+                                                       &m_camera[cid].imgSize[0],
+                                                       &m_camera[cid].imgSize[1],
+                                                       m_camera[cidShared].getDist(),
+                                                       &m_modelPoints3d[m_points2dPtsId[i]*3]));
+                }
+                cost_function = m_settings.analyticJacobians ? ViewReprojectionErrorIntrinsic::CreateAnalytic(points) : ViewReprojectionErrorIntrinsic::Create(points);
+                parameters = {&m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
+                              &m_objectPoses[fid*6], // first 3 rotation
+                              m_camera[cid].getTrans(),
+                              m_camera[cid].getRot(),
+                              m_camera[cidShared].getFocal(),
+                              m_camera[cidShared].getPrincipal()};
             }
             else if (!m_optimizeIntrinsic && m_optimizeExtrinsic) {
 //                 std::cout << "Optimizing 3D points and camera extrinsics\n";
-                ceres::CostFunction* cost_function = ReprojectionErrorNoIntrinsic::Create(m_points2d[i].u,
-                                                                                          m_points2d[i].v,
-                                                                                          m_camera[cidShared].getFocal(),
-                                                                                          m_camera[cidShared].getPrincipal(),
-                                                                                          m_camera[cidShared].getDist(), &m_modelPoints3d[pid*3]);
-                
-                ceres::LossFunction* loss_function = new ceres::HuberLoss(0.2);
-                problem.AddResidualBlock(cost_function,
-//                                         loss_function, // NULL /* squared loss */,
-                                        NULL /* squared loss */,
-                                        &m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
-                                        &m_objectPoses[fid*6], // first 3 rotation
-                                        m_camera[cid].getTrans(),
-                                        m_camera[cid].getRot());
+                std::vector<ReprojectionErrorNoIntrinsic> points;
+                for (unsigned int j = offsets[g]; j < offsets[g + 1]; ++j) {
+                    unsigned int i = order[j];
+                    points.push_back(ReprojectionErrorNoIntrinsic(m_points2d[i*2], m_points2d[i*2 + 1],
+                                                                  m_camera[cidShared].getFocal(),
+                                                                  m_camera[cidShared].getPrincipal(),
+                                                                  m_camera[cidShared].getDist(), 
+                                                                  &m_modelPoints3d[m_points2dPtsId[i]*3]));
+                }
+                cost_function = m_settings.analyticJacobians ? ViewReprojectionErrorNoIntrinsic::CreateAnalytic(points) : ViewReprojectionErrorNoIntrinsic::Create(points);
+                parameters = {&m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
+                              &m_objectPoses[fid*6], // first 3 rotation
+                              m_camera[cid].getTrans(),
+                              m_camera[cid].getRot()};
             }
             else if (!m_optimizeRadial && !m_optimizeIntrinsic && !m_optimizeExtrinsic) {
 //                 std::cout << "Optimizing only the 3D points\n";
-                ceres::CostFunction* cost_function = ReprojectionErrorNoIntrinsicNoExtrinsic::Create(m_points2d[i].u,
-                                                                                          m_points2d[i].v,
-                                                                                          m_camera[cid].getTrans(),
-                                                                                          m_camera[cid].getRot(),
-                                                                                          m_camera[cidShared].getFocal(),
-                                                                                          m_camera[cidShared].getPrincipal(),
-                                                                                          m_camera[cidShared].getDist(), &m_modelPoints3d[pid*3]);
-                
-                ceres::LossFunction* loss_function = new ceres::HuberLoss(0.2);
-                problem.AddResidualBlock(cost_function,
-//                                         loss_function, // NULL /* squared loss */,
-                                        NULL /* squared loss */,
-                                        &m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
-                                        &m_objectPoses[fid*6]); // first 3 rotation
-                                        
+                std::vector<ReprojectionErrorNoIntrinsicNoExtrinsic> points;
+                for (unsigned int j = offsets[g]; j < offsets[g + 1]; ++j) {
+                    unsigned int i = order[j];
+                    points.push_back(ReprojectionErrorNoIntrinsicNoExtrinsic(m_points2d[i*2], m_points2d[i*2 + 1],
+                                                                             m_camera[cid].getTrans(),
+                                                                             m_camera[cid].getRot(),
+                                                                             m_camera[cidShared].getFocal(),
+                                                                             m_camera[cidShared].getPrincipal(),
+                                                                             m_camera[cidShared].getDist(), 
+                                                                             &m_modelPoints3d[m_points2dPtsId[i]*3]));
+                }
+                cost_function = m_settings.analyticJacobians ? ViewReprojectionErrorNoIntrinsicNoExtrinsic::CreateAnalytic(points) : ViewReprojectionErrorNoIntrinsicNoExtrinsic::Create(points);
+                parameters = {&m_objectPoses[fid*6 + 3],  // 6 params per frame; second 3 translation
+                              &m_objectPoses[fid*6]}; // first 3 rotation
+            }
+            
+            if (cost_function != NULL) {
+                if (lossFunction != NULL) {
+                    cost_function = new PerObservationLoss(cost_function, lossFunction,
+                                                           cost_function->num_residuals() / (offsets[g + 1] - offsets[g]));
+                }
+                blockIds.push_back(problem.AddResidualBlock(cost_function, NULL, parameters));
+                obsIds.insert(obsIds.end(), order.begin() + offsets[g], order.begin() + offsets[g + 1]);
             }
         }
+    }
+    
+    // Rejects all observations with a reprojection error larger than outlierThreshold times the RMS error.
+    // Returns the number of newly rejected observations.
+    unsigned int rejectOutliers(ceres::Problem& problem,
+                                const std::vector<ceres::ResidualBlockId>& blockIds,
+                                const std::vector<unsigned int>& obsIds) {
+        if (obsIds.empty())
+            return 0;
         
-        std::cout << "Problem defined. Starting optimization...\n";
-        std::cout.flush();
+        // Residuals without the robust loss, in the order of obsIds
+        std::vector<double> residuals;
+        std::vector<double*> parameters;
+        for (size_t b = 0; b < blockIds.size(); ++b) {
+            const ceres::CostFunction* cost = problem.GetCostFunctionForResidualBlock(blockIds[b]);
+            const PerObservationLoss* robustCost = dynamic_cast<const PerObservationLoss*>(cost);
+            if (robustCost != NULL)
+                cost = robustCost->costFunction();
+            problem.GetParameterBlocksForResidualBlock(blockIds[b], &parameters);
+            size_t offset = residuals.size();
+            residuals.resize(offset + cost->num_residuals());
+            cost->Evaluate(parameters.data(), &residuals[offset], NULL);
+        }
+        
+        // Each observation has the same number of residuals, of which the first two are the reprojection error
+        size_t stride = residuals.size() / obsIds.size();
+        std::vector<double> errorSq(obsIds.size());
+        double sumErrorSq = 0.0;
+        for (size_t i = 0; i < obsIds.size(); ++i) {
+            errorSq[i] = residuals[i*stride]*residuals[i*stride] + residuals[i*stride + 1]*residuals[i*stride + 1];
+            sumErrorSq += errorSq[i];
+        }
+        double threshold = m_settings.outlierThreshold * std::sqrt(sumErrorSq / obsIds.size());
+        
+        unsigned int numRejected = 0;
+        for (size_t i = 0; i < obsIds.size(); ++i) {
+            if (errorSq[i] > threshold*threshold) {
+                m_rejected[obsIds[i]] = 1;
+                ++numRejected;
+            }
+        }
+        return numRejected;
+    }
+    
+    void optimize(void) {
+        if (m_verbose) {
+            if (m_optimizeRadial && m_optimizeIntrinsic && m_optimizeExtrinsic) {
+                std::cout << "Optimizing object pose, camera intrinsics, distortion and camera extrinsics.\n";
+            } 
+            else if (!m_optimizeRadial && m_optimizeIntrinsic && m_optimizeExtrinsic) {
+                std::cout << "Optimizing object pose, camera intrinsics and extrinsics.\n";
+            }
+            else if (!m_optimizeIntrinsic && m_optimizeExtrinsic) {
+                std::cout << "Optimizing object pose and camera extrinsics\n";
+            }
+            else if (!m_optimizeRadial && !m_optimizeIntrinsic && !m_optimizeExtrinsic) {
+                std::cout << "Optimizing only object pose.\n";
+            }
+        }
         
         // Make Ceres automatically detect the bundle structure. Note that the
         // standard solver, SPARSE_NORMAL_CHOLESKY, also works fine but it is slower
         // for standard bundle adjustment problems.
         ceres::Solver::Options options;
-        options.linear_solver_type = ceres::DENSE_SCHUR;  // DENSE_SCHUR ideal for up to a hundred variables
-        options.minimizer_progress_to_stdout = true;
-        options.max_num_iterations = 50;
-        options.function_tolerance = 1e-4;  // minium percentage of cost change
+        m_settings.apply(options);
+        options.minimizer_progress_to_stdout = m_verbose;
 //         options.initial_trust_region_radius = 1e2;  
         
-        ceres::Solver::Summary summary;
-        ceres::Solve(options, &problem, &summary);
-//         std::cout << summary.FullReport() << "\n";
+        // One loss function is shared by all residuals
+        std::unique_ptr<ceres::LossFunction> lossFunction(m_settings.createLossFunction());
+        
+        // Each round is warm started from the parameters of the previous one
+        for (int round = 0; ; ++round) {
+            // Set up optimization problem
+            ceres::Problem problem;
+            std::vector<ceres::ResidualBlockId> blockIds;
+            std::vector<unsigned int> obsIds;
+            this->buildProblem(problem, lossFunction.get(), blockIds, obsIds);
+            
+            if (m_verbose) {
+                std::cout << "Problem defined. Starting optimization...\n";
+                std::cout.flush();
+            }
+            
+            ceres::Solver::Summary summary;
+            ceres::Solve(options, &problem, &summary);
+//             std::cout << summary.FullReport() << "\n";
+            
+            if (round >= m_settings.outlierRounds)
+                break;
+            
+            unsigned int numRejected = this->rejectOutliers(problem, blockIds, obsIds);
+            if (m_verbose) {
+                std::cout << "Outlier rejection round " << round + 1 << ": Rejected " << numRejected << " observations.\n";
+                std::cout.flush();
+            }
+            if (numRejected == 0)
+                break;
+        }
     }
     
     
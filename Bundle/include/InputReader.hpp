@@ -5,8 +5,13 @@
 #include <string>
 #include <fstream>
 #include <iostream>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 
 #include "json.hpp"
+#include "BinaryFormat.h"
 
 using namespace nlohmann;
 
@@ -24,11 +29,86 @@ public:
     std::vector< std::vector<double> > cameraList;
     std::vector< std::vector<double> > objectPoses;
     
+    // Output data of binary files, pointing into the memory mapped file
+    bool isBinary;
+    BinaryHeader header;
+    double* cameras;
+    double* modelPoints3dData;
+    double* objectPosesData;
+    double* points2dData;
+    unsigned int* points2dPtsIdData;
+    unsigned int* points2dCamIdData;
+    unsigned int* points2dFrameIdData;
+    
     InputReader(std::string inputFile):
-        m_inputFile(inputFile) {
+        m_inputFile(inputFile),
+        isBinary(false),
+        m_mappedData(NULL),
+        m_mappedSize(0) {
+    }
+    
+    ~InputReader() {
+        if (m_mappedData != NULL)
+            munmap(m_mappedData, m_mappedSize);
     }
     
     void parse(void) {
+        // Binary files are recognized by their magic bytes
+        std::ifstream in_file(m_inputFile, std::ios::binary);
+        char magic[4] = {0, 0, 0, 0};
+        in_file.read(magic, 4);
+        in_file.close();
+        if (memcmp(magic, BINARY_FORMAT_MAGIC, 4) == 0) {
+            this->_parse_binary();
+        } else {
+            this->_parse_json();
+        }
+    }
+    
+    // Maps the file into memory. Mapping is private, so the optimizer may write into the object poses
+    // without changing the file.
+    void _parse_binary(void) {
+        std::cout << "Reading binary input file: " << m_inputFile << "\n";
+        int fd = open(m_inputFile.c_str(), O_RDONLY);
+        struct stat st;
+        if ((fd < 0) || (fstat(fd, &st) != 0) || (st.st_size < (off_t)sizeof(BinaryHeader))) {
+            std::cout << "Could not read binary input file\n";
+            std::cout.flush();
+            exit(1);
+        }
+        
+        m_mappedSize = st.st_size;
+        void* data = mmap(NULL, m_mappedSize, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+        close(fd);
+        if (data == MAP_FAILED) {
+            std::cout << "Memory mapping the binary input file failed\n";
+            std::cout.flush();
+            exit(1);
+        }
+        m_mappedData = static_cast<char*>(data);
+        
+        memcpy(&header, m_mappedData, sizeof(BinaryHeader));
+        if (!header.isValid() || (header.fileSize() != m_mappedSize)) {
+            std::cout << "Binary input file is corrupted or of an unknown version\n";
+            std::cout.flush();
+            exit(1);
+        }
+        
+        // The header is 24 bytes long, therefore all float64 sections are 8 byte aligned
+        double* floats = reinterpret_cast<double*>(m_mappedData + sizeof(BinaryHeader));
+        cameras = floats;
+        modelPoints3dData = cameras + 17*(size_t)header.numCams;
+        objectPosesData = modelPoints3dData + 3*(size_t)header.numModelPoints;
+        points2dData = objectPosesData + 6*(size_t)header.numFrames;
+        
+        unsigned int* ids = reinterpret_cast<unsigned int*>(points2dData + 2*(size_t)header.numPoints2d);
+        points2dPtsIdData = ids;
+        points2dCamIdData = ids + header.numPoints2d;
+        points2dFrameIdData = ids + 2*(size_t)header.numPoints2d;
+        isBinary = true;
+    }
+    
+    void _parse_json(void) {
         // Stream file into json
         json fileDict;
         std::cout << "Reading input file: " << m_inputFile << "\n";
@@ -184,6 +264,9 @@ public:
     }
     
     
+private:
+    char* m_mappedData;
+    size_t m_mappedSize;
 };
 
 #endif
\ No newline at end of file
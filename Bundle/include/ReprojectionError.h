@@ -5,6 +5,7 @@
 #include "ceres/rotation.h"
 
 #include "Camera.hpp"
+#include "AnalyticProjection.h"
 
 // Templated pinhole camera model for Ceres.  
 // The camera is parameterized using 9 parameters: 3 for rotation, 3 for translation,
@@ -94,6 +95,32 @@ struct ReprojectionError {
       return (new ceres::AutoDiffCostFunction<ReprojectionError, 4, 3, 3, 3, 3, 2, 2>(
           new ReprojectionError(observed_x, observed_y, width, height, cameraDist, modelPoint)));
   }
+  // Same residuals as operator(), but with hand derived jacobians instead of automatic differentiation.
+  // Parameters and jacobians follow the layout of ceres::CostFunction::Evaluate.
+  bool EvaluateAnalytic(double const* const* parameters, double* residuals, double** jacobians) const {
+    const double* cameraPrincipal = parameters[5];
+    AnalyticProjection proj(modelPoint, parameters[0], parameters[1], parameters[2], parameters[3],
+                            parameters[4], cameraPrincipal, cameraDist, jacobians != NULL);
+    residuals[0] = proj.point[0] - observed_x;
+    residuals[1] = proj.point[1] - observed_y;
+    residuals[2] = 0.001 * (static_cast<double>(*width)/ 2.0 - cameraPrincipal[0]);
+    residuals[3] = 0.001 * (static_cast<double>(*height)/ 2.0 - cameraPrincipal[1]);
+    
+    if (jacobians != NULL) {
+        setProjectionJacobian(jacobians[0], 4, 3, proj.objectTranslation);
+        setProjectionJacobian(jacobians[1], 4, 3, proj.objectRotation);
+        setProjectionJacobian(jacobians[2], 4, 3, proj.cameraTranslation);
+        setProjectionJacobian(jacobians[3], 4, 3, proj.cameraRotation);
+        setProjectionJacobian(jacobians[4], 4, 2, proj.cameraFocal);
+        setProjectionJacobian(jacobians[5], 4, 2, proj.cameraPrincipal);
+        if (jacobians[5] != NULL) {
+            jacobians[5][2*2 + 0] = -0.001;
+            jacobians[5][3*2 + 1] = -0.001;
+        }
+    }
+    return true;
+  }
+  
   double observed_x;
   double observed_y;
   int* height;
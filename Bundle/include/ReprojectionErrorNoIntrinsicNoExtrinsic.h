@@ -5,6 +5,7 @@
 #include "ceres/rotation.h"
 
 #include "Camera.hpp"
+#include "AnalyticProjection.h"
 
 // Templated pinhole camera model for Ceres.  
 struct ReprojectionErrorNoIntrinsicNoExtrinsic {
@@ -95,6 +96,21 @@ struct ReprojectionErrorNoIntrinsicNoExtrinsic {
           new ReprojectionErrorNoIntrinsicNoExtrinsic(observed_x, observed_y,
               cameraTranslation, cameraRotation, cameraFocal, cameraPrincipal, cameraDist, modelPoint)));
   }
+  // Same residuals as operator(), but with hand derived jacobians instead of automatic differentiation.
+  // Parameters and jacobians follow the layout of ceres::CostFunction::Evaluate.
+  bool EvaluateAnalytic(double const* const* parameters, double* residuals, double** jacobians) const {
+    AnalyticProjection proj(modelPoint, parameters[0], parameters[1], cameraTranslation, cameraRotation,
+                            cameraFocal, cameraPrincipal, cameraDist, jacobians != NULL);
+    residuals[0] = proj.point[0] - observed_x;
+    residuals[1] = proj.point[1] - observed_y;
+    
+    if (jacobians != NULL) {
+        setProjectionJacobian(jacobians[0], 2, 3, proj.objectTranslation);
+        setProjectionJacobian(jacobians[1], 2, 3, proj.objectRotation);
+    }
+    return true;
+  }
+  
   double observed_x;
   double observed_y;
   double* cameraTranslation; // array of length 2
@@ -5,6 +5,7 @@
 #include "ceres/rotation.h"
 
 #include "Camera.hpp"
+#include "AnalyticProjection.h"
 
 // Templated pinhole camera model
 struct ReprojectionErrorWithRadialFull {
@@ -104,6 +105,45 @@ struct ReprojectionErrorWithRadialFull {
       return (new ceres::AutoDiffCostFunction<ReprojectionErrorWithRadialFull, 9, 3, 3, 3, 3, 2, 2, 5>( // Template argument is #output, #noparam1, #noparam2, ...
           new ReprojectionErrorWithRadialFull(observed_x, observed_y, width, height, modelPoint)));
   }
+  // Same residuals as operator(), but with hand derived jacobians instead of automatic differentiation.
+  // Parameters and jacobians follow the layout of ceres::CostFunction::Evaluate.
+  bool EvaluateAnalytic(double const* const* parameters, double* residuals, double** jacobians) const {
+    const double* cameraPrincipal = parameters[5];
+    const double* cameraDist = parameters[6];
+    AnalyticProjection proj(modelPoint, parameters[0], parameters[1], parameters[2], parameters[3],
+                            parameters[4], cameraPrincipal, cameraDist, jacobians != NULL);
+    residuals[0] = proj.point[0] - observed_x;
+    residuals[1] = proj.point[1] - observed_y;
+    
+    // Distortion should be small
+    const double distWeights[5] = {0.1, 0.5, 0.1, 0.1, 1.0};
+    for (int i = 0; i < 5; ++i)
+        residuals[2 + i] = distWeights[i] * cameraDist[i];
+    
+    // Principal point should be roughly in the middle
+    residuals[7] = 0.001 * (static_cast<double>(*width)/ 2.0 - cameraPrincipal[0]);
+    residuals[8] = 0.001 * (static_cast<double>(*height)/ 2.0 - cameraPrincipal[1]);
+    
+    if (jacobians != NULL) {
+        setProjectionJacobian(jacobians[0], 9, 3, proj.objectTranslation);
+        setProjectionJacobian(jacobians[1], 9, 3, proj.objectRotation);
+        setProjectionJacobian(jacobians[2], 9, 3, proj.cameraTranslation);
+        setProjectionJacobian(jacobians[3], 9, 3, proj.cameraRotation);
+        setProjectionJacobian(jacobians[4], 9, 2, proj.cameraFocal);
+        setProjectionJacobian(jacobians[5], 9, 2, proj.cameraPrincipal);
+        setProjectionJacobian(jacobians[6], 9, 5, proj.cameraDist);
+        if (jacobians[5] != NULL) {
+            jacobians[5][7*2 + 0] = -0.001;
+            jacobians[5][8*2 + 1] = -0.001;
+        }
+        if (jacobians[6] != NULL) {
+            for (int i = 0; i < 5; ++i)
+                jacobians[6][(2 + i)*5 + i] = distWeights[i];
+        }
+    }
+    return true;
+  }
+  
   double observed_x;
   double observed_y;
   int* height;
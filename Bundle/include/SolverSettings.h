@@ -0,0 +1,77 @@
+#ifndef H_SOLVERSETTINGS
+#define H_SOLVERSETTINGS
+
+#include <string>
+#include <stdexcept>
+#include <algorithm>
+#include <cctype>
+
+#include "ceres/ceres.h"
+
+// Options passed on to the ceres solver
+struct SolverSettings {
+    std::string linearSolver;  // DENSE_SCHUR, SPARSE_SCHUR, ITERATIVE_SCHUR, SPARSE_NORMAL_CHOLESKY, ...
+    std::string preconditioner;  // used by iterative solvers: JACOBI, SCHUR_JACOBI, CLUSTER_JACOBI, ...
+    int numThreads;  // threads for residual and jacobian evaluation
+    int maxIterations;
+    double functionTolerance;  // minium percentage of cost change
+    double gradientTolerance;
+    double parameterTolerance;
+    std::string loss;  // robust loss: NONE, HUBER or CAUCHY
+    double lossScale;  // scale of the robust loss in pixels
+    int outlierRounds;  // how often observations are rejected and the problem is solved again
+    double outlierThreshold;  // observations above outlierThreshold times the RMS error are rejected
+    bool analyticJacobians;  // use the hand derived jacobians instead of automatic differentiation
+    
+    SolverSettings():
+        linearSolver("DENSE_SCHUR"),  // DENSE_SCHUR ideal for up to a hundred variables
+        preconditioner("JACOBI"),
+        numThreads(1),
+        maxIterations(50),
+        functionTolerance(1e-4),
+        gradientTolerance(1e-10),
+        parameterTolerance(1e-8),
+        loss("NONE"),
+        lossScale(1.0),
+        outlierRounds(0),
+        outlierThreshold(3.0),
+        analyticJacobians(false) { }
+    
+    // Returns a new loss function or NULL for the squared loss, throws std::invalid_argument for unknown losses
+    ceres::LossFunction* createLossFunction(void) const {
+        std::string name(loss);
+        std::transform(name.begin(), name.end(), name.begin(), ::toupper);
+        if (name == "NONE")
+            return NULL;
+        if (name == "HUBER")
+            return new ceres::HuberLoss(lossScale);
+        if (name == "CAUCHY")
+            return new ceres::CauchyLoss(lossScale);
+        throw std::invalid_argument("Unknown loss function: " + loss);
+    }
+    
+    // Fills the solver options, throws std::invalid_argument for unknown solver/preconditioner names
+    void apply(ceres::Solver::Options& options) const {
+        if (!ceres::StringToLinearSolverType(linearSolver, &options.linear_solver_type))
+            throw std::invalid_argument("Unknown linear solver type: " + linearSolver);
+        if (!ceres::StringToPreconditionerType(preconditioner, &options.preconditioner_type))
+            throw std::invalid_argument("Unknown preconditioner type: " + preconditioner);
+        options.num_threads = numThreads;
+        options.max_num_iterations = maxIterations;
+        options.function_tolerance = functionTolerance;
+        options.gradient_tolerance = gradientTolerance;
+        options.parameter_tolerance = parameterTolerance;
+        
+        std::string error;
+        if (!options.IsValid(&error))
+            throw std::invalid_argument("Invalid solver settings: " + error);
+        
+        delete this->createLossFunction();
+        if (lossScale <= 0.0)
+            throw std::invalid_argument("Loss scale needs to be positive.");
+        if ((outlierRounds < 0) || (outlierThreshold <= 0.0))
+            throw std::invalid_argument("Invalid outlier rejection settings.");
+    }
+};
+
+#endif
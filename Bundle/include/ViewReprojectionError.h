@@ -0,0 +1,178 @@
+#ifndef H_VIEWREPROJECTIONERROR
+#define H_VIEWREPROJECTIONERROR
+
+#include <vector>
+#include <memory>
+#include <cmath>
+#include <type_traits>
+
+#include "ceres/ceres.h"
+
+// Sum of the parameter block sizes
+template <int... Sizes> struct SumOfSizes;
+template <> struct SumOfSizes<> { static const int value = 0; };
+template <int Size, int... Sizes> struct SumOfSizes<Size, Sizes...> {
+    static const int value = Size + SumOfSizes<Sizes...>::value;
+};
+
+// Analytic counterpart of ViewReprojectionError: Evaluates PointFunctor::EvaluateAnalytic for each observation.
+// The jacobian of observation i w.r.t. a block are rows [i*NumResiduals, (i+1)*NumResiduals) of that blocks jacobian.
+template <class PointFunctor, int NumResiduals, int... BlockSizes>
+class ViewAnalyticCostFunction : public ceres::CostFunction {
+public:
+    explicit ViewAnalyticCostFunction(const std::vector<PointFunctor>& points)
+        : points(points) {
+        const int blockSizes[] = {BlockSizes...};
+        for (unsigned int i = 0; i < sizeof...(BlockSizes); ++i)
+            mutable_parameter_block_sizes()->push_back(blockSizes[i]);
+        set_num_residuals(NumResiduals*points.size());
+    }
+    
+    virtual bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const {
+        const int blockSizes[] = {BlockSizes...};
+        double* pointJacobians[sizeof...(BlockSizes)];
+        for (size_t i = 0; i < points.size(); ++i) {
+            if (jacobians != NULL) {
+                for (unsigned int j = 0; j < sizeof...(BlockSizes); ++j)
+                    pointJacobians[j] = (jacobians[j] != NULL) ? &jacobians[j][i*NumResiduals*blockSizes[j]] : NULL;
+            }
+            if (!points[i].EvaluateAnalytic(parameters, &residuals[i*NumResiduals],
+                                            (jacobians != NULL) ? pointJacobians : NULL))
+                return false;
+        }
+        return true;
+    }
+    
+private:
+    std::vector<PointFunctor> points;
+};
+
+// Residuals of all observations of one view (frame, camera) in a single residual block.
+// All observations of a view depend on the same parameter blocks, so one cost function evaluating 
+// the per observation functor PointFunctor for each of them replaces one cost function per observation.
+// The stride equals the total number of parameters, so all derivatives are computed in a single pass.
+template <class PointFunctor, int NumResiduals, int... BlockSizes>
+struct ViewReprojectionError {
+    typedef ceres::DynamicAutoDiffCostFunction<ViewReprojectionError, SumOfSizes<BlockSizes...>::value> CostFunctionType;
+    
+    explicit ViewReprojectionError(const std::vector<PointFunctor>& points)
+        : points(points) {}
+    
+    // Templated cost functor, residuals of observation i are at residuals[i*NumResiduals]
+    template <typename T>
+    bool operator()(T const* const* parameters, T* residuals) const {
+        for (size_t i = 0; i < points.size(); ++i) {
+            if (!evaluate(points[i], parameters, &residuals[i*NumResiduals], 
+                          std::integral_constant<int, sizeof...(BlockSizes)>()))
+                return false;
+        }
+        return true;
+    }
+    
+    // Factory to hide the construction of the CostFunction object from
+    // the client code.
+    static ceres::CostFunction* Create(const std::vector<PointFunctor>& points) {
+        CostFunctionType* costFunction = new CostFunctionType(new ViewReprojectionError(points));
+        const int blockSizes[] = {BlockSizes...};
+        for (unsigned int i = 0; i < sizeof...(BlockSizes); ++i)
+            costFunction->AddParameterBlock(blockSizes[i]);
+        costFunction->SetNumResiduals(NumResiduals*points.size());
+        return costFunction;
+    }
+    
+    // Same cost function using the hand derived jacobians of the per observation functor
+    static ceres::CostFunction* CreateAnalytic(const std::vector<PointFunctor>& points) {
+        return new ViewAnalyticCostFunction<PointFunctor, NumResiduals, BlockSizes...>(points);
+    }
+    
+    // Pass the parameter blocks on to the per observation functor
+    template <typename T>
+    static bool evaluate(const PointFunctor& f, T const* const* p, T* r, std::integral_constant<int, 2>) {
+        return f(p[0], p[1], r);
+    }
+    template <typename T>
+    static bool evaluate(const PointFunctor& f, T const* const* p, T* r, std::integral_constant<int, 4>) {
+        return f(p[0], p[1], p[2], p[3], r);
+    }
+    template <typename T>
+    static bool evaluate(const PointFunctor& f, T const* const* p, T* r, std::integral_constant<int, 6>) {
+        return f(p[0], p[1], p[2], p[3], p[4], p[5], r);
+    }
+    template <typename T>
+    static bool evaluate(const PointFunctor& f, T const* const* p, T* r, std::integral_constant<int, 7>) {
+        return f(p[0], p[1], p[2], p[3], p[4], p[5], p[6], r);
+    }
+    
+    std::vector<PointFunctor> points;
+};
+
+// Applies a robust loss to each observation of a view block separately. Ceres applies a loss function to the complete
+// residual block, which would down weight all observations of a view together. Instead the residuals r of each 
+// observation are replaced by sqrt(rho(|r|^2)) * r / |r|, so the squared norm of the block is the sum of the losses of
+// its observations, which is the same objective as one residual block with the loss per observation.
+class PerObservationLoss : public ceres::CostFunction {
+public:
+    // Takes ownership of costFunction, but not of lossFunction
+    PerObservationLoss(ceres::CostFunction* costFunction, const ceres::LossFunction* lossFunction,
+                       int numResidualsPerObservation)
+        : m_costFunction(costFunction), m_lossFunction(lossFunction), m_numResiduals(numResidualsPerObservation) {
+        *mutable_parameter_block_sizes() = costFunction->parameter_block_sizes();
+        set_num_residuals(costFunction->num_residuals());
+    }
+    
+    virtual bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const {
+        if (!m_costFunction->Evaluate(parameters, residuals, jacobians))
+            return false;
+        
+        const std::vector<int>& blockSizes = parameter_block_sizes();
+        for (int first = 0; first < num_residuals(); first += m_numResiduals) {
+            double* r = &residuals[first];
+            double sqNorm = 0.0;
+            for (int k = 0; k < m_numResiduals; ++k)
+                sqNorm += r[k]*r[k];
+            double rho[3];
+            m_lossFunction->Evaluate(sqNorm, rho);
+            
+            // scale g(s) = sqrt(rho(s)/s) and its derivative, for s = 0 their limits
+            double g, dg;
+            if (sqNorm > 0.0) {
+                g = std::sqrt(rho[0] / sqNorm);
+                dg = (rho[1]*sqNorm - rho[0]) / (2.0*sqNorm*sqNorm*g);
+            } else {
+                g = std::sqrt(rho[1]);
+                dg = rho[2] / (4.0*g);
+            }
+            
+            // jacobian of g(|r|^2) * r is g * J + 2 g'(|r|^2) * r * (r^T J), needs the unscaled residuals
+            if (jacobians != NULL) {
+                for (size_t j = 0; j < blockSizes.size(); ++j) {
+                    if (jacobians[j] == NULL)
+                        continue;
+                    double* J = &jacobians[j][first*blockSizes[j]];
+                    for (int c = 0; c < blockSizes[j]; ++c) {
+                        double rJ = 0.0;
+                        for (int k = 0; k < m_numResiduals; ++k)
+                            rJ += r[k]*J[k*blockSizes[j] + c];
+                        for (int k = 0; k < m_numResiduals; ++k)
+                            J[k*blockSizes[j] + c] = g*J[k*blockSizes[j] + c] + 2.0*dg*r[k]*rJ;
+                    }
+                }
+            }
+            for (int k = 0; k < m_numResiduals; ++k)
+                r[k] *= g;
+        }
+        return true;
+    }
+    
+    // The wrapped cost function, evaluates the residuals without the loss
+    const ceres::CostFunction* costFunction(void) const {
+        return m_costFunction.get();
+    }
+    
+private:
+    std::unique_ptr<ceres::CostFunction> m_costFunction;
+    const ceres::LossFunction* m_lossFunction;
+    int m_numResiduals;  // number of residuals of each observation
+};
+
+#endif
@@ -6,6 +6,8 @@
 #include <stdlib.h>
 #include <unistd.h>
 
+#include "SolverSettings.h"
+
 inline bool fileExistCheck(const std::string& name) {
     std::ifstream f(name.c_str());
     return f.good();
@@ -14,18 +16,32 @@ inline bool fileExistCheck(const std::string& name) {
 void printProgramOptions(void) {
     std::cout << "FreiCalib Bundle adjuster, for optimizing an initial camera calibration.\n";
     std::cout << "Program options:\n";
-    std::cout << "\t-i <string> : Input JSON describing the problem.\n";
-    std::cout << "\t-o <string> : Ouput JSON after optimization.\n";
+    std::cout << "\t-i <string> : Input JSON or binary file describing the problem.\n";
+    std::cout << "\t-o <string> : Ouput file after optimization (same format as the input).\n";
     
     std::cout << "\t-k : Optimize camera intrinsics (focals, principal point, [radials]).\n";
     std::cout << "\t-r : Optimize radial distortion.\n";
     std::cout << "\t-m : Optimize camera extrinsics (translation, rotation).\n";
     std::cout << "\t-s : Use a shared intrinsic camera model.\n";
+    
+    std::cout << "\t-l <string> : Linear solver (DENSE_SCHUR, SPARSE_SCHUR, ITERATIVE_SCHUR, ...), default DENSE_SCHUR.\n";
+    std::cout << "\t-p <string> : Preconditioner of iterative solvers (JACOBI, SCHUR_JACOBI, ...), default JACOBI.\n";
+    std::cout << "\t-t <int> : Number of threads used for evaluating residuals and jacobians, default 1.\n";
+    std::cout << "\t-n <int> : Maximal number of iterations, default 50.\n";
+    std::cout << "\t-f <float> : Function tolerance, default 1e-4.\n";
+    std::cout << "\t-g <float> : Gradient tolerance, default 1e-10.\n";
+    std::cout << "\t-x <float> : Parameter tolerance, default 1e-8.\n";
+    std::cout << "\t-L <string> : Robust loss (NONE, HUBER, CAUCHY), default NONE.\n";
+    std::cout << "\t-S <float> : Scale of the robust loss in pixels, default 1.0.\n";
+    std::cout << "\t-R <int> : Number of outlier rejection rounds, default 0.\n";
+    std::cout << "\t-N <float> : Reject observations with errors above N times the RMS error, default 3.0.\n";
+    std::cout << "\t-a : Use hand derived jacobians instead of automatic differentiation.\n";
 }
 
 int parseInputs(int argc, char **argv,
                 std::string& inputFile, std::string& outputFile, 
-                bool& optimizeIntrinsics, bool& optimizeDistortion, bool& optimizeExtrinsics, bool& shareCameraModel) {
+                bool& optimizeIntrinsics, bool& optimizeDistortion, bool& optimizeExtrinsics, bool& shareCameraModel,
+                SolverSettings& settings) {
     // Default values
     optimizeIntrinsics = false;
     optimizeDistortion = false;
@@ -34,7 +50,7 @@ int parseInputs(int argc, char **argv,
     
     int option;
     using namespace std;
-    while ((option = getopt (argc, argv, "i:o:krms")) != -1) {
+    while ((option = getopt (argc, argv, "i:o:krmsal:p:t:n:f:g:x:L:S:R:N:")) != -1) {
         switch (option)
             {       
             // INPUT DATA
@@ -59,6 +75,44 @@ int parseInputs(int argc, char **argv,
                 shareCameraModel = true;
                 break;
                 
+            // SOLVER SETTINGS
+            case 'l':
+                settings.linearSolver = std::string(optarg);
+                break;
+            case 'p':
+                settings.preconditioner = std::string(optarg);
+                break;
+            case 't':
+                settings.numThreads = atoi(optarg);
+                break;
+            case 'n':
+                settings.maxIterations = atoi(optarg);
+                break;
+            case 'f':
+                settings.functionTolerance = atof(optarg);
+                break;
+            case 'g':
+                settings.gradientTolerance = atof(optarg);
+                break;
+            case 'x':
+                settings.parameterTolerance = atof(optarg);
+                break;
+            case 'L':
+                settings.loss = std::string(optarg);
+                break;
+            case 'S':
+                settings.lossScale = atof(optarg);
+                break;
+            case 'R':
+                settings.outlierRounds = atoi(optarg);
+                break;
+            case 'N':
+                settings.outlierThreshold = atof(optarg);
+                break;
+            case 'a':
+                settings.analyticJacobians = true;
+                break;
+                
             case '?':
                 if (optopt == 'c')
                     fprintf (stderr, "Option -%c requires an argument.\n", optopt);
@@ -11,23 +11,49 @@ int main(int argc, char **argv) {
     bool optimizeRadial = false;
     bool optimizeExtrinsic = false;
     bool useSharedCameraModel = false;
+    SolverSettings settings;
     
     // Get command line arguments
     parseInputs(argc, argv,
                 inFile, outFile, 
-                optimizeIntrinsic, optimizeRadial, optimizeExtrinsic, useSharedCameraModel);
-
+                optimizeIntrinsic, optimizeRadial, optimizeExtrinsic, useSharedCameraModel,
+                settings);
+    
+    // Check solver settings before reading the problem
+    try {
+        ceres::Solver::Options options;
+        settings.apply(options);
+    } catch (const std::invalid_argument& e) {
+        std::cout << e.what() << "\n";
+        printProgramOptions();
+        return 1;
+    }
     
     // Read passed problem
     InputReader reader(inFile);
     reader.parse();
      
+    // Binary problems are optimized directly on the memory mapped file and results are written in binary too
+    if (reader.isBinary) {
+        BundleAdjuster adj(optimizeIntrinsic, optimizeRadial, optimizeExtrinsic, useSharedCameraModel,
+                           reader.modelPoints3dData, reader.header.numModelPoints,
+                           reader.points2dData, reader.points2dCamIdData, reader.points2dPtsIdData, reader.points2dFrameIdData,
+                           reader.header.numPoints2d,
+                           reader.cameras, reader.header.numCams,
+                           reader.objectPosesData, reader.header.numFrames);
+        adj.setSolverSettings(settings);
+        adj.optimize();
+        adj.writeBinary(outFile);
+        return 0;
+    }
+    
     // Setup problem
     BundleAdjuster adj(optimizeIntrinsic, optimizeRadial, optimizeExtrinsic, useSharedCameraModel,
                        reader.modelPoints3d,
                        reader.points2d, reader.points2dCamId, reader.points2dPtsId, reader.points2dFrameId, 
                        reader.cameraList,
                        reader.objectPoses);
+    adj.setSolverSettings(settings);
     adj.optimize();
     adj.writeJson(outFile);
     
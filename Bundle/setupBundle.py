@@ -0,0 +1,16 @@
+import os
+from distutils.core import setup, Extension
+from Cython.Build import cythonize
+
+# in process version of the ceres bundle adjuster (same as ./build/ceres_librarypnp, but without file IO)
+ext = Extension('BundleAdjusterPnP',
+                sources=[os.path.abspath('BundleAdjusterPnP.pyx')],
+                libraries=['ceres', 'glog', 'pthread'],
+                include_dirs=[os.path.abspath('./include/'), '/usr/include/eigen3', '/usr/local/include/eigen3'],
+                extra_compile_args=['-std=c++11']
+                )
+
+setup(
+    name = "BundleAdjusterPnP",
+    ext_modules = cythonize(ext),
+)
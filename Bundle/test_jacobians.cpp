@@ -0,0 +1,143 @@
+// Compares the hand derived jacobians of the reprojection errors against ceres automatic differentiation
+// on random problems. Returns a non zero exit code when they disagree.
+#include <iostream>
+#include <vector>
+#include <random>
+#include <memory>
+#include <cmath>
+#include <algorithm>
+
+#include "BundleAdjuster.hpp"
+
+// Random views: parameter blocks objT, objR, camT, camR, focal, principal, dist and a set of observations
+struct RandomView {
+    double objT[3], objR[3], camT[3], camR[3], focal[2], principal[2], dist[5];
+    int imgSize[2];
+    std::vector<double> modelPoints, points2d;
+
+    RandomView(std::mt19937& rng, int numPoints, bool zeroRotation) {
+        std::uniform_real_distribution<double> unit(-1.0, 1.0);
+        for (int i = 0; i < 3; ++i) {
+            objT[i] = 0.2*unit(rng);
+            objR[i] = zeroRotation ? 0.0 : 1.8*unit(rng);
+            camR[i] = zeroRotation ? 0.0 : 1.8*unit(rng);
+        }
+        // points stay close to the origin, so they are always in front of the camera
+        camT[0] = 0.3*unit(rng);
+        camT[1] = 0.3*unit(rng);
+        camT[2] = 2.5 + unit(rng);
+
+        imgSize[0] = 1280;
+        imgSize[1] = 1024;
+        focal[0] = 1000.0 + 300.0*unit(rng);
+        focal[1] = focal[0]*(1.0 + 0.01*unit(rng));
+        principal[0] = imgSize[0]/2.0 + 50.0*unit(rng);
+        principal[1] = imgSize[1]/2.0 + 50.0*unit(rng);
+        dist[0] = 0.2*unit(rng);
+        dist[1] = 0.1*unit(rng);
+        dist[2] = 0.01*unit(rng);
+        dist[3] = 0.01*unit(rng);
+        dist[4] = 0.05*unit(rng);
+
+        for (int i = 0; i < numPoints; ++i) {
+            modelPoints.push_back(0.2*unit(rng));
+            modelPoints.push_back(0.2*unit(rng));
+            modelPoints.push_back(0.05*unit(rng));
+            points2d.push_back(principal[0] + 400.0*unit(rng));
+            points2d.push_back(principal[1] + 400.0*unit(rng));
+        }
+    }
+};
+
+// Evaluates both cost functions with all jacobians and returns the largest relative deviation
+double compareCostFunctions(const ceres::CostFunction& autodiff, const ceres::CostFunction& analytic,
+                            const std::vector<double*>& parameters) {
+    const std::vector<int>& blockSizes = autodiff.parameter_block_sizes();
+    const int numResiduals = autodiff.num_residuals();
+    if ((blockSizes != analytic.parameter_block_sizes()) || (numResiduals != analytic.num_residuals()))
+        return INFINITY;
+
+    std::vector<double> residuals[2];
+    std::vector<std::vector<double> > jacobians[2];
+    const ceres::CostFunction* costFunctions[2] = {&autodiff, &analytic};
+    for (int k = 0; k < 2; ++k) {
+        residuals[k].resize(numResiduals);
+        std::vector<double*> jacobianPtrs;
+        for (size_t j = 0; j < blockSizes.size(); ++j)
+            jacobians[k].push_back(std::vector<double>(numResiduals*blockSizes[j], NAN));
+        for (size_t j = 0; j < blockSizes.size(); ++j)
+            jacobianPtrs.push_back(&jacobians[k][j][0]);
+        if (!costFunctions[k]->Evaluate(&parameters[0], &residuals[k][0], &jacobianPtrs[0]))
+            return INFINITY;
+    }
+
+    double maxError = 0.0;
+    for (int i = 0; i < numResiduals; ++i)
+        maxError = std::max(maxError, std::abs(residuals[0][i] - residuals[1][i]) / (1.0 + std::abs(residuals[0][i])));
+    for (size_t j = 0; j < blockSizes.size(); ++j) {
+        for (size_t i = 0; i < jacobians[0][j].size(); ++i) {
+            double error = std::abs(jacobians[0][j][i] - jacobians[1][j][i]) / (1.0 + std::abs(jacobians[0][j][i]));
+            if (std::isnan(error))  // entry was not written
+                return INFINITY;
+            maxError = std::max(maxError, error);
+        }
+    }
+    return maxError;
+}
+
+template <class ViewCost, class PointFunctor>
+bool testView(const char* name, const std::vector<PointFunctor>& points, const std::vector<double*>& parameters,
+              double tolerance) {
+    std::unique_ptr<ceres::CostFunction> autodiff(ViewCost::Create(points));
+    std::unique_ptr<ceres::CostFunction> analytic(ViewCost::CreateAnalytic(points));
+    double error = compareCostFunctions(*autodiff, *analytic, parameters);
+    if (error > tolerance) {
+        std::cout << "FAILED: " << name << " deviates from autodiff by " << error << "\n";
+        return false;
+    }
+    return true;
+}
+
+int main() {
+    const int numTrials = 200;
+    const double tolerance = 1e-8;
+    std::mt19937 rng(42);
+    bool success = true;
+
+    for (int trial = 0; trial < numTrials; ++trial) {
+        RandomView v(rng, 1 + trial % 7, trial < 2);
+        std::vector<ReprojectionErrorWithRadialFull> radialFull;
+        std::vector<ReprojectionError> intrinsic;
+        std::vector<ReprojectionErrorNoIntrinsic> noIntrinsic;
+        std::vector<ReprojectionErrorNoIntrinsicNoExtrinsic> noIntrinsicNoExtrinsic;
+        for (size_t i = 0; i < v.points2d.size() / 2; ++i) {
+            double* modelPoint = &v.modelPoints[i*3];
+            double x = v.points2d[i*2], y = v.points2d[i*2 + 1];
+            radialFull.push_back(ReprojectionErrorWithRadialFull(x, y, &v.imgSize[0], &v.imgSize[1], modelPoint));
+            intrinsic.push_back(ReprojectionError(x, y, &v.imgSize[0], &v.imgSize[1], v.dist, modelPoint));
+            noIntrinsic.push_back(ReprojectionErrorNoIntrinsic(x, y, v.focal, v.principal, v.dist, modelPoint));
+            noIntrinsicNoExtrinsic.push_back(ReprojectionErrorNoIntrinsicNoExtrinsic(x, y, v.camT, v.camR,
+                                                                                     v.focal, v.principal, v.dist,
+                                                                                     modelPoint));
+        }
+
+        success &= testView<ViewReprojectionErrorWithRadialFull>("ReprojectionErrorWithRadialFull", radialFull,
+                                                                 {v.objT, v.objR, v.camT, v.camR, v.focal, v.principal, v.dist},
+                                                                 tolerance);
+        success &= testView<ViewReprojectionErrorIntrinsic>("ReprojectionError", intrinsic,
+                                                            {v.objT, v.objR, v.camT, v.camR, v.focal, v.principal},
+                                                            tolerance);
+        success &= testView<ViewReprojectionErrorNoIntrinsic>("ReprojectionErrorNoIntrinsic", noIntrinsic,
+                                                              {v.objT, v.objR, v.camT, v.camR},
+                                                              tolerance);
+        success &= testView<ViewReprojectionErrorNoIntrinsicNoExtrinsic>("ReprojectionErrorNoIntrinsicNoExtrinsic",
+                                                                         noIntrinsicNoExtrinsic,
+                                                                         {v.objT, v.objR},
+                                                                         tolerance);
+    }
+
+    if (!success)
+        return 1;
+    std::cout << "SUCCESS: Analytic jacobians match automatic differentiation on " << numTrials << " random problems.\n";
+    return 0;
+}
@@ -106,6 +106,16 @@ cdef extern from "RunAprilDetectorBatch.hpp":
         RunAprilDetectorBatch(string, int, unsigned int, bool, float) except +  # this is just the constructor; weird stuff turns cpp exceptions into python exceptions
         vector[vector[Detection]] processImageBatch(vector[string])
         vector[vector[Detection]] processVideo(string)
+        vector[vector[vector[Detection]]] processVideoBatch(vector[string])
+        void startImageBatch(vector[string]) except +
+        unsigned int startVideo(string) except +
+        bool nextResult(unsigned int&, vector[Detection]&) nogil
+        void stop() nogil
+        void setQueueCapacity(unsigned int)
+        void setNumReaders(unsigned int)
+        void setFrameStride(unsigned int)
+        void setMinMotion(float)
+        void setRefineCorners(bool)
 
 
 cdef class PyRunAprilDetectorBatch:
@@ -118,6 +128,27 @@ cdef class PyRunAprilDetectorBatch:
         
     def __dealloc__(self):
         del self.c_RunAprilDetectorBatch
+
+    def setQueueCapacity(self, unsigned int capacity):
+        """ Maximal number of decoded video frames waiting for detection, 0 means unbounded. """
+        self.c_RunAprilDetectorBatch.setQueueCapacity(capacity)
+
+    def setNumReaders(self, unsigned int numReaders):
+        """ Number of threads decoding a video in parallel, each one reads its own range of frames. """
+        self.c_RunAprilDetectorBatch.setNumReaders(numReaders)
+
+    def setFrameStride(self, unsigned int frameStride):
+        """ Only every frameStride-th frame of a video is detected, skipped frames have no detections. """
+        self.c_RunAprilDetectorBatch.setFrameStride(frameStride)
+
+    def setMinMotion(self, float minMotion):
+        """ Skips video frames that moved less than minMotion pixels since the last detected frame, 0 disables it. """
+        self.c_RunAprilDetectorBatch.setMinMotion(minMotion)
+
+    def setRefineCorners(self, bool refineCorners):
+        """ With a resize factor below 1 tags are found on the resized image and their corners refined on the
+            full resolution image. """
+        self.c_RunAprilDetectorBatch.setRefineCorners(refineCorners)
         
     def processImageBatch(self, imagePaths):
         cdef vector[string] imagePathsEnc = to_cstring_array(imagePaths)
@@ -154,4 +185,63 @@ cdef class PyRunAprilDetectorBatch:
                 imgOut.append(PyDetection_factory(x))
             fullOut.append(imgOut)
 
-        return fullOut
\ No newline at end of file
+        return fullOut
+
+    def processVideoBatch(self, videoPaths):
+        """ Detects several videos at once with the same workers, returns the detections of each video. """
+        cdef vector[string] videoPathsEnc = to_cstring_array(videoPaths)
+
+        # get the c class result
+        cdef vector[vector[vector[Detection]]] cResult = self.c_RunAprilDetectorBatch.processVideoBatch(videoPathsEnc)
+
+        fullOut = list()
+        for vidResult in cResult:
+            vidOut = list()
+            for imgResult in vidResult:
+                imgOut = list()
+                for x in imgResult:
+                    imgOut.append(PyDetection_factory(x))
+                vidOut.append(imgOut)
+            fullOut.append(vidOut)
+
+        return fullOut
+
+    def iterImageBatch(self, imagePaths):
+        """ Generator yielding (image index, detections) for each image as soon as it is processed.
+            Images come in the order they are finished, not in the order of imagePaths. """
+        cdef vector[string] imagePathsEnc = to_cstring_array(imagePaths)
+        cdef unsigned int fid
+        cdef vector[Detection] cResult
+        cdef bool hasResult
+        self.c_RunAprilDetectorBatch.startImageBatch(imagePathsEnc)
+        try:
+            while True:
+                with nogil:
+                    hasResult = self.c_RunAprilDetectorBatch.nextResult(fid, cResult)
+                if not hasResult:
+                    break
+                yield fid, [PyDetection_factory(x) for x in cResult]
+        finally:
+            # also runs when the generator is closed early
+            with nogil:
+                self.c_RunAprilDetectorBatch.stop()
+
+    def iterVideo(self, videoPath):
+        """ Generator yielding (frame index, detections) for each frame of the video as soon as it is processed.
+            Frames come in the order they are finished. """
+        cdef string videoPathStr = to_cstring(videoPath)
+        cdef unsigned int fid
+        cdef vector[Detection] cResult
+        cdef bool hasResult
+        self.c_RunAprilDetectorBatch.startVideo(videoPathStr)
+        try:
+            while True:
+                with nogil:
+                    hasResult = self.c_RunAprilDetectorBatch.nextResult(fid, cResult)
+                if not hasResult:
+                    break
+                yield fid, [PyDetection_factory(x) for x in cResult]
+        finally:
+            # also runs when the generator is closed early
+            with nogil:
+                self.c_RunAprilDetectorBatch.stop()
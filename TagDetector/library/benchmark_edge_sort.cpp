@@ -0,0 +1,91 @@
+// Measures the time of sorting the segmentation edges of the tag detector with std::stable_sort (original) and with
+// Edge::sortEdges (counting sort), and checks that both give the same order.
+//
+// Usage: benchmark_edge_sort [-n repetitions] image [image ...]
+#include <iostream>
+#include <iomanip>
+#include <vector>
+#include <string>
+#include <algorithm>
+#include <chrono>
+#include <cstdlib>
+#include <cstring>
+
+#include "opencv2/opencv.hpp"
+
+#include "TagDetector.h"
+#include "Tag36h11.h"
+#include "Edge.h"
+
+// Edges as built by TagDetector::extractTags before they are sorted
+std::vector<AprilTags::Edge> buildEdges(AprilTags::TagDetector& detector, const cv::Mat& image) {
+    AprilTags::FloatImage fimOrig, fim, fimSeg, fimTheta, fimMag;
+    detector.preprocess(image, fimOrig, fim, fimSeg, fimTheta, fimMag);
+
+    int width = fimSeg.getWidth();
+    int height = fimSeg.getHeight();
+    std::vector<AprilTags::Edge> edges(width*height*4);
+    size_t nEdges = 0;
+    for (int y = 0; y+1 < height; y++) {
+        for (int x = 0; x+1 < width; x++) {
+            if (fimMag.get(x, y) < AprilTags::Edge::minMag)
+                continue;
+            AprilTags::Edge::calcEdges(fimTheta.get(x, y), x, y, fimTheta, fimMag, edges, nEdges);
+        }
+    }
+    edges.resize(nEdges);
+    return edges;
+}
+
+int main(int argc, char **argv) {
+    int repetitions = 5;
+    int arg = 1;
+    if ((arg + 1 < argc) && (strcmp(argv[arg], "-n") == 0)) {
+        repetitions = std::atoi(argv[arg + 1]);
+        arg += 2;
+    }
+    if (argc - arg < 1) {
+        std::cout << "Usage: " << argv[0] << " [-n repetitions] image [image ...]\n";
+        return 1;
+    }
+
+    AprilTags::TagDetector detector(AprilTags::tagCodes36h11, 2);
+    std::cout << "edges      stable_sort [ms]  counting sort [ms]  speedup\n";
+    for (; arg < argc; ++arg) {
+        cv::Mat image = cv::imread(argv[arg], cv::IMREAD_GRAYSCALE);
+        if (image.empty()) {
+            std::cout << "Could not read " << argv[arg] << "\n";
+            return 1;
+        }
+        std::vector<AprilTags::Edge> edges = buildEdges(detector, image);
+
+        double secondsStable = 0.0, secondsCounting = 0.0;
+        std::vector<AprilTags::Edge> sortedStable, sortedCounting;
+        for (int r = 0; r < repetitions; ++r) {
+            sortedStable = edges;
+            auto start = std::chrono::steady_clock::now();
+            std::stable_sort(sortedStable.begin(), sortedStable.end());
+            secondsStable += std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+
+            sortedCounting = edges;
+            start = std::chrono::steady_clock::now();
+            AprilTags::Edge::sortEdges(sortedCounting);
+            secondsCounting += std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+        }
+
+        for (size_t i = 0; i < edges.size(); ++i) {
+            if ((sortedStable[i].pixelIdxA != sortedCounting[i].pixelIdxA) ||
+                (sortedStable[i].pixelIdxB != sortedCounting[i].pixelIdxB)) {
+                std::cout << "Order differs at edge " << i << " of " << argv[arg] << "\n";
+                return 1;
+            }
+        }
+
+        std::cout << std::setw(10) << edges.size()
+                  << std::fixed << std::setprecision(2)
+                  << std::setw(18) << 1000*secondsStable/repetitions
+                  << std::setw(20) << 1000*secondsCounting/repetitions
+                  << std::setw(9) << secondsStable/secondsCounting << "\n";
+    }
+    return 0;
+}
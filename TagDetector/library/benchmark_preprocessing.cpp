@@ -0,0 +1,96 @@
+// Measures the time per megapixel of the first stage of the tag detector (TagDetector::preprocess: conversion to
+// float, Gaussian blur and gradient) for the original per pixel loops and the OpenCV based path, and compares results.
+//
+// Usage: benchmark_preprocessing [-n repetitions] image [image ...]
+#include <iostream>
+#include <iomanip>
+#include <vector>
+#include <string>
+#include <chrono>
+#include <cmath>
+#include <cstdlib>
+#include <cstring>
+
+#include "opencv2/opencv.hpp"
+
+#include "TagDetector.h"
+#include "Tag36h11.h"
+#include "Edge.h"
+#include "MathUtil.h"
+
+// Seconds per megapixel of preprocess() on all images
+double timePreprocessing(AprilTags::TagDetector& detector, const std::vector<cv::Mat>& images, int repetitions) {
+    AprilTags::FloatImage fimOrig, fim, fimSeg, fimTheta, fimMag;
+    double megapixels = 0.0;
+    auto start = std::chrono::steady_clock::now();
+    for (int r = 0; r < repetitions; ++r) {
+        for (size_t i = 0; i < images.size(); ++i) {
+            detector.preprocess(images[i], fimOrig, fim, fimSeg, fimTheta, fimMag);
+            megapixels += images[i].total() / 1e6;
+        }
+    }
+    double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    return seconds / megapixels;
+}
+
+int main(int argc, char **argv) {
+    int repetitions = 5;
+    int arg = 1;
+    if ((arg + 1 < argc) && (strcmp(argv[arg], "-n") == 0)) {
+        repetitions = std::atoi(argv[arg + 1]);
+        arg += 2;
+    }
+    if (argc - arg < 1) {
+        std::cout << "Usage: " << argv[0] << " [-n repetitions] image [image ...]\n";
+        return 1;
+    }
+
+    std::vector<cv::Mat> images;
+    for (; arg < argc; ++arg) {
+        cv::Mat image = cv::imread(argv[arg], cv::IMREAD_GRAYSCALE);
+        if (image.empty()) {
+            std::cout << "Could not read " << argv[arg] << "\n";
+            return 1;
+        }
+        images.push_back(image);
+    }
+
+    AprilTags::TagDetector detector(AprilTags::tagCodes36h11, 2);
+    detector.useOpenCVPreprocessing = false;
+    double before = timePreprocessing(detector, images, repetitions);
+    detector.useOpenCVPreprocessing = true;
+    double after = timePreprocessing(detector, images, repetitions);
+
+    std::cout << std::fixed << std::setprecision(2)
+              << "loops:  " << 1000*before << " ms/MP\n"
+              << "opencv: " << 1000*after << " ms/MP\n"
+              << "speedup: " << before / after << "\n";
+
+    // Compare the results, what matters is which pixels pass the edge threshold and their direction
+    size_t numPixels = 0, numThresholdChanged = 0;
+    float maxMagDiff = 0.0f, maxThetaDiff = 0.0f;
+    for (size_t i = 0; i < images.size(); ++i) {
+        AprilTags::FloatImage fimOrig[2], fim[2], fimSeg[2], fimTheta[2], fimMag[2];
+        for (int k = 0; k < 2; ++k) {
+            detector.useOpenCVPreprocessing = (k == 1);
+            detector.preprocess(images[i], fimOrig[k], fim[k], fimSeg[k], fimTheta[k], fimMag[k]);
+        }
+        for (int y = 0; y < fimMag[0].getHeight(); ++y) {
+            for (int x = 0; x < fimMag[0].getWidth(); ++x) {
+                float mag0 = fimMag[0].get(x, y), mag1 = fimMag[1].get(x, y);
+                maxMagDiff = std::max(maxMagDiff, std::fabs(mag0 - mag1));
+                // directions are compared modulo 2pi, atan2 may return -pi on one path and pi on the other
+                float thetaDiff = AprilTags::MathUtil::mod2pi(fimTheta[0].get(x, y) - fimTheta[1].get(x, y));
+                maxThetaDiff = std::max(maxThetaDiff, std::fabs(thetaDiff));
+                if ((mag0 < AprilTags::Edge::minMag) != (mag1 < AprilTags::Edge::minMag)) {
+                    numThresholdChanged++;
+                }
+                numPixels++;
+            }
+        }
+    }
+    std::cout << std::setprecision(9)
+              << "max difference magnitude: " << maxMagDiff << ", direction: " << maxThetaDiff << "\n"
+              << "pixels with changed edge threshold: " << numThresholdChanged << " of " << numPixels << "\n";
+    return 0;
+}
@@ -0,0 +1,67 @@
+// Measures detection throughput (frames per second) of RunAprilDetectorBatch for an increasing number of worker threads.
+//
+// Usage: benchmark_threads [-v] [-c queue_capacity] [-r num_readers] max_threads path [path ...]
+//   -v   path is a video, otherwise all paths are images processed as one batch
+//   -c   capacity of the decoded frame queue (video only), 0 means unbounded
+//   -r   number of threads decoding the video (video only)
+#include <iostream>
+#include <iomanip>
+#include <vector>
+#include <string>
+#include <chrono>
+#include <cstdlib>
+#include <cstring>
+
+#include "RunAprilDetectorBatch.hpp"
+
+int main(int argc, char **argv) {
+    bool video = false;
+    unsigned int queueCapacity = 32;
+    unsigned int numReaders = 1;
+    int arg = 1;
+    while ((arg < argc) && (argv[arg][0] == '-')) {
+        if (strcmp(argv[arg], "-v") == 0) {
+            video = true;
+        } else if ((strcmp(argv[arg], "-c") == 0) && (arg + 1 < argc)) {
+            queueCapacity = std::atoi(argv[++arg]);
+        } else if ((strcmp(argv[arg], "-r") == 0) && (arg + 1 < argc)) {
+            numReaders = std::atoi(argv[++arg]);
+        } else {
+            break;
+        }
+        ++arg;
+    }
+    if (argc - arg < 2) {
+        std::cout << "Usage: " << argv[0] << " [-v] [-c queue_capacity] [-r num_readers] max_threads path [path ...]\n";
+        return 1;
+    }
+    unsigned int maxThreads = std::atoi(argv[arg++]);
+    std::vector<std::string> paths(argv + arg, argv + argc);
+
+    std::cout << "threads  frames  seconds  frames/s  speedup\n";
+    double baseline = 0.0;
+    for (unsigned int numThreads = 1; numThreads <= maxThreads; ++numThreads) {
+        RunAprilDetectorBatch detector("36h11", 2, numThreads, false, 1.0);
+        detector.setQueueCapacity(queueCapacity);
+        detector.setNumReaders(numReaders);
+
+        auto start = std::chrono::steady_clock::now();
+        size_t numFrames = 0;
+        if (video) {
+            numFrames = detector.processVideo(paths[0]).size();
+        } else {
+            numFrames = detector.processImageBatch(paths).size();
+        }
+        double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+
+        double fps = numFrames / seconds;
+        if (numThreads == 1) {
+            baseline = fps;
+        }
+        std::cout << std::setw(7) << numThreads << std::setw(8) << numFrames
+                  << std::fixed << std::setprecision(3) << std::setw(9) << seconds
+                  << std::setprecision(1) << std::setw(10) << fps
+                  << std::setprecision(2) << std::setw(9) << fps / baseline << "\n";
+    }
+    return 0;
+}
@@ -0,0 +1,84 @@
+#ifndef BLOCKINGQUEUE_H
+#define BLOCKINGQUEUE_H
+
+#include <queue>
+#include <mutex>
+#include <condition_variable>
+
+// FIFO queue shared between threads. push() blocks while the queue is full, pop() blocks while it is empty.
+// After close() pushing fails and pop() returns the remaining items, then false.
+template <class T>
+class BlockingQueue {
+private:
+    std::queue<T> m_queue;
+    std::mutex m_mutex;
+    std::condition_variable m_notEmpty, m_notFull;
+    unsigned int m_capacity;  // 0 means unbounded
+    bool m_closed;
+
+public:
+    explicit BlockingQueue(unsigned int capacity=0):
+        m_capacity(capacity),
+        m_closed(false)
+    { }
+
+    // Adds an item, waits while the queue is full. Returns false if the queue was closed.
+    bool push(T item) {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        m_notFull.wait(lock, [this] { return m_closed || (m_capacity == 0) || (m_queue.size() < m_capacity); });
+        if (m_closed) {
+            return false;
+        }
+        m_queue.push(std::move(item));
+        lock.unlock();
+        m_notEmpty.notify_one();
+        return true;
+    }
+
+    // Takes the oldest item, waits while the queue is empty. Returns false once the queue is closed and drained.
+    bool pop(T& item) {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        m_notEmpty.wait(lock, [this] { return m_closed || !m_queue.empty(); });
+        if (m_queue.empty()) {
+            return false;
+        }
+        item = std::move(m_queue.front());
+        m_queue.pop();
+        lock.unlock();
+        m_notFull.notify_one();
+        return true;
+    }
+
+    // No more items will be added, wakes up all waiting threads
+    void close() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_closed = true;
+        m_notEmpty.notify_all();
+        m_notFull.notify_all();
+    }
+
+    // Drops all items and opens the queue again. Must not be called while other threads use the queue.
+    void reset() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_queue = std::queue<T>();
+        m_closed = false;
+    }
+
+    void setCapacity(unsigned int capacity) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_capacity = capacity;
+        m_notFull.notify_all();
+    }
+
+    unsigned int capacity() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return m_capacity;
+    }
+
+    size_t size() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return m_queue.size();
+    }
+};
+
+#endif
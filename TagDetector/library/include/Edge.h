@@ -49,6 +49,11 @@ public:
 			const FloatImage& theta, const FloatImage& mag,
 			std::vector<Edge> &edges, size_t &nEdges);
 
+  //! Sorts edges by increasing cost, keeping the order of edges with the same cost (like std::stable_sort).
+  /*! Costs are small integers in [0, WEIGHT_SCALE], so this is a counting sort in linear time.
+   */
+  static void sortEdges(std::vector<Edge> &edges);
+
   //! Process edges in order of increasing cost, merging clusters if we can do so without exceeding the thetaThresh.
   static void mergeEdges(std::vector<Edge> &edges, UnionFindSimple &uf, float tmin[], float tmax[], float mmin[], float mmax[]);
 
@@ -0,0 +1,76 @@
+#ifndef KEYFRAMESELECTOR_H
+#define KEYFRAMESELECTOR_H
+
+#include <vector>
+#include <algorithm>
+
+#include "opencv2/opencv.hpp"
+
+// Picks keyframes of a video: A frame is kept when the image content moved by at least minMotion pixels since the last
+// kept frame. Corners are found in each kept frame and tracked frame to frame with pyramidal Lucas-Kanade, which is
+// much cheaper than running the tag detector. The tag corners are strong corners, so they are among the tracked points.
+// Frames have to be passed in order and from a single thread.
+class KeyframeSelector {
+private:
+    float m_minMotion;  // in pixels of the frames passed to select()
+    unsigned int m_maxPoints;  // number of corners tracked
+    unsigned int m_minPoints;  // fewer tracked corners than this and the frame is kept
+
+    cv::Mat m_prevFrame;
+    std::vector<cv::Point2f> m_points;  // tracked corners in the previous frame
+    std::vector<cv::Point2f> m_keyPoints;  // the same corners in the last kept frame
+
+    void keep(const cv::Mat& frame) {
+        m_prevFrame = frame;
+        m_points.clear();
+        cv::goodFeaturesToTrack(frame, m_points, m_maxPoints, 0.01, 10.0);
+        m_keyPoints = m_points;
+    }
+
+public:
+    explicit KeyframeSelector(float minMotion, unsigned int maxPoints=200, unsigned int minPoints=10):
+        m_minMotion(minMotion),
+        m_maxPoints(maxPoints),
+        m_minPoints(minPoints)
+    { }
+
+    // Returns true if frame (grayscale) should be kept. The frame is referenced until the next call, so it must not be
+    // written to in between.
+    bool select(const cv::Mat& frame) {
+        if (m_prevFrame.empty() || (m_points.size() < m_minPoints)) {
+            this->keep(frame);
+            return true;
+        }
+
+        std::vector<cv::Point2f> points;
+        std::vector<unsigned char> status;
+        std::vector<float> error;
+        cv::calcOpticalFlowPyrLK(m_prevFrame, frame, m_points, points, status, error);
+
+        // Keep the corners that could be tracked, the largest displacement since the last kept frame is the motion
+        // of the board (static background does not move)
+        float maxMotion = 0.0f;
+        unsigned int n = 0;
+        for (unsigned int i=0; i < points.size(); i++) {
+            if (!status[i]) {
+                continue;
+            }
+            m_points[n] = points[i];
+            m_keyPoints[n] = m_keyPoints[i];
+            maxMotion = std::max(maxMotion, static_cast<float>(cv::norm(points[i] - m_keyPoints[i])));
+            n++;
+        }
+        m_points.resize(n);
+        m_keyPoints.resize(n);
+
+        if ((n < m_minPoints) || (maxMotion >= m_minMotion)) {
+            // lost track or moved far enough
+            this->keep(frame);
+            return true;
+        }
+        m_prevFrame = frame;
+        return false;
+    }
+};
+
+#endif
@@ -5,8 +5,12 @@
 #include <vector>
 #include <thread>
 #include <mutex>
-#include <queue>
+#include <atomic>
 #include <utility>
+#include <list>
+#include <limits>
+#include <iterator>
+#include <cmath>
 
 #include "opencv2/opencv.hpp"
 
@@ -16,21 +20,59 @@
 #include "Tag36h11.h"
 
 #include "Detection.h"
+#include "BlockingQueue.h"
+#include "KeyframeSelector.h"
+
+// A decoded video frame waiting for a worker, videoId is the index of the video when several are processed at once
+struct VideoFrame {
+    unsigned int videoId;
+    unsigned int frameId;
+    cv::Mat image;
+};
+
+// Detections of a finished frame (or image, then videoId is 0)
+struct FrameResult {
+    unsigned int videoId;
+    unsigned int frameId;
+    std::vector< Detection > detections;
+};
 
 class RunAprilDetectorBatch {
 private:
     AprilTags::TagDetector* m_tagDetector;
     AprilTags::TagCodes m_tagCodes;
     std::string m_tagCodesName;
-    bool m_stop;  // Stopping flag for video workers
     bool m_draw; // Indicates if detections should be showed or not 
     int m_blackBorder;  // Amount of border 
     unsigned int m_maxNumThreads; // Number of parallel threads
+    unsigned int m_numReaders; // Number of threads decoding a video, each one reads a range of frames
+    unsigned int m_frameStride; // Only every m_frameStride-th frame of a video is detected
+    float m_minMotion; // Frames that moved less than this (in pixels) since the last detected frame are skipped, 0 disables
     
     cv::Mat m_image;  // Image read from disk
     cv::Mat m_image_gray;  // Grayscale image for detection
     
     float m_resizeFactor;
+    bool m_refineCorners;  // Refine corners found on the resized image on the full resolution image
+    
+    // State of a running detection (see startImageBatch, startVideo and nextResult)
+    std::vector< std::thread > m_workerList;  // Keep track of our workers
+    std::vector< std::thread > m_videoReaders;
+    std::list< cv::VideoCapture > m_videos;  // one per reader
+    std::atomic<unsigned int> m_numRunningReaders;
+    BlockingQueue< std::pair<int, std::string> > m_jobQueue;  // Jobs of an image batch
+    BlockingQueue< VideoFrame > m_frameQueue; // Queue of read images, bounded so the reader does not run away
+    
+    // Finished frames, workers push them as soon as they are done and nextResult() hands them out.
+    // It is closed when the last worker quits.
+    BlockingQueue< FrameResult > m_resultQueue;
+    std::atomic<unsigned int> m_numRunningWorkers;
+    std::atomic<bool> m_cancel;  // Tells all threads to quit early
+    
+    // Without streaming every worker keeps its finished frames in its own buffer, they are merged after the workers 
+    // are joined. So workers never wait for each other.
+    bool m_stream;
+    std::vector< std::vector< FrameResult > > m_workerResults;
     
 public:
     // default constructor
@@ -38,11 +80,19 @@ public:
         // default settings
         m_tagDetector(NULL),
         m_maxNumThreads(1),
+        m_numReaders(1),
+        m_frameStride(1),
+        m_minMotion(0.0f),
+        m_refineCorners(false),
         m_resizeFactor(1.0),
         m_tagCodes(AprilTags::tagCodes36h11),
         m_blackBorder(blackBorder),
         m_draw(false),
-        m_stop(false)
+        m_frameQueue(32),
+        m_numRunningReaders(0),
+        m_numRunningWorkers(0),
+        m_cancel(false),
+        m_stream(true)
         {
             // Set the tag family
             if (codeName == "16h5") {
@@ -67,11 +117,19 @@ public:
         // default settings
         m_tagDetector(NULL),
         m_maxNumThreads(maxNumThreads),
+        m_numReaders(1),
+        m_frameStride(1),
+        m_minMotion(0.0f),
+        m_refineCorners(false),
         m_resizeFactor(resizeFactor),
         m_tagCodes(AprilTags::tagCodes36h11),
         m_blackBorder(blackBorder),
         m_draw(draw),
-        m_stop(false)
+        m_frameQueue(32),
+        m_numRunningReaders(0),
+        m_numRunningWorkers(0),
+        m_cancel(false),
+        m_stream(true)
         {
             // Set the tag family
             if (codeName == "16h5") {
@@ -92,6 +150,11 @@ public:
             setup();
         }
         
+    ~RunAprilDetectorBatch() {
+        this->stop();
+        delete m_tagDetector;
+    }
+        
     // call this once to create a TagDetector
     void setup() {
         if (m_tagDetector != NULL) {
@@ -108,94 +171,276 @@ public:
     }
     
     
+    // Maximal number of decoded video frames waiting for a worker, 0 means unbounded
+    void setQueueCapacity(unsigned int capacity) {
+        m_frameQueue.setCapacity(capacity);
+    }
+    
+    // Number of threads decoding a video in parallel. The video is split into as many ranges of frames, 
+    // each reader seeks to the start of its range.
+    void setNumReaders(unsigned int numReaders) {
+        m_numReaders = std::max(numReaders, 1u);
+    }
+    
+    // Only frames whose id is a multiple of frameStride are detected, the others are not even decoded.
+    void setFrameStride(unsigned int frameStride) {
+        m_frameStride = std::max(frameStride, 1u);
+    }
+    
+    // Keyframe selection: A frame is only detected if it moved by at least minMotion pixels (full resolution) since the
+    // last detected frame, which is checked by tracking corners (see KeyframeSelector). Frames have to be read in order,
+    // so a single reader is used. 0 disables it.
+    void setMinMotion(float minMotion) {
+        m_minMotion = std::max(minMotion, 0.0f);
+    }
+    
+    // Two stage detection for a resize factor below 1: Tags are searched on the resized image, then each corner is 
+    // refined on the full resolution image (see refineCorners). Gives the speed of the resized image without losing 
+    // the precision of the corners.
+    void setRefineCorners(bool refineCorners) {
+        m_refineCorners = refineCorners;
+    }
+    
+    bool refiningCorners() const {
+        return m_refineCorners && (m_resizeFactor != 1.0f);
+    }
+    
     std::vector< std::vector< Detection > > processImageBatch(std::vector<std::string> imagePathBatch) {
         std::vector< std::vector< Detection > > detectionResult;  // This is where we keep the output
         detectionResult.resize(imagePathBatch.size()); // Thats how much output we will have
-        std::vector< int > processIdList;
         
-        // Fill vector of process ids
-        for (int pid=0; pid < static_cast<unsigned int> (imagePathBatch.size()); ++pid) {
-            processIdList.push_back(pid);
+        this->startImageBatch(imagePathBatch, false);
+        this->collectResults(detectionResult);
+        
+        return detectionResult;
+        
+    }
+    
+    // Starts detection on a batch of images in the background, fetch the results with nextResult()
+    // (or collectResults() when stream is false)
+    void startImageBatch(const std::vector<std::string>& imagePathBatch, bool stream=true) {
+        this->stop();  // in case the previous run was not consumed completely
+        m_resultQueue.reset();
+        m_stream = stream;
+        
+        // Queue up all jobs, workers quit once it is empty
+        for (int pid=0; pid < static_cast<int> (imagePathBatch.size()); ++pid) {
+            m_jobQueue.push(std::make_pair(pid, imagePathBatch[pid]));
         }
+        m_jobQueue.close();
         
-        std::vector< std::thread > workerList;  // Keep track of our workers
         unsigned int maxNumThreads = std::min(m_maxNumThreads, static_cast<unsigned int> (imagePathBatch.size()));  // Possible that there are less jobs than possible threads
 //         std::cout << "Running with " << maxNumThreads << " threads\n";       
-        
-        std::mutex getJobMutex, writeResultMutex;
+        m_cancel = false;
+        m_numRunningWorkers = maxNumThreads;
+        if (maxNumThreads == 0) {
+            m_resultQueue.close();  // nothing to do
+        }
+        m_workerResults.resize(maxNumThreads);
         
         // Create worker threads
         for(unsigned int i=0; i < maxNumThreads; i++) {
 //             std::cout << "Starting thread " << i << "\n";            
-            workerList.push_back(std::thread(&RunAprilDetectorBatch::processImageWorkerThread, this,
-                                             std::ref(processIdList),
-                                             std::ref(imagePathBatch),
-                                             std::ref(detectionResult),
-                                             std::ref(getJobMutex),
-                                             std::ref(writeResultMutex))
+            m_workerList.push_back(std::thread(&RunAprilDetectorBatch::processImageWorkerThread, this,
+                                               i, std::ref(m_jobQueue))
                        );
         }
+    }
+    
+    // Blocks until a worker finished a frame (or image) and hands out its detections. 
+    // Frames come in the order they are finished. Returns false once all frames were handed out.
+    bool nextResult(unsigned int& frameId, std::vector< Detection >& detections) {
+        unsigned int videoId;
+        return this->nextResult(videoId, frameId, detections);
+    }
+    
+    // Same as above, also tells which video the frame belongs to when several videos are processed
+    bool nextResult(unsigned int& videoId, unsigned int& frameId, std::vector< Detection >& detections) {
+        FrameResult result;
+        if (!m_resultQueue.pop(result)) {
+            // all workers are done
+            this->stop();
+            return false;
+        }
         
-//         std::cout << "Now waiting for jobs to finish. \n";   
+        videoId = result.videoId;
+        frameId = result.frameId;
+        std::swap(detections, result.detections);
+        this->setType(detections);
+        return true;
+    }
+    
+    // Waits until all workers are done and writes their results into detectionResult (indexed by frame id).
+    // Counterpart of nextResult() for a detection started without streaming.
+    void collectResults(std::vector< std::vector< Detection > >& detectionResult) {
+        std::vector< std::vector< std::vector< Detection > > > videoResults(1);
+        std::swap(videoResults[0], detectionResult);
+        this->collectResults(videoResults);
+        std::swap(videoResults[0], detectionResult);
+    }
+    
+    // Same as above for several videos, detectionResult is indexed by video id and frame id
+    void collectResults(std::vector< std::vector< std::vector< Detection > > >& detectionResult) {
+        // workers quit on their own once all frames are done
+        for (unsigned int j=0; j < m_workerList.size(); ++j) {
+            m_workerList[j].join();
+        }
+        m_workerList.clear();
         
-        // Let all workers finish
-        while (workerList.size() > 0) {                
-            
-            // Iterate workers and check if one of them is finished, if so remove from the list of workers
-            for (unsigned int j=0; j < workerList.size(); ++j) {
-                if (workerList[j].joinable()) {
-                    workerList[j].join();
-                    workerList.erase(workerList.begin() + j);
-//                     std::cout << "Some Thread finished and joined\n";
-                    break;
+        for (unsigned int w=0; w < m_workerResults.size(); ++w) {
+            for (unsigned int j=0; j < m_workerResults[w].size(); ++j) {
+                FrameResult& result = m_workerResults[w][j];
+                std::vector< std::vector< Detection > >& videoResult = detectionResult[result.videoId];
+                if (result.frameId >= videoResult.size()) {
+                    videoResult.resize(result.frameId + 1);  // frame count of the container can be off
                 }
+                std::swap(videoResult[result.frameId], result.detections);
+                this->setType(videoResult[result.frameId]);
             }
-            std::this_thread::sleep_for(std::chrono::milliseconds(5));
         }
+        this->stop();
+    }
+    
+    // Stops a running detection early, waits for all threads and discards results not handed out yet
+    void stop() {
+        m_cancel = true;
+        // wake up threads waiting on a queue
+        m_jobQueue.close();
+        m_frameQueue.close();
+        m_resultQueue.close();
+        for (unsigned int j=0; j < m_workerList.size(); ++j) {
+            m_workerList[j].join();
+        }
+        m_workerList.clear();
+        for (unsigned int j=0; j < m_videoReaders.size(); ++j) {
+            m_videoReaders[j].join();
+        }
+        m_videoReaders.clear();
+        m_videos.clear();
         
-        return detectionResult;
+        m_jobQueue.reset();
+        m_frameQueue.reset();
+        m_resultQueue.reset();
+        m_resultQueue.close();  // nextResult() returns false until the next start
+        m_workerResults.clear();
+        m_numRunningWorkers = 0;
+    }
+    
+    // Called by the workers when they finished a frame
+    void pushResult(unsigned int workerId, unsigned int videoId, unsigned int frameId, std::vector< Detection >& detections) {
+        FrameResult result = {videoId, frameId, std::move(detections)};
+        if (m_stream) {
+            m_resultQueue.push(std::move(result));
+        } else {
+            m_workerResults[workerId].push_back(std::move(result));
+        }
+    }
+    
+    // Puts the detections into generic Detections, the type is left empty (see setType)
+    void convertDetections(const vector<AprilTags::TagDetection>& detections, std::vector< Detection >& result) const {
+        float f = 1.0f / m_resizeFactor; // upscaleFactor
+        result.resize(detections.size());
+        for (unsigned int i=0; i<detections.size(); i++) {
+            result[i].id = detections[i].id;
+            result[i].points.resize(4);
+            for (unsigned int k=0; k<4; k++) {
+                result[i].points[k] = std::pair<float, float> (detections[i].p[k].first*f, detections[i].p[k].second*f);
+            }
+        }
+    }
+    
+    // Turns an image into the input of the detector: grayscale and resized by m_resizeFactor.
+    // Converting first means only one channel is interpolated, for a factor of 1 nothing is resized.
+    void prepareImage(const cv::Mat& image, cv::Mat& image_gray) const {
+        cv::Mat gray;
+        this->toGray(image, gray);
+        this->resizeImage(gray, image_gray);
+    }
+    
+    void toGray(const cv::Mat& image, cv::Mat& gray) const {
+        if (image.channels() == 1) {
+            gray = image;
+        } else {
+            cv::cvtColor(image, gray, CV_BGR2GRAY);
+        }
+    }
+    
+    void resizeImage(const cv::Mat& image, cv::Mat& image_resized) const {
+        if (m_resizeFactor == 1.0f) {
+            image_resized = image;
+        } else {
+            cv::resize(image, image_resized, cv::Size(), m_resizeFactor, m_resizeFactor);
+        }
+    }
+    
+    // Second stage of the two stage detection: Moves the (upscaled) corners to the sub-pixel corner location in the
+    // full resolution grayscale image. The search window covers two pixels of the resized image around each corner, 
+    // corners that would leave it keep their upscaled location.
+    void refineCorners(const cv::Mat& image_full, std::vector< Detection >& result) const {
+        if (result.empty()) {
+            return;
+        }
+        std::vector<cv::Point2f> corners;
+        for (unsigned int i=0; i<result.size(); i++) {
+            for (unsigned int k=0; k<result[i].points.size(); k++) {
+                corners.push_back(cv::Point2f(result[i].points[k].first, result[i].points[k].second));
+            }
+        }
+        
+        int halfWindow = std::max(2, static_cast<int>(std::ceil(2.0f / m_resizeFactor)));
+        std::vector<cv::Point2f> refined(corners);
+        cv::cornerSubPix(image_full, refined, cv::Size(halfWindow, halfWindow), cv::Size(-1, -1),
+                         cv::TermCriteria(cv::TermCriteria::EPS + cv::TermCriteria::COUNT, 20, 0.01));
         
+        unsigned int j = 0;
+        for (unsigned int i=0; i<result.size(); i++) {
+            for (unsigned int k=0; k<result[i].points.size(); k++, j++) {
+                if (cv::norm(refined[j] - corners[j]) <= halfWindow) {
+                    result[i].points[k] = std::pair<float, float> (refined[j].x, refined[j].y);
+                }
+            }
+        }
     }
     
+    // The tag type is the same for all detections, it is set when they are handed out instead of in the workers
+    void setType(std::vector< Detection >& detections) const {
+        for (unsigned int i=0; i<detections.size(); i++) {
+            detections[i].type = m_tagCodesName;
+        }
+    }
     
-    void processImageWorkerThread(std::vector<int>& processIdList, std::vector< std::string>& imagePathList,
-                                  std::vector< std::vector< Detection > >& detectionResult,
-                                  std::mutex& getJobMutex, std::mutex& writeResultMutex) {
+    // Called by each worker when it quits, the last one closes the result queue
+    void workerFinished() {
+        if (--m_numRunningWorkers == 0) {
+            m_resultQueue.close();
+        }
+    }
+    
+    
+    void processImageWorkerThread(unsigned int workerId, BlockingQueue< std::pair<int, std::string> >& jobQueue) {
         // Dont use class members, because they are shared across threads
         cv::Mat image;  // Image read from disk
-        cv::Mat image_small;  // Image resized
-        cv::Mat image_gray;  // Grayscale image for detection
+        cv::Mat image_gray;  // Grayscale and resized image for detection
+        cv::Mat image_full;  // Grayscale image in full resolution, for refining corners
         
         // Input data of a single job
+        std::pair<int, std::string> job;
         int processId;
         std::string imagePath;
         
-        while (true) { // worker loop (loops until it breaks, which happens when there are no more jobs)
-            
-            // Check for a work package
-            getJobMutex.lock();
-            if (processIdList.size() == 0) {
-//                 std::cout << "Stopping worker thread.\n";
-                getJobMutex.unlock();
-                break;
-            }
-            else {
-                // Get data to do a job
-                processId = processIdList.back();
-                imagePath = imagePathList.back();
-                processIdList.pop_back();
-                imagePathList.pop_back();
-//                 std::cout << "Took job " << processId << "\n";
-                getJobMutex.unlock();
-            }
+        // worker loop (runs until there are no more jobs)
+        while (!m_cancel && jobQueue.pop(job)) {
+            processId = job.first;
+            imagePath = job.second;
+//             std::cout << "Took job " << processId << "\n";
             
             //// Actually do the job
             // Read image
             image = cv::imread(imagePath);
-            cv::resize(image, image_small, cv::Size(), m_resizeFactor, m_resizeFactor);
             
             // detect April tags (requires a gray scale image)
-            cv::cvtColor(image_small, image_gray, CV_BGR2GRAY);
+            this->toGray(image, image_full);
+            this->resizeImage(image_full, image_gray);
             vector<AprilTags::TagDetection> detections = m_tagDetector->extractTags(image_gray);
 
             // show the current image including any detections
@@ -210,27 +455,16 @@ public:
                 cv::waitKey(200);
             }
             
-            writeResultMutex.lock();
-            float f = 1.0f / m_resizeFactor; // upscaleFactor
-            // Put everything in a generic detection
-            for (unsigned int i=0; i<detections.size(); i++) {
-                std::vector< std::pair<float, float> > points;
-                points.push_back(std::pair<float, float> (detections[i].p[0].first*f, detections[i].p[0].second*f));
-                points.push_back(std::pair<float, float> (detections[i].p[1].first*f, detections[i].p[1].second*f));
-                points.push_back(std::pair<float, float> (detections[i].p[2].first*f, detections[i].p[2].second*f));
-                points.push_back(std::pair<float, float> (detections[i].p[3].first*f, detections[i].p[3].second*f));
-//                 points.push_back(detections[i].p[0]);
-//                 points.push_back(detections[i].p[1]);
-//                 points.push_back(detections[i].p[2]);
-//                 points.push_back(detections[i].p[3]);
-                detectionResult[processId].push_back(Detection(this->m_tagCodesName,
-                                                    detections[i].id,
-                                                    points));
-            }      
+            std::vector< Detection > result;
+            this->convertDetections(detections, result);
+            if (this->refiningCorners()) {
+                this->refineCorners(image_full, result);
+            }
+            this->pushResult(workerId, 0, processId, result);
 //             std::cout << "Finished job " << processId << " and wrote back results\n";
-            writeResultMutex.unlock();
             
         } // worker loop
+        this->workerFinished();
     }
     
     std::vector< Detection > processImage(std::string imagePath) {
@@ -279,125 +513,211 @@ public:
 
 
     std::vector< std::vector< Detection > > processVideo(std::string videoPath) {
-        // Open Video
-        cv::VideoCapture video(videoPath);
-        unsigned int numOfFrames(video.get(CV_CAP_PROP_FRAME_COUNT));
+        unsigned int numOfFrames = this->startVideo(videoPath, false);
 
         std::vector< std::vector< Detection > > detectionResult;  // This is where we keep the output
         detectionResult.resize(numOfFrames); // Thats how much output we will have
+        this->collectResults(detectionResult);
 
-        std::vector< std::thread > workerList;  // Keep track of our workers
-        std::queue< std::pair<unsigned int, cv::Mat> > frameQueue; // Queue of read images
-        std::mutex queueLock, writeResultMutex;
-
-        // Start Worker that reads new frames from the video
-        std::thread videoReader(&RunAprilDetectorBatch::videoReaderThread, this,
-                               std::ref(video),
-                               std::ref(queueLock),
-                               std::ref(frameQueue));
+        return detectionResult;
 
-        // Use remaining workers for making detections
-        m_stop = false;
-        for(unsigned int i=0; i < m_maxNumThreads; i++) {
-            workerList.push_back(std::thread(&RunAprilDetectorBatch::processVideoWorkerThread, this,
-                                             std::ref(detectionResult),
-                                             std::ref(queueLock),
-                                             std::ref(frameQueue),
-                                             std::ref(writeResultMutex)));
+    }
+    
+    // Detects several videos at once (e.g. all cameras of a rig), their frames are processed by the same workers.
+    // The result is indexed by the position of the video in videoPaths and frame id.
+    std::vector< std::vector< std::vector< Detection > > > processVideoBatch(std::vector<std::string> videoPaths) {
+        std::vector<unsigned int> numOfFrames = this->startVideoBatch(videoPaths, false);
+
+        std::vector< std::vector< std::vector< Detection > > > detectionResult(videoPaths.size());
+        for (unsigned int v=0; v < videoPaths.size(); v++) {
+            detectionResult[v].resize(numOfFrames[v]);
         }
+        this->collectResults(detectionResult);
 
+        return detectionResult;
+    }
+
+    // Starts detection on a video in the background, fetch the results with nextResult() (or collectResults() when
+    // stream is false). Returns the number of frames. Frames skipped because of the frame stride or keyframe selection
+    // give no result (empty detections in processVideo), frame ids always count all frames of the video.
+    unsigned int startVideo(const std::string& videoPath, bool stream=true) {
+        return this->startVideoBatch(std::vector<std::string>(1, videoPath), stream).front();
+    }
 
-        // Let all workers finish
-        for (unsigned int j=0; j < workerList.size(); ++j) {
-            workerList[j].join();
+    // Starts detection on several videos, all their readers feed the same workers. Returns the number of frames
+    // of each video. nextResult() tells which video a frame belongs to.
+    std::vector<unsigned int> startVideoBatch(const std::vector<std::string>& videoPaths, bool stream=true) {
+        this->stop();  // in case the previous run was not consumed completely
+        m_resultQueue.reset();
+        m_stream = stream;
+
+        m_cancel = false;
+        m_numRunningWorkers = m_maxNumThreads;
+        if (m_maxNumThreads == 0) {
+            m_resultQueue.close();  // no worker would ever close it
+        }
+        m_workerResults.resize(m_maxNumThreads);
+
+        // Open Videos
+        std::vector<unsigned int> numOfFrames(videoPaths.size());
+        std::vector<unsigned int> numReaders(videoPaths.size());
+        std::vector< std::list< cv::VideoCapture >::iterator > firstVideo(videoPaths.size());
+        unsigned int totalNumReaders = 0;
+        for (unsigned int v=0; v < videoPaths.size(); v++) {
+            m_videos.emplace_back(videoPaths[v]);
+            firstVideo[v] = std::prev(m_videos.end());
+            numOfFrames[v] = static_cast<unsigned int>(firstVideo[v]->get(CV_CAP_PROP_FRAME_COUNT));
+
+            // Split the video into ranges of frames, the last reader also takes frames beyond the reported frame count
+            numReaders[v] = m_numReaders;
+            if ((numOfFrames[v] < 2*numReaders[v]) || (m_minMotion > 0.0f)) {
+                numReaders[v] = 1;  // frame count unknown, too few frames or keyframes are selected
+            }
+            for (unsigned int i=1; i < numReaders[v]; i++) {
+                m_videos.emplace_back();  // opened by its reader, so opening and seeking runs in parallel
+            }
+            totalNumReaders += numReaders[v];
+        }
+        m_numRunningReaders = totalNumReaders;  // set before any reader starts, the last one closes the queue
+        if ((totalNumReaders == 0) || (m_maxNumThreads == 0)) {
+            m_frameQueue.close();  // nothing to read, or nobody to detect the frames
+            totalNumReaders = 0;
+            m_numRunningReaders = 0;
         }
 
-        // clean up remainder
-        videoReader.join();
-        video.release();
+        // Start Workers that read new frames from the videos
+        for (unsigned int v=0; (v < videoPaths.size()) && (totalNumReaders > 0); v++) {
+            std::list< cv::VideoCapture >::iterator video = firstVideo[v];
+            for (unsigned int i=0; i < numReaders[v]; i++, video++) {
+                unsigned int startFrame = (i*numOfFrames[v]) / numReaders[v];
+                unsigned int endFrame = (i + 1 == numReaders[v]) ? std::numeric_limits<unsigned int>::max() : ((i + 1)*numOfFrames[v]) / numReaders[v];
+                m_videoReaders.push_back(std::thread(&RunAprilDetectorBatch::videoReaderThread, this,
+                                                     std::ref(*video),
+                                                     videoPaths[v], v, startFrame, endFrame,
+                                                     std::ref(m_frameQueue)));
+            }
+        }
 
-        return detectionResult;
+        // Use remaining workers for making detections
+        for(unsigned int i=0; i < m_maxNumThreads; i++) {
+            m_workerList.push_back(std::thread(&RunAprilDetectorBatch::processVideoWorkerThread, this,
+                                               i, std::ref(m_frameQueue)));
+        }
 
+        return numOfFrames;
     }
 
-    void videoReaderThread(cv::VideoCapture& video, std::mutex& queueLock, std::queue< std::pair<unsigned int, cv::Mat> >& frameQueue){
+    // Reads the frames [startFrame, endFrame) of the video into the queue, frame ids are counted from the start of the video
+    void videoReaderThread(cv::VideoCapture& video, const std::string videoPath, unsigned int videoId,
+                           unsigned int startFrame, unsigned int endFrame,
+                           BlockingQueue< VideoFrame >& frameQueue){
 
 //        std::cout << "Video reader thread created\n";
+        if (!video.isOpened()) {
+            video.open(videoPath);
+        }
+        if (video.isOpened() && (startFrame > 0)) {
+            video.set(CV_CAP_PROP_POS_FRAMES, startFrame);
+            if (static_cast<unsigned int>(video.get(CV_CAP_PROP_POS_FRAMES)) != startFrame) {
+                // Seeking is not exact for this video, skip frames from the start instead
+                video.open(videoPath);
+                for (unsigned int i=0; (i < startFrame) && !m_cancel; i++) {
+                    video.grab();
+                }
+            }
+        }
+
+        cv::Mat frame;  // output of the decoder, its buffer is reused as long as we dont hand it over
+        KeyframeSelector keyframes(m_minMotion*(this->refiningCorners() ? 1.0f : m_resizeFactor));  // tracks on the queued frames
+        unsigned int fid=startFrame;
         // Check if camera opened successfully
         if(!video.isOpened()){
 //            std::cout << "Error opening video stream or file\n";
-            return;
+            fid = endFrame;
         }
 
-        cv::Mat frame;
-        unsigned int fid=0;
-        while (true) {
+        while (!m_cancel && (fid < endFrame)) {
+            if (fid % m_frameStride != 0) {
+                // skipped frames are only grabbed, not decoded
+                if (!video.grab()) {
+                    break;
+                }
+                fid++;
+                continue;
+            }
             video >> frame;
             if (frame.empty()){
-                m_stop = true;  // this will tell the workers that they can stop once the queue is empty
-                return;
+                break;
             }
 
-            // wait for lock
-            queueLock.lock();
+            // Convert to grayscale and downsample right away, so the queue and the workers deal with a 
+            // third of the data. When drawing, workers need the color frame, when refining corners the full resolution.
+            cv::Mat image;
+            if (m_draw) {
+                image = frame;
+            } else if (this->refiningCorners()) {
+                this->toGray(frame, image);
+            } else {
+                this->prepareImage(frame, image);
+            }
+            
+            bool keep = true;
+            if (m_minMotion > 0.0f) {
+                cv::Mat gray;
+                if (m_draw && this->refiningCorners()) {
+                    this->toGray(frame, gray);
+                } else if (m_draw) {
+                    this->prepareImage(frame, gray);
+                } else {
+                    gray = image;
+                }
+                keep = keyframes.select(gray);  // keeps a reference to gray until the next frame
+                if (gray.data == frame.data) {
+                    frame = cv::Mat();  // the decoder must not overwrite it
+                }
+            }
+            if (image.data == frame.data) {
+                frame = cv::Mat();  // the buffer is handed over instead of cloned, the decoder allocates a new one
+            }
+            if (!keep) {
+                fid++;
+                continue;
+            }
 
-            // Once we have it we add something to the queue
-            frameQueue.push(
-                std::make_pair(fid, frame.clone())
-            );
+            // Blocks while the queue is full, fails when the detection was stopped
+            VideoFrame item = {videoId, fid, std::move(image)};
+            if (!frameQueue.push(std::move(item))) {
+                break;
+            }
             fid++;
-            queueLock.unlock();
-
 //            std::cout << "Number of frames in queue: " << frameQueue.size() << "\n";
-
-            // We dont fill the queue too much
-            while (frameQueue.size() > 32){
-                std::this_thread::sleep_for(std::chrono::milliseconds(5));
-            }
+        }
+        if (--m_numRunningReaders == 0) {
+            frameQueue.close();  // this will tell the workers that they can stop once the queue is empty
         }
     }
 
-    void processVideoWorkerThread(std::vector< std::vector< Detection > >& detectionResult,
-                                  std::mutex& queueLock,
-                                  std::queue< std::pair<unsigned int, cv::Mat> >& frameQueue, std::mutex& writeResultMutex){
+    void processVideoWorkerThread(unsigned int workerId, BlockingQueue< VideoFrame >& frameQueue){
             // Read image
-            cv::Mat image, image_gray, image_small;
+            cv::Mat image, image_gray, image_full;
             unsigned int fid;
+            VideoFrame frame;
 
-            // main worker loop
-            while (true){
-
-                // wait for frames loop
-                while (true){
-                    queueLock.lock();
-                    if (frameQueue.empty()) {
-                        if (m_stop) {
-                            // end criterion: empty queue with stop signal
-                            queueLock.unlock();
-                            return;
-                        }
-                        else {
-                            // wait for more frames
-                            queueLock.unlock();
-                            std::this_thread::sleep_for(std::chrono::milliseconds(5));
-                        }
-
-                    } else{
-                        // process given frame
-                        std::swap(frameQueue.front().first, fid);
-                        std::swap(frameQueue.front().second, image);
-                        frameQueue.pop();
-                        queueLock.unlock();
-                        break;
-                    }
-
-                }
-
-                // resize
-                cv::resize(image, image_small, cv::Size(), m_resizeFactor, m_resizeFactor);
+            // main worker loop, ends when the queue is empty and closed
+            while (!m_cancel && frameQueue.pop(frame)){
+                fid = frame.frameId;
+                std::swap(frame.image, image);
 
                 // detect April tags (requires a gray scale image)
-                cv::cvtColor(image_small, image_gray, CV_BGR2GRAY);
+                if (m_draw) {
+                    this->toGray(image, image_full);
+                    this->resizeImage(image_full, image_gray);
+                } else if (this->refiningCorners()) {
+                    std::swap(image, image_full);  // converted to grayscale by the reader
+                    this->resizeImage(image_full, image_gray);
+                } else {
+                    std::swap(image, image_gray);  // already prepared by the reader
+                }
                 vector<AprilTags::TagDetection> detections = m_tagDetector->extractTags(image_gray);
 //                std::cout << "Detection done.\n";
 
@@ -415,22 +735,15 @@ public:
                     cv::destroyWindow("apriltag_det");
                 }
 
-                writeResultMutex.lock();
-                float f = 1.0f / m_resizeFactor; // upscaleFactor
-                // Put everything in a generic detection
-                for (unsigned int i=0; i<detections.size(); i++) {
-                    std::vector< std::pair<float, float> > points;
-                    points.push_back(std::pair<float, float> (detections[i].p[0].first*f, detections[i].p[0].second*f));
-                    points.push_back(std::pair<float, float> (detections[i].p[1].first*f, detections[i].p[1].second*f));
-                    points.push_back(std::pair<float, float> (detections[i].p[2].first*f, detections[i].p[2].second*f));
-                    points.push_back(std::pair<float, float> (detections[i].p[3].first*f, detections[i].p[3].second*f));
-                    detectionResult[fid].push_back(Detection(this->m_tagCodesName,
-                                                        detections[i].id,
-                                                        points));
+                std::vector< Detection > result;
+                this->convertDetections(detections, result);
+                if (this->refiningCorners()) {
+                    this->refineCorners(image_full, result);
                 }
+                this->pushResult(workerId, frame.videoId, fid, result);
     //             std::cout << "Finished job " << processId << " and wrote back results\n";
-                writeResultMutex.unlock();
             }
+            this->workerFinished();
     }
 }; // End Detector
 
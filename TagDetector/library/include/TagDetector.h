@@ -16,12 +16,21 @@ public:
 	
 	const TagFamily thisTagFamily;
 
+	//! Use OpenCV's vectorized conversion and Gaussian blur and a vectorizable gradient loop in preprocess(),
+	//! instead of the original per pixel loops. Same filters and thresholds, results only differ by float rounding.
+	bool useOpenCVPreprocessing;
+
 	//! Constructor
         // note: TagFamily is instantiated here from TagCodes
-        TagDetector(const TagCodes& tagCodes) : thisTagFamily(tagCodes) {}
-        TagDetector(const TagCodes& tagCodes, int blackBorder) : thisTagFamily(tagCodes, blackBorder) {}
+        TagDetector(const TagCodes& tagCodes) : thisTagFamily(tagCodes), useOpenCVPreprocessing(true) {}
+        TagDetector(const TagCodes& tagCodes, int blackBorder) : thisTagFamily(tagCodes, blackBorder), useOpenCVPreprocessing(true) {}
 	
 	std::vector<TagDetection> extractTags(const cv::Mat& image);
+
+	//! First stage of extractTags: converts the grayscale image to floats in [0,1] (fimOrig), low passes it for
+	//! sampling bits (fim) and for segmentation (fimSeg), and computes the gradient direction and squared magnitude.
+	void preprocess(const cv::Mat& image, FloatImage& fimOrig, FloatImage& fim, FloatImage& fimSeg,
+	                FloatImage& fimTheta, FloatImage& fimMag) const;
 	
 };
 
@@ -1,3 +1,5 @@
+#include <algorithm>
+
 #include "Edge.h"
 #include "FloatImage.h"
 #include "MathUtil.h"
@@ -66,6 +68,28 @@ void Edge::calcEdges(float theta0, int x, int y,
   }
 }
 
+void Edge::sortEdges(std::vector<Edge> &edges) {
+  // count the edges of each cost, shifted by one so the prefix sum gives the first slot of each cost
+  std::vector<size_t> first(WEIGHT_SCALE + 2, 0);
+  for (size_t i = 0; i < edges.size(); i++) {
+    int cost = edges[i].cost;
+    if (cost < 0 || cost > WEIGHT_SCALE) {
+      // not a cost from edgeCost()
+      std::stable_sort(edges.begin(), edges.end());
+      return;
+    }
+    first[cost + 1]++;
+  }
+  for (int c = 0; c <= WEIGHT_SCALE; c++)
+    first[c + 1] += first[c];
+
+  // going through the edges in order keeps edges of the same cost in order
+  std::vector<Edge> sorted(edges.size());
+  for (size_t i = 0; i < edges.size(); i++)
+    sorted[first[edges[i].cost]++] = edges[i];
+  edges.swap(sorted);
+}
+
 void Edge::mergeEdges(std::vector<Edge> &edges, UnionFindSimple &uf,
 		      float tmin[], float tmax[], float mmin[], float mmax[]) {
   for (size_t i = 0; i < edges.size(); i++) {
@@ -35,69 +35,82 @@ using namespace std;
 
 namespace AprilTags {
 
-  std::vector<TagDetection> TagDetector::extractTags(const cv::Mat& image) {
-
-    // convert to internal AprilTags image (todo: slow, change internally to OpenCV)
-    int width = image.cols;
-    int height = image.rows;
-    AprilTags::FloatImage fimOrig(width, height);
-    int i = 0;
-    for (int y=0; y<height; y++) {
-      for (int x=0; x<width; x++) {
-        fimOrig.set(x, y, image.data[i]/255.);
-        i++;
-      }
+  namespace {
+    //! cv::Mat header on the pixels of a FloatImage (no copy), OpenCV writes into the image through it
+    cv::Mat asMat(FloatImage& fim) {
+      return cv::Mat(fim.getHeight(), fim.getWidth(), CV_32F, fim.getFloatImagePixels().data());
     }
-    std::pair<int,int> opticalCenter(width/2, height/2);
 
-#ifdef DEBUG_APRIL
-#if 0
-  { // debug - write
-    int height_ = fimOrig.getHeight();
-    int width_  = fimOrig.getWidth();
-    cv::Mat image(height_, width_, CV_8UC3);
-    {
-      for (int y=0; y<height_; y++) {
-        for (int x=0; x<width_; x++) {
-          cv::Vec3b v;
-          //        float vf = fimMag.get(x,y);
-          float vf = fimOrig.get(x,y);
-          int val = (int)(vf * 255.);
-          if ((val & 0xffff00) != 0) {printf("problem... %i\n", val);}
-          for (int k=0; k<3; k++) {
-            v(k) = val;
+    //! Separable Gaussian blur with the same filter and border handling as filterFactoredCentered
+    /*! The vertical pass of filterFactoredCentered replicates the border pixels. Its horizontal pass does so only in
+     * the first row: convolveSymmetricCentered compares the offset of the row in the image instead of the position in
+     * the row against the border. From the third row on, the first radius+1 outputs are the first pixel of the row and
+     * the last radius outputs the last pixel (times the filter sum). In the second row the same holds, except that the
+     * filter taps right of the center read the end of the first row. The horizontal pass here does the same.
+     */
+    void blurOpenCV(const FloatImage& src, FloatImage& dst, const std::vector<float>& filt) {
+      int width = src.getWidth();
+      int height = src.getHeight();
+      dst = FloatImage(width, height);
+      cv::Mat srcMat(height, width, CV_32F, const_cast<float*>(src.getFloatImagePixels().data()));
+      cv::Mat dstMat = asMat(dst);
+      cv::Mat kernel(filt, false);
+      cv::Mat identity(1, 1, CV_32F, cv::Scalar(1.0f));
+
+      cv::Mat horiz;
+      cv::sepFilter2D(srcMat, horiz, CV_32F, kernel, identity, cv::Point(-1, -1), 0, cv::BORDER_REPLICATE);
+
+      int radius = filt.size()/2;
+      if (width > 2*radius + 1) {
+        double filtSum = 0.0;
+        for (size_t j = 0; j < filt.size(); j++)
+          filtSum += filt[j];
+        for (int y = 1; y < height; y++) {
+          const float* srcRow = srcMat.ptr<float>(y);
+          float* row = horiz.ptr<float>(y);
+          for (int x = 0; x <= radius; x++) {
+            if (y == 1) {
+              double acc = 0.0;
+              for (int j = 0; j < (int)filt.size(); j++)
+                acc += (j <= x + radius ? srcRow[0] : srcRow[x + radius - j]) * filt[j];  // < 0 is in the first row
+              row[x] = (float)acc;
+            } else {
+              row[x] = (float)(srcRow[0] * filtSum);
+            }
           }
-          image.at<cv::Vec3b>(y, x) = v;
+          for (int x = width - radius; x < width; x++)
+            row[x] = (float)(srcRow[width - 1] * filtSum);
         }
       }
+
+      cv::sepFilter2D(horiz, dstMat, CV_32F, identity, kernel, cv::Point(-1, -1), 0, cv::BORDER_REPLICATE);
     }
-    imwrite("out.bmp", image);
   }
-#endif
-#if 0
-  FloatImage fimOrig = fimOrig_;
-  { // debug - read
 
-    cv::Mat image = cv::imread("test.bmp");
-    int height_ = fimOrig.getHeight();
-    int width_  = fimOrig.getWidth();
-    {
-      for (int y=0; y<height_; y++) {
-        for (int x=0; x<width_; x++) {
-          cv::Vec3b v = image.at<cv::Vec3b>(y,x);
-          float val = (float)v(0)/255.;
-          fimOrig.set(x,y,val);
+  void TagDetector::preprocess(const cv::Mat& image, FloatImage& fimOrig, FloatImage& fim, FloatImage& fimSeg,
+                               FloatImage& fimTheta, FloatImage& fimMag) const {
+
+    // convert to internal AprilTags image
+    int width = image.cols;
+    int height = image.rows;
+    fimOrig = FloatImage(width, height);
+    if (useOpenCVPreprocessing) {
+      cv::Mat origMat = asMat(fimOrig);
+      image.convertTo(origMat, CV_32F, 1./255.);
+    } else {
+      int i = 0;
+      for (int y=0; y<height; y++) {
+        for (int x=0; x<width; x++) {
+          fimOrig.set(x, y, image.data[i]/255.);
+          i++;
         }
       }
     }
-  }
-#endif
-#endif
 
   //================================================================
   // Step one: preprocess image (convert to grayscale) and low pass if necessary
 
-  FloatImage fim = fimOrig;
+  fim = fimOrig;
   
   //! Gaussian smoothing kernel applied to image (0 == no filter).
   /*! Used when sampling bits. Filtering is a good idea in cases
@@ -121,7 +134,11 @@ namespace AprilTags {
   if (sigma > 0) {
     int filtsz = ((int) max(3.0f, 3*sigma)) | 1;
     std::vector<float> filt = Gaussian::makeGaussianFilter(sigma, filtsz);
-    fim.filterFactoredCentered(filt, filt);
+    if (useOpenCVPreprocessing) {
+      blurOpenCV(fimOrig, fim, filt);
+    } else {
+      fim.filterFactoredCentered(filt, filt);
+    }
   }
 
   //================================================================
@@ -130,7 +147,6 @@ namespace AprilTags {
   // break up segments, causing us to miss Quads. It is useful to do a Gaussian
   // low pass on this step even if we don't want it for encoding.
 
-  FloatImage fimSeg;
   if (segSigma > 0) {
     if (segSigma == sigma) {
       fimSeg = fim;
@@ -138,16 +154,43 @@ namespace AprilTags {
       // blur anew
       int filtsz = ((int) max(3.0f, 3*segSigma)) | 1;
       std::vector<float> filt = Gaussian::makeGaussianFilter(segSigma, filtsz);
-      fimSeg = fimOrig;
-      fimSeg.filterFactoredCentered(filt, filt);
+      if (useOpenCVPreprocessing) {
+        blurOpenCV(fimOrig, fimSeg, filt);
+      } else {
+        fimSeg = fimOrig;
+        fimSeg.filterFactoredCentered(filt, filt);
+      }
     }
   } else {
     fimSeg = fimOrig;
   }
 
-  FloatImage fimTheta(fimSeg.getWidth(), fimSeg.getHeight());
-  FloatImage fimMag(fimSeg.getWidth(), fimSeg.getHeight());
+  fimTheta = FloatImage(fimSeg.getWidth(), fimSeg.getHeight());
+  fimMag = FloatImage(fimSeg.getWidth(), fimSeg.getHeight());
   
+  if (useOpenCVPreprocessing) {
+    // Same central differences, but on row pointers, so the compiler can vectorize everything except atan2.
+    // atan2 is kept since a less accurate angle changes which edges get merged.
+    int w = fimSeg.getWidth();
+    const float* seg = fimSeg.getFloatImagePixels().data();
+    float* theta = fimTheta.getFloatImagePixels().data();
+    float* mag = fimMag.getFloatImagePixels().data();
+    std::vector<float> Ix(w), Iy(w);
+    for (int y = 1; y < fimSeg.getHeight()-1; y++) {
+      const float* row = seg + y*w;
+      const float* rowUp = row - w;
+      const float* rowDown = row + w;
+      for (int x = 1; x < w-1; x++) {
+        Ix[x] = row[x+1] - row[x-1];
+        Iy[x] = rowDown[x] - rowUp[x];
+        mag[y*w + x] = Ix[x]*Ix[x] + Iy[x]*Iy[x];
+      }
+      for (int x = 1; x < w-1; x++) {
+        theta[y*w + x] = atan2(Iy[x], Ix[x]);
+      }
+    }
+    return;
+  }
 
   #pragma omp parallel for
   for (int y = 1; y < fimSeg.getHeight()-1; y++) {
@@ -166,6 +209,62 @@ namespace AprilTags {
       fimMag.set(x, y, mag);
     }
   }
+  }
+
+  std::vector<TagDetection> TagDetector::extractTags(const cv::Mat& image) {
+
+    int width = image.cols;
+    int height = image.rows;
+    std::pair<int,int> opticalCenter(width/2, height/2);
+
+    //================================================================
+    // Step one and two: convert and low pass the image, compute the local gradient (see preprocess)
+    FloatImage fimOrig, fim, fimSeg, fimTheta, fimMag;
+    preprocess(image, fimOrig, fim, fimSeg, fimTheta, fimMag);
+
+#ifdef DEBUG_APRIL
+#if 0
+  { // debug - write
+    int height_ = fimOrig.getHeight();
+    int width_  = fimOrig.getWidth();
+    cv::Mat image(height_, width_, CV_8UC3);
+    {
+      for (int y=0; y<height_; y++) {
+        for (int x=0; x<width_; x++) {
+          cv::Vec3b v;
+          //        float vf = fimMag.get(x,y);
+          float vf = fimOrig.get(x,y);
+          int val = (int)(vf * 255.);
+          if ((val & 0xffff00) != 0) {printf("problem... %i\n", val);}
+          for (int k=0; k<3; k++) {
+            v(k) = val;
+          }
+          image.at<cv::Vec3b>(y, x) = v;
+        }
+      }
+    }
+    imwrite("out.bmp", image);
+  }
+#endif
+#if 0
+  FloatImage fimOrig = fimOrig_;
+  { // debug - read
+
+    cv::Mat image = cv::imread("test.bmp");
+    int height_ = fimOrig.getHeight();
+    int width_  = fimOrig.getWidth();
+    {
+      for (int y=0; y<height_; y++) {
+        for (int x=0; x<width_; x++) {
+          cv::Vec3b v = image.at<cv::Vec3b>(y,x);
+          float val = (float)v(0)/255.;
+          fimOrig.set(x,y,val);
+        }
+      }
+    }
+  }
+#endif
+#endif
 
 #ifdef DEBUG_APRIL
   int height_ = fimSeg.getHeight();
@@ -232,7 +331,7 @@ namespace AprilTags {
     }
                   
     edges.resize(nEdges);
-    std::stable_sort(edges.begin(), edges.end());
+    Edge::sortEdges(edges);
     Edge::mergeEdges(edges,uf,tmin,tmax,mmin,mmax);
   }
           
@@ -1,7 +1,7 @@
 import argparse, os
 import numpy as np
 
-from core.BoardDetector import BoardDetector
+from core.BoardDetector import get_board_detector
 from utils.general_util import json_load, json_dump
 
 from detect_marker import detect_marker
@@ -50,7 +50,7 @@ def calc_intrinsics(marker_path, data_path, det_file_name, output_file=None,
         print('\tMarker file: %s' % marker_path)
 
     # set up detector and estimator
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path)
 
     if os.path.isdir(data_path):
         if verbose > 0:
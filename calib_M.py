@@ -3,13 +3,15 @@ import numpy as np
 import random
 import cv2
 
-from utils.general_util import find_images, sample_uniform, try_to_match, json_dump
+from utils.general_util import find_images, sample_uniform, try_to_match, json_dump, json_load
 
-from core.BoardDetector import BoardDetector
+from core.BoardDetector import get_board_detector
 from core.TagPoseEstimator import TagPoseEstimator
-from core.EstimateM import estimate_extrinsics_pnp, calculate_reprojection_error, run_bundle_adjust_pnp
+from core.ObservationIndex import ObservationIndex
+from core.EstimateM import estimate_extrinsics_pnp, calculate_reprojection_error, run_bundle_adjust_pnp, \
+    estimate_and_score_object_poses, greedy_pick_object_pose, calc_3d_object_points
 
-from detect_marker import detect_marker
+from detect_marker import detect_marker_rig
 from calib_K import calc_intrinsics
 
 
@@ -122,27 +124,59 @@ def enumerate_points(det, model_points):
     return p2d_out, pid_out, p3dm_out, fid_out, cid_out, mid_out
 
 
+def load_calib(calib_path):
+    # load file
+    calib = json_load(calib_path)
+
+    # find id's
+    cid_list = list()
+    for cid in range(1024):
+        if 'cam%d' % cid in calib['K'].keys():
+            cid_list.append(cid)
+
+    # bring in different layout
+    calib_out = {'K': list(),
+                 'dist': list(),
+                 'M': list(),
+                 'cid': cid_list}
+
+    for cid in cid_list:
+        calib_out['K'].append(np.array(calib['K']['cam%d' % cid]))
+        calib_out['dist'].append(np.array(calib['dist']['cam%d' % cid]))
+        calib_out['M'].append(np.array(calib['M']['cam%d' % cid]))
+
+    return calib_out
+
+
+def _save_calib(calib_file, cam_ids, K_list, d_list, M_list, verbose):
+    # TODO: Now I think I should have organized this the other way around, but its already baked in so many programs...
+    calib = {'K': dict(), 'dist': dict(), 'M': dict()}
+    for i, cid in enumerate(cam_ids):
+        calib['K']['cam%d' % cid] = K_list[i]
+        calib['dist']['cam%d' % cid] = d_list[i]
+        calib['M']['cam%d' % cid] = M_list[i]
+    json_dump(calib_file, calib, verbose=verbose > 0)
+
+
 def calc_extrinsics(marker_path, data_path, cam_pat, run_pat,
                     det_file_name, calib_file_name, calib_out_file_name,
                     estimate_dist, dist_complexity,
                     cache, verbose,
-                    optimize_distortion=False, optimize_intrinsic=True):
+                    optimize_distortion=False, optimize_intrinsic=True,
+                    max_pair_frames=None, num_workers=1, temporal=False, frame_stride=1):
     # find input data
     base_path, img_shapes, data, cam_ids = find_data(data_path, cam_pat, run_pat)
 
-    # get detections
-    det = list()
-    for x, c in zip(data, cam_ids):
-        det.append(
-            detect_marker(marker_path, x,
-                          det_file_name % c if det_file_name is not None else None,
-                          cache=cache, verbose=verbose)
-        )
+    # get detections of all cameras at once (the same frames are skipped in all cameras, so they stay in sync)
+    det = detect_marker_rig(marker_path, data,
+                            [det_file_name % c if det_file_name is not None else None for c in cam_ids],
+                            cache=cache, verbose=verbose, frame_stride=frame_stride)
 
     # uniquely number detections
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path)
     tagpose = TagPoseEstimator(detector.object_points)
     p2d, pid, p3d, fid, cid, mid = enumerate_points(det, detector.object_points)
+    obs_index = ObservationIndex(fid, cid, num_cams=len(cam_ids))
 
     # load/calc intrinsics for all cams
     K_list, d_list = zip(*[calc_intrinsics(marker_path, x,
@@ -155,7 +189,11 @@ def calc_extrinsics(marker_path, data_path, cam_pat, run_pat,
     # estimate extrinsic calibration
     M_list, point3d_coord, pid2d_to_pid3d, object_poses = estimate_extrinsics_pnp(tagpose, K_list, d_list,
                                                                                   p2d, cid, fid, pid, mid,
-                                                                                  verbose)
+                                                                                  obs_index=obs_index,
+                                                                                  max_pair_frames=max_pair_frames,
+                                                                                  num_workers=num_workers,
+                                                                                  temporal=temporal,
+                                                                                  verbose=verbose)
 
     # calculate reprojection error of initial solution
     if verbose > 0:
@@ -171,6 +209,8 @@ def calc_extrinsics(marker_path, data_path, cam_pat, run_pat,
                                           detector.object_points, object_poses, img_shapes,
                                           optimize_intrinsic=optimize_intrinsic,
                                           optimize_distortion=optimize_distortion,
+                                          obs_index=obs_index,
+                                          num_threads=num_workers,
                                           verbose=verbose)
 
     # calculate reprojection error of the new solution
@@ -182,18 +222,95 @@ def calc_extrinsics(marker_path, data_path, cam_pat, run_pat,
 
     # save extrinsics
     if calib_out_file_name is not None:
-        # TODO: Now I think I should have organized this the other way around, but its already baked in so many programs...
-        calib = {'K': dict(), 'dist': dict(), 'M': dict()}
-        for i, cid in enumerate(cam_ids):
-            calib['K']['cam%d' % cid] = K_list[i]
-            calib['dist']['cam%d' % cid] = d_list[i]
-            calib['M']['cam%d' % cid] = M_list[i]
-        calib_file = os.path.join(base_path, calib_out_file_name)
-        json_dump(calib_file, calib, verbose=verbose > 0)
+        _save_calib(os.path.join(base_path, calib_out_file_name), cam_ids, K_list, d_list, M_list, verbose)
 
     return K_list, d_list, M_list
 
 
+def refine_extrinsics(marker_path, data_path, cam_pat, run_pat,
+                      det_file_name, calib_path, calib_out_file_name,
+                      cache, verbose,
+                      optimize_distortion=False, optimize_intrinsic=False,
+                      max_iterations=10, num_workers=1, temporal=False, frame_stride=1, return_error=False):
+    """ Incremental mode: Refines an existing calibration (M.json at calib_path) with newly recorded frames.
+
+        Only the object poses of the new frames are estimated, given the existing calibration. Then a short
+        bundle adjustment is run, which starts from the existing calibration.
+        With return_error the average reprojection errors before and after refinement are returned as well.
+    """
+    # find input data
+    base_path, img_shapes, data, cam_ids = find_data(data_path, cam_pat, run_pat)
+
+    # load existing calibration
+    calib = load_calib(calib_path)
+    assert list(calib['cid']) == list(cam_ids), 'Cameras of the calibration and the recorded data differ.'
+    K_list, d_list, M_list = calib['K'], calib['dist'], calib['M']
+
+    # get detections of all cameras at once
+    det = detect_marker_rig(marker_path, data,
+                            [det_file_name % c if det_file_name is not None else None for c in cam_ids],
+                            cache=cache, verbose=verbose, frame_stride=frame_stride)
+
+    # uniquely number detections
+    detector = get_board_detector(marker_path)
+    tagpose = TagPoseEstimator(detector.object_points)
+    p2d, pid, p3d, fid, cid, mid = enumerate_points(det, detector.object_points)
+    obs_index = ObservationIndex(fid, cid, num_cams=len(cam_ids))
+
+    # estimate object poses of the new frames with respect to the existing calibration
+    scores_object, T_obj2cam = estimate_and_score_object_poses(tagpose, p2d, cid, fid, mid, K_list, d_list,
+                                                               obs_index=obs_index, num_workers=num_workers,
+                                                               temporal=temporal)
+    object_poses = greedy_pick_object_pose(scores_object, T_obj2cam, M_list, verbose)
+
+    # observations of frames without an object pose can't be used
+    has_pose = np.array([T is not None for T in object_poses], dtype=bool)
+    assert np.any(has_pose), 'Object pose could not be estimated in any of the new frames.'
+    if not np.all(has_pose[fid]):
+        m = has_pose[fid]
+        p2d, fid, cid, mid = p2d[m], fid[m], cid[m], mid[m]
+        obs_index = ObservationIndex(fid, cid, num_frames=len(object_poses), num_cams=len(cam_ids))
+
+    # calculate reprojection error of the existing calibration
+    point3d_coord, pid2d_to_pid3d = calc_3d_object_points(detector.object_points, object_poses, fid, cid, mid)
+    error_init = None
+    if verbose > 0 or return_error:
+        error_init = calculate_reprojection_error(p2d, point3d_coord, pid2d_to_pid3d,
+                                                  K_list, d_list, M_list,
+                                                  cid)
+    if verbose > 0:
+        print('Average reprojection error: %.2f pixels' % error_init)
+
+    # run a short bundle adjust starting from the existing calibration
+    K_list, d_list, M_list, \
+    point3d_coord = run_bundle_adjust_pnp(K_list, d_list, M_list,
+                                          p2d, cid, fid, mid,
+                                          detector.object_points, object_poses, img_shapes,
+                                          optimize_intrinsic=optimize_intrinsic,
+                                          optimize_distortion=optimize_distortion,
+                                          obs_index=obs_index,
+                                          num_threads=num_workers,
+                                          max_iterations=max_iterations,
+                                          verbose=verbose)
+
+    # calculate reprojection error of the refined calibration
+    error = None
+    if verbose > 0 or return_error:
+        error = calculate_reprojection_error(p2d, point3d_coord, pid2d_to_pid3d,
+                                             K_list, d_list, M_list,
+                                             cid)
+    if verbose > 0:
+        print('Average reprojection error: %.2f pixels' % error)
+
+    # save refined extrinsics
+    if calib_out_file_name is not None:
+        _save_calib(os.path.join(base_path, calib_out_file_name), cam_ids, K_list, d_list, M_list, verbose)
+
+    if return_error:
+        return K_list, d_list, M_list, error_init, error
+    return K_list, d_list, M_list
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calculate extrinsic calibration.')
     parser.add_argument('marker', type=str, help='Marker description file.')
@@ -211,11 +328,30 @@ if __name__ == "__main__":
                         help='File to load intrinsic calibration from.')
     parser.add_argument('--calib_out_file_name', type=str, default='M.json',
                         help='File to store calibration result in.')
+    parser.add_argument('--max_pair_frames', type=int, default=None, help='Maximal number of frames considered'
+                                                                           ' when initializing a camera pair.'
+                                                                           ' Default uses all frames.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of threads used for pose estimation'
+                                                                   ' and bundle adjustment.')
+    parser.add_argument('--temporal', action='store_true', help='Warm start pose estimation from the previous frame.'
+                                                                    ' Use for video recordings.')
+    parser.add_argument('--frame_stride', type=int, default=1, help='Only detect every n-th frame of the videos.')
+    parser.add_argument('--refine', type=str, default=None, help='Existing calibration file (M.json) that is refined'
+                                                                 ' with the given data instead of calibrating'
+                                                                 ' from scratch.')
     parser.add_argument('-c', '--cache', action='store_true', help='Use stored version.')
     parser.add_argument('-v', '--verbosity', type=int, default=1, help='Verbosity level, higher is more ouput.')
     args = parser.parse_args()
 
-    calc_extrinsics(args.marker, args.data_path,
-                    args.cam_pat, args.run_pat, args.det_file_name, args.calib_file_name, args.calib_out_file_name,
-                    args.estimate_dist, args.dist_complexity,
-                    args.cache, args.verbosity)
+    if args.refine is not None:
+        refine_extrinsics(args.marker, args.data_path,
+                          args.cam_pat, args.run_pat, args.det_file_name, args.refine, args.calib_out_file_name,
+                          args.cache, args.verbosity,
+                          num_workers=args.num_workers, temporal=args.temporal, frame_stride=args.frame_stride)
+    else:
+        calc_extrinsics(args.marker, args.data_path,
+                        args.cam_pat, args.run_pat, args.det_file_name, args.calib_file_name, args.calib_out_file_name,
+                        args.estimate_dist, args.dist_complexity,
+                        args.cache, args.verbosity,
+                        max_pair_frames=args.max_pair_frames, num_workers=args.num_workers,
+                        temporal=args.temporal, frame_stride=args.frame_stride)
@@ -3,36 +3,36 @@ import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 
-from utils.general_util import json_load, fig2data
+from utils.general_util import fig2data
 
-from calib_M import find_data, enumerate_points
-from detect_marker import detect_marker
-from core.BoardDetector import BoardDetector
+from calib_M import find_data, enumerate_points, load_calib
+from detect_marker import detect_marker_rig
+from core.BoardDetector import get_board_detector
 from core.TagPoseEstimator import TagPoseEstimator
+from core.ObservationIndex import ObservationIndex
 from core.EstimateM import calculate_reprojection_error, greedy_pick_object_pose, estimate_and_score_object_poses, calc_3d_object_points
 
 
 def check_extrinsics(marker_path, data_path,
                      cam_pat, run_pat,
                      K, dist, M,
-                     verbose):
+                     verbose, num_workers=1, temporal=False):
     # find input data
     base_path, img_shapes, data, cam_ids = find_data(data_path, cam_pat, run_pat)
 
-    # get detections
-    det = list()
-    for x in data:
-        det.append(
-            detect_marker(marker_path, x, output_file=None, cache=False, verbose=False)
-        )
+    # get detections of all cameras at once
+    det = detect_marker_rig(marker_path, data, cache=False, verbose=False)
 
     # uniquely number detections
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path)
     tagpose = TagPoseEstimator(detector.object_points)
     p2d, pid, p3d, fid, cid, mid = enumerate_points(det, detector.object_points)
+    obs_index = ObservationIndex(fid, cid, num_cams=len(K))
 
     # calculate object poses and pick greedily
-    scores_object, T_obj2cam = estimate_and_score_object_poses(tagpose, p2d, cid, fid, mid, K, dist)
+    scores_object, T_obj2cam = estimate_and_score_object_poses(tagpose, p2d, cid, fid, mid, K, dist,
+                                                               obs_index=obs_index, num_workers=num_workers,
+                                                               temporal=temporal)
     object_poses = greedy_pick_object_pose(scores_object, T_obj2cam, M, verbose)
     point3d_coord, pid2d_to_pid3d = calc_3d_object_points(tagpose.object_points, object_poses, fid, cid, mid)
 
@@ -64,29 +64,6 @@ def check_extrinsics(marker_path, data_path,
     cv2.waitKey()
 
 
-def load_calib(calib_path):
-    # load file
-    calib = json_load(calib_path)
-
-    # find id's
-    cid_list = list()
-    for cid in range(1024):
-        if 'cam%d' % cid in calib['K'].keys():
-            cid_list.append(cid)
-
-    # bring in different layout
-    calib_out = {'K': list(),
-                 'dist': list(),
-                 'M': list()}
-
-    for cid in cid_list:
-        calib_out['K'].append(np.array(calib['K']['cam%d' % cid]))
-        calib_out['dist'].append(np.array(calib['dist']['cam%d' % cid]))
-        calib_out['M'].append(np.array(calib['M']['cam%d' % cid]))
-
-    return calib_out
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Check extrinsic calibration wrt some data.')
     parser.add_argument('marker', type=str, help='Marker description file.')
@@ -96,6 +73,9 @@ if __name__ == "__main__":
                                                                      'when searching for camera folders or names.')
     parser.add_argument('--run_pat', type=str, default='run%03d', help='Expression that is being matched '
                                                                        'when searching for runs.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of threads used for pose estimation.')
+    parser.add_argument('--temporal', action='store_true', help='Warm start pose estimation from the previous frame.'
+                                                                    ' Use for video recordings.')
     parser.add_argument('-v', '--verbosity', type=int, default=1, help='Verbosity level, higher is more ouput.')
     args = parser.parse_args()
 
@@ -105,4 +85,5 @@ if __name__ == "__main__":
     check_extrinsics(args.marker, args.data_path,
                      args.cam_pat, args.run_pat,
                      calib['K'], calib['dist'], calib['M'],
-                     args.verbosity)
+                     args.verbosity, num_workers=args.num_workers,
+                     temporal=args.temporal)
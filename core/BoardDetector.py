@@ -1,5 +1,7 @@
+import os
 import numpy as np
 import cv2
+import threading
 
 from TagDetector.AprilTagDetectorBatch import *
 from utils.general_util import json_load
@@ -11,7 +13,10 @@ class BoardDetector(object):
         Also knows where all its landmarks lie in 3D.
     """
     def __init__(self, marker_def_file,
-                 num_parallel_jobs=10, downsampling=1):
+                 num_parallel_jobs=10, downsampling=1, queue_capacity=32, num_video_readers=1,
+                 frame_stride=1, min_motion=0.0, refine_corners=False):
+
+        assert num_parallel_jobs > 0, 'At least one detection thread is needed.'
 
         # load marker info from file
         marker_def = json_load(marker_def_file)
@@ -26,6 +31,11 @@ class BoardDetector(object):
 
         self.tag_detector_batch = PyRunAprilDetectorBatch(marker_type, black_border, num_parallel_jobs, 1.0/downsampling,
                                                           draw=False)
+        self.tag_detector_batch.setQueueCapacity(queue_capacity)  # decoded video frames buffered for the workers
+        self.tag_detector_batch.setNumReaders(num_video_readers)  # threads decoding a video, worth it for high resolutions
+        self.tag_detector_batch.setFrameStride(frame_stride)  # only every n-th video frame is detected
+        self.tag_detector_batch.setMinMotion(min_motion)  # skip video frames that moved less pixels than this
+        self.tag_detector_batch.setRefineCorners(refine_corners)  # find tags downsampled, refine corners in full resolution
         self.object_points = self.get_april_tag_points()
 
     def _front2back(self, points_front, shift):
@@ -79,61 +89,85 @@ class BoardDetector(object):
         object_points_det = self.object_points[point2d_ids, :]
         return object_points_det
 
+    @staticmethod
+    def _convert_detections(det_f):
+        """ Turns the tag detections of a single frame into point coordinates and point ids. """
+        point_coords = list()
+        point_ids = list()
+        for det in det_f:
+            point_coords.append(np.array(det.points))
+            point_ids.append(4*det.id)
+            point_ids.append(4*det.id+1)
+            point_ids.append(4*det.id+2)
+            point_ids.append(4*det.id+3)
+
+        # turn into np array
+        if len(point_coords) > 0:
+            point_coords = np.concatenate(point_coords)
+        else:
+            point_coords = np.zeros((0, 2))
+        return point_coords, point_ids
+
     def process_image_batch(self, image_file_list):
         """ Detects points on a given list of strings (image paths) and returns a list of detections. """
         det_list = self.tag_detector_batch.processImageBatch(image_file_list)
 
         point_coords_frames = list()
         point_ids_frames = list()
-        for fid, det_f in enumerate(det_list):
-            point_coords = list()
-            point_ids = list()
-            for det in det_f:
-                point_coords.append(np.array(det.points))
-                point_ids.append(4*det.id)
-                point_ids.append(4*det.id+1)
-                point_ids.append(4*det.id+2)
-                point_ids.append(4*det.id+3)
-
-            # turn into np array
-            if len(point_coords) > 0:
-                point_coords = np.concatenate(point_coords)
-            else:
-                point_coords = np.zeros((0, 2))
-
+        for det_f in det_list:
+            point_coords, point_ids = self._convert_detections(det_f)
             point_coords_frames.append(point_coords)
             point_ids_frames.append(point_ids)
 
         return point_coords_frames, point_ids_frames
 
     def process_video(self, video_file):
-        """ Detects points on a given video file and returns a list of detections. """
+        """ Detects points on a given video file and returns a list of detections.
+            There is one entry per frame of the video, frames skipped due to frame_stride or min_motion are empty. """
         print('Running detector on video: %s' % video_file)
         det_list = self.tag_detector_batch.processVideo(video_file)
 
         point_coords_frames = list()
         point_ids_frames = list()
-        for fid, det_f in enumerate(det_list):
-            point_coords = list()
-            point_ids = list()
-            for det in det_f:
-                point_coords.append(np.array(det.points))
-                point_ids.append(4*det.id)
-                point_ids.append(4*det.id+1)
-                point_ids.append(4*det.id+2)
-                point_ids.append(4*det.id+3)
-
-            # turn into np array
-            if len(point_coords) > 0:
-                point_coords = np.concatenate(point_coords)
-            else:
-                point_coords = np.zeros((0, 2))
-
+        for det_f in det_list:
+            point_coords, point_ids = self._convert_detections(det_f)
             point_coords_frames.append(point_coords)
             point_ids_frames.append(point_ids)
 
         return point_coords_frames, point_ids_frames
 
+    def process_video_batch(self, video_file_list):
+        """ Detects points in several video files at once (e.g. all cameras of a rig), their frames share the workers.
+            Returns a list of detections for each video. """
+        print('Running detector on %d videos' % len(video_file_list))
+        det_list = self.tag_detector_batch.processVideoBatch(video_file_list)
+
+        output = list()
+        for det_vid in det_list:
+            point_coords_frames = list()
+            point_ids_frames = list()
+            for det_f in det_vid:
+                point_coords, point_ids = self._convert_detections(det_f)
+                point_coords_frames.append(point_coords)
+                point_ids_frames.append(point_ids)
+            output.append((point_coords_frames, point_ids_frames))
+        return output
+
+    def iter_image_batch(self, image_file_list):
+        """ Generator yielding (image index, point coords, point ids) for each image as soon as it is processed.
+            Images come in the order the detector finishes them. """
+        for fid, det_f in self.tag_detector_batch.iterImageBatch(image_file_list):
+            point_coords, point_ids = self._convert_detections(det_f)
+            yield fid, point_coords, point_ids
+
+    def iter_video(self, video_file):
+        """ Generator yielding (frame index, point coords, point ids) for each frame of a video as soon as it is processed.
+            Frames come in the order the detector finishes them. """
+        print('Running detector on video: %s' % video_file)
+        for fid, det_f in self.tag_detector_batch.iterVideo(video_file):
+            point_coords, point_ids = self._convert_detections(det_f)
+            yield fid, point_coords, point_ids
+
     def draw_board(self, image, points, point_ids, linewidth=8, sx=640, show=True, block=True):
         # inpaint the image
         for i in range(0, points.shape[0], 4):
@@ -168,3 +202,28 @@ class BoardDetector(object):
             put_text_centered(img, '%d' % tagId, middle,
                               fontFace=cv2.FONT_HERSHEY_PLAIN, fontScale=linewidth,
                               color=(0, 0, 255), thickness=2)
+
+
+_board_detectors = dict()  # shared instances, see get_board_detector()
+_board_detectors_lock = threading.Lock()
+
+
+def get_board_detector(marker_def_file, num_parallel_jobs=10, downsampling=1, queue_capacity=32, num_video_readers=1,
+                       frame_stride=1, min_motion=0.0, refine_corners=False):
+    """ Returns a BoardDetector for the given marker and detector settings, which is shared across the whole run.
+        Creating one parses the marker file and sets up the native detector, so scripts calling each other
+        (e.g. calib_M -> calib_K -> detect_marker) should get theirs from here.
+        A shared detector runs one detection at a time, so don't use it from several threads at once.
+    """
+    # the file is not parsed here, the modification time makes an edited marker file get a new detector
+    marker_def_file = os.path.abspath(marker_def_file)
+    key = (marker_def_file, os.path.getmtime(marker_def_file), num_parallel_jobs, downsampling, queue_capacity,
+           num_video_readers, frame_stride, min_motion, refine_corners)
+    with _board_detectors_lock:
+        if key not in _board_detectors:
+            _board_detectors[key] = BoardDetector(marker_def_file, num_parallel_jobs=num_parallel_jobs,
+                                                  downsampling=downsampling, queue_capacity=queue_capacity,
+                                                  num_video_readers=num_video_readers,
+                                                  frame_stride=frame_stride, min_motion=min_motion,
+                                                  refine_corners=refine_corners)
+        return _board_detectors[key]
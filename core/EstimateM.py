@@ -5,6 +5,17 @@ import numpy as np
 
 import utils.CamLib as cl
 from utils.Graph import *
+from core.ObservationIndex import ObservationIndex
+
+try:
+    from Bundle.BundleAdjusterPnP import PyBundleAdjuster
+except ImportError:
+    PyBundleAdjuster = None  # extension not built, bundle adjustment falls back to calling ./Bundle/build/ceres_librarypnp
+
+# binary problem format of the bundle adjuster, see Bundle/include/BinaryFormat.h
+BAL_BIN_MAGIC = b'FCBA'
+BAL_BIN_VERSION = 1
+BAL_BIN_HEADER_SIZE = 24  # magic and five uint32, sizeof(BinaryHeader)
 
 
 def _center_extrinsics(cam_extrinsic, object_poses=None, point3d_coord=None):
@@ -50,7 +61,8 @@ def _center_extrinsics(cam_extrinsic, object_poses=None, point3d_coord=None):
 def calc_3d_object_points(calib_object_points3d, object_poses,
                           point2d_fid, point2d_cid, point2d_mid):
     """ Given the object points in the objects frame and the objects pose this function
-    returns the 3D points in the world coordinate frame. """
+    returns the 3D points in the world coordinate frame. Additionally, it returns for each 2D observation
+    the index of its 3D point, which is -1 for observations in frames without a known object pose. """
     assert len(calib_object_points3d.shape) == 2, "Shape mismatch."
     assert calib_object_points3d.shape[0] > 0, "Shape mismatch."
     assert calib_object_points3d.shape[1] == 3, "Shape mismatch."
@@ -61,74 +73,58 @@ def calc_3d_object_points(calib_object_points3d, object_poses,
     assert point2d_cid.shape[0] == point2d_mid.shape[0], "Shape mismatch."
     assert point2d_cid.shape[0] >= calib_object_points3d.shape[0], "Shape mismatch."
 
-    num_cams = len(np.unique(point2d_cid))
     num_frames = np.max(point2d_fid) + 1
+    num_model_points = calib_object_points3d.shape[0]
 
-    point3d_coord = list()
-    pid2d_to_pid3d = dict()
-    model_points = calib_object_points3d.copy()
-    model_points = np.concatenate([model_points,
-                                   np.ones((model_points.shape[0], 1))], -1)
-    mid_all = [i for i in range(model_points.shape[0])]
-    n_start = 0
-    for fid in range(num_frames):
-        if object_poses[fid] is None:
-            continue
-        points3d = np.matmul(model_points, np.transpose(object_poses[fid]))
-        points3d = points3d[:, :-1] / points3d[:, -1:]
-        point3d_coord.append(points3d)
+    # each frame with a known object pose gets its own block of 3D points
+    valid_fid = [fid for fid in range(num_frames) if object_poses[fid] is not None]
+    block_start = -np.ones((num_frames, ), dtype=np.int64)
+    block_start[valid_fid] = np.arange(len(valid_fid)) * num_model_points
 
-        for cid in range(num_cams):
-            mask = np.logical_and(point2d_fid == fid, point2d_cid == cid)  # all 2d points that belong to this frame and camera
-            pid2d_ind = np.where(mask)[0]  # p2d id
-            mid = point2d_mid[pid2d_ind].tolist() # which markers where detected in the image
-            for pid2d, m in zip(pid2d_ind.tolist(), mid):
-                p3 = mid_all.index(m)
-                pid2d_to_pid3d[pid2d] = n_start + p3  # TODO: there is something going wrong with the indices
-        n_start += points3d.shape[0]
+    # transform the model points with all object poses at once
+    model_points = np.concatenate([calib_object_points3d,
+                                   np.ones((num_model_points, 1))], -1)
+    poses = np.stack([object_poses[fid] for fid in valid_fid], 0)
+    points3d = np.matmul(np.expand_dims(model_points, 0), np.transpose(poses, [0, 2, 1]))
+    points3d = points3d[:, :, :-1] / points3d[:, :, -1:]
+    point3d_coord = np.reshape(points3d, [-1, 3])
 
-    point3d_coord = np.concatenate(point3d_coord, 0)
+    # a 2d observation corresponds to its marker point within the block of its frame
+    start = block_start[point2d_fid]
+    pid2d_to_pid3d = np.where(start >= 0, start + point2d_mid, -1)
 
     return point3d_coord, pid2d_to_pid3d
 
 
 def estimate_and_score_object_poses(tagpose_estimator, point2d_coord, point2d_cid, point2d_fid, point2d_mid,
-                                    cam_intrinsic, cam_dist):
-
+                                    cam_intrinsic, cam_dist, obs_index=None, num_workers=1,
+                                    temporal=False, max_residual=2.0):
+    """ Estimates the object pose relative to each camera in each frame by solving a PnP problem per view.
+        See TagPoseEstimator.estimate_poses_batch for num_workers, temporal and max_residual.
+    """
     num_cams = len(cam_intrinsic)
     num_frames = np.max(point2d_fid) + 1
-    
-    # 0. Score how well a fid/cid pair is suited for estimation of the object pose
-    scores_object = dict()
-    for fid in range(num_frames):
-        scores_object[fid] = dict()
-        for cid in range(num_cams):
-            scores_object[fid][cid] = 0.0
 
-    # 1. Iterate cams and estimate relative pose to the calibration object for each frame
-    T_obj2cam = dict()  # contains the trafo from object points to the cam
+    if obs_index is None:
+        obs_index = ObservationIndex(point2d_fid, point2d_cid, num_cams=num_cams)
+
+    # 1. Estimate relative pose to the calibration object for each frame and cam
+    poses, valid, _ = tagpose_estimator.estimate_poses_batch(point2d_coord, point2d_cid, point2d_fid, point2d_mid,
+                                                             cam_intrinsic, cam_dist, obs_index=obs_index,
+                                                             num_workers=num_workers, temporal=temporal,
+                                                             max_residual=max_residual, check_calib=True)
+
+    # 2. Score how well a fid/cid pair is suited for estimation of the object pose: how many points we see there
+    scores_object, T_obj2cam = dict(), dict()  # T_obj2cam contains the trafo from object points to the cam
     for fid in range(num_frames):
-        T_obj2cam[fid] = dict()
+        scores_object[fid], T_obj2cam[fid] = dict(), dict()
         for cid in range(num_cams):
-            mask = np.logical_and(point2d_cid == cid, point2d_fid == fid)
-            points2d_obs = point2d_coord[mask, :]
-            points2d_mid_obs = point2d_mid[mask]
-
-            if np.sum(mask) < 4:
-                T_obj2cam[fid][cid] = None
+            if valid[fid, cid]:
+                scores_object[fid][cid] = obs_index.count(fid, cid)
+                T_obj2cam[fid][cid] = poses[fid, cid]
+            else:
                 scores_object[fid][cid] = 0
-                continue
-
-            scores_object[fid][cid] = np.sum(mask)  # score is how many points we see there
-
-            points3d_cam, R, t = tagpose_estimator.estimate_relative_cam_pose(cam_intrinsic[cid],
-                                                                              cam_dist[cid],
-                                                                              points2d_obs, points2d_mid_obs)
-
-            M_object = np.eye(4)
-            M_object[:3, :3] = R
-            M_object[:3, -1:] = t  # trafo from model to camera frame
-            T_obj2cam[fid][cid] = M_object
+                T_obj2cam[fid][cid] = None
 
     return scores_object, T_obj2cam
 
@@ -158,14 +154,14 @@ def greedy_pick_object_pose(scores_object, T_obj2cam, M, verbose):
 
 
 def _calc_reprojection_error(cam_intrinsic, cam_dist, cam_extrinsic, coord2d_obs, coord3d):
-    """ Calculates the reprojection error for a single 2D / 3D point correspondence and its camera calib. """
+    """ Calculates the reprojection error for a set of 2D / 3D point correspondences seen by a single camera. """
     if len(coord3d.shape) == 1:
         coord3d = np.expand_dims(coord3d, 0)
     if len(coord2d_obs.shape) == 1:
         coord2d_obs = np.expand_dims(coord2d_obs, 0)
 
     # transform into this cams frame
-    coord3d_h = np.concatenate([coord3d, np.ones((1, 1))], -1)
+    coord3d_h = np.concatenate([coord3d, np.ones((coord3d.shape[0], 1))], -1)
     coord3d_cam = np.matmul(coord3d_h, np.transpose(np.linalg.inv(cam_extrinsic)))
     coord3d_cam = coord3d_cam[:, :3] / coord3d_cam[:, -1:]
 
@@ -177,7 +173,7 @@ def _calc_reprojection_error(cam_intrinsic, cam_dist, cam_extrinsic, coord2d_obs
     coord2d = cl.distort_points(coord2d, cam_intrinsic, cam_dist)
 
     # find corresponding observation of this cam
-    delta_error = np.sqrt(np.sum(np.square(coord2d - coord2d_obs)))
+    delta_error = np.sqrt(np.sum(np.square(coord2d - coord2d_obs), -1))
     return delta_error, coord2d
 
 
@@ -208,22 +204,24 @@ def calculate_reprojection_error(point2d_coord, point3d_coord, pid2d_to_pid3d,
     assert point2d_coord.shape[1] == 2, "Shape mismatch."
     assert point3d_coord.shape[1] == 3, "Shape mismatch."
 
-    # calculate the error
-    reprojection_error = list()
-    reprojection_error_camwise = dict()
-    for pid2d, pid3d in pid2d_to_pid3d.items():
-        coord3d = np.expand_dims(point3d_coord[pid3d, :], 0)
-        coord2d_obs = np.expand_dims(point2d_coord[pid2d, :], 0)
-        cid = point2d_cid[pid2d]
+    assert pid2d_to_pid3d.shape[0] == point2d_coord.shape[0], "Shape mismatch."
+
+    # gather all correspondences
+    pid2d = np.where(pid2d_to_pid3d >= 0)[0]
+    pid3d = pid2d_to_pid3d[pid2d]
+    obs_cid = point2d_cid[pid2d]
 
+    # calculate the error, projecting all points seen by one camera at once
+    reprojection_error = [np.zeros((0, ))]
+    reprojection_error_camwise = dict()
+    for cid in np.unique(obs_cid).tolist():
+        mask = obs_cid == cid
         error, _ = _calc_reprojection_error(cam_intrinsic[cid], cam_dist[cid], cam_extrinsic[cid],
-                                            coord2d_obs, coord3d)
+                                            point2d_coord[pid2d[mask], :], point3d_coord[pid3d[mask], :])
 
         reprojection_error.append(error)
-
-        if cid not in reprojection_error_camwise.keys():
-            reprojection_error_camwise[cid] = list()
-        reprojection_error_camwise[cid].append(error)
+        reprojection_error_camwise[cid] = error
+    reprojection_error = np.concatenate(reprojection_error)
 
     if show:
         print('\n\n------------')
@@ -242,10 +240,53 @@ def calculate_reprojection_error(point2d_coord, point3d_coord, pid2d_to_pid3d,
     return np.mean(reprojection_error)
 
 
+def _find_best_frame_pair(scores_object, T_obj2cam, num_frames, cid1, cid2, max_pair_frames=None,
+                          max_chunk_elements=2**18):
+    """ Finds the pair of frames (fid1 <= fid2) for which the trafo cam1 -> cam2 estimated in fid1 and the trafo
+        cam2 -> cam1 estimated in fid2 are closest to being the inverse of each other.
+        Scores all frame pairs of a camera pair at once, chunked over fid1 to bound memory.
+    """
+    # frames where both cameras estimated the object pose
+    fids = [fid for fid in range(num_frames)
+            if (T_obj2cam[fid][cid1] is not None) and (T_obj2cam[fid][cid2] is not None)]
+
+    if (max_pair_frames is not None) and (len(fids) > max_pair_frames):
+        # keep the frames where both cams see most points
+        covis = np.array([min(scores_object[fid][cid1], scores_object[fid][cid2]) for fid in fids])
+        keep = np.argsort(-covis, kind='stable')[:max_pair_frames]
+        fids = [fids[i] for i in sorted(keep.tolist())]
+
+    if len(fids) == 0:
+        return (0, 0), float('inf')
+
+    T1 = np.stack([T_obj2cam[fid][cid1] for fid in fids], 0)
+    T2 = np.stack([T_obj2cam[fid][cid2] for fid in fids], 0)
+    T12 = np.matmul(T2, np.linalg.inv(T1))  # trafo cam1 -> cams2 using fid1
+    T21 = np.matmul(T1, np.linalg.inv(T2))  # trafo cam2 -> cams1 using fid2
+
+    # for perfect estimations the two mappings should be the inverse of each others
+    num = len(fids)
+    chunk = max(1, max_chunk_elements // num)
+    best_pair, best_score = None, float('inf')
+    for start in range(0, num, chunk):
+        end = min(start + chunk, num)
+        R = np.matmul(np.expand_dims(T12[start:end], 1), np.expand_dims(T21, 0)) - np.eye(4)
+        scores = np.sum(np.abs(R), axis=(2, 3))
+
+        # only pairs with fid1 <= fid2
+        rows = np.arange(start, end)
+        scores[np.expand_dims(rows, 1) > np.expand_dims(np.arange(num), 0)] = float('inf')
+
+        i, j = np.unravel_index(np.argmin(scores), scores.shape)
+        if (best_pair is None) or (scores[i, j] < best_score):
+            best_pair, best_score = (fids[start + i], fids[j]), float(scores[i, j])
+    return best_pair, best_score
+
+
 def estimate_extrinsics_pnp(tagpose_estimator,
                             cam_intrinsic, cam_dist,
                             point2d_coord, point2d_cid, point2d_fid, point2d_pid, point2d_mid,
-                            verbose=0):
+                            obs_index=None, max_pair_frames=None, num_workers=1, temporal=False, verbose=0):
     """ Estimates extrinsic parameters for each camera from the given 2D point correspondences alone.
         It estimates the essential matrix for camera pairs along the observation graph.
 
@@ -258,6 +299,11 @@ def estimate_extrinsics_pnp(tagpose_estimator,
         point2d_fid: Nx1 np.array, Array containing the frame id for each of the N points.
         point2d_pid: Nx1 np.array, Array containing a unique point id for each of the N points.
         point2d_mid: Nx1 np.array, Array containing a marker-unique id for each of the N points.
+        obs_index: ObservationIndex, Observations grouped by frame and camera. Is built from the points if not given.
+        max_pair_frames: int, If given only this many frames (the ones with most co-visible points) are considered
+            when searching the best pair of frames for each pair of cameras. By default all frames are used.
+        num_workers: int, Number of threads used for solving the PnP problems of all views.
+        temporal: bool, Frames are consecutive video frames, warm start PnP from the previous frames pose.
 
     Returns:
         cam_extrinsic: list of 4x4 np.array, Intrinsic calibration of each camera.
@@ -286,61 +332,24 @@ def estimate_extrinsics_pnp(tagpose_estimator,
     calib_object_points3d = tagpose_estimator.object_points.copy()
 
     # 1. Iterate cams and estimate relative pose to the calibration object for each frame
+    if obs_index is None:
+        obs_index = ObservationIndex(point2d_fid, point2d_cid, num_cams=num_cams)
     scores_object, T_obj2cam = estimate_and_score_object_poses(tagpose_estimator,
                                                                point2d_coord, point2d_cid,
                                                                point2d_fid, point2d_mid,
-                                                               cam_intrinsic, cam_dist)
-
-    def _calc_score(T1, T2):
-        """ Estimates how closely T1 * T2 = eye() holds. """
-        R = np.matmul(T1, T2) - np.eye(T1.shape[0])
-        return np.sum(np.abs(R))  # frobenius norm
+                                                               cam_intrinsic, cam_dist,
+                                                               obs_index=obs_index,
+                                                               num_workers=num_workers,
+                                                               temporal=temporal)
 
     # try to find the pair of frames which worked best --> estimate relative camera pose from there
-    scores_rel_calib = dict()  # store how good this guess seems to be for calibrating a cam pair
-    for fid1 in range(num_frames): # for each pair of frames
-        for fid2 in range(fid1, num_frames):
-            scores_rel_calib[fid1, fid2] = dict()
-            for cid1 in range(num_cams):  # check each pair of cams
-                for cid2 in range(cid1+1, num_cams):
-                    # check if its valid
-                    if (T_obj2cam[fid1][cid2] is None) or (T_obj2cam[fid1][cid1] is None) or \
-                            (T_obj2cam[fid2][cid2] is None) or (T_obj2cam[fid2][cid1] is None):
-                        s_rel = float('inf')
-                    else:
-
-                        # calculate the transformation cam1 -> cams2 using fid1
-                        T12_fid1 = np.matmul(T_obj2cam[fid1][cid2],
-                                             np.linalg.inv(T_obj2cam[fid1][cid1]))
-
-                        # calculate the transformation cam2 -> cams1 using fid2
-                        T21_fid2 = np.matmul(T_obj2cam[fid2][cid1],
-                                             np.linalg.inv(T_obj2cam[fid2][cid2]))
-
-                        # for perfect estimations the two mappings should be the inverse of each others
-                        s_rel = _calc_score(T12_fid1, T21_fid2)
-
-                    scores_rel_calib[fid1, fid2][cid1, cid2] = s_rel
-
-    # 3. Find out which frames are optimal for a given cam pair
-    cam_pair_best_fid = dict()
+    cam_pair_best_fid, cam_pair_best_score = dict(), dict()
     for cid1 in range(num_cams):
         for cid2 in range(cid1+1, num_cams):
-            min_fid = None
-            min_v = float('inf')
-            for fid_pair, score_dict in scores_rel_calib.items():
-                # get an initial value
-                if min_fid is None:
-                    min_fid = fid_pair
-                    min_v = score_dict[cid1, cid2]
-                    continue
-
-                # if current best is worse than current item replace
-                if min_v > score_dict[cid1, cid2]:
-                    min_fid = fid_pair
-                    min_v = score_dict[cid1, cid2]
-
-            cam_pair_best_fid[cid1, cid2] = min_fid
+            fid_pair, s_rel = _find_best_frame_pair(scores_object, T_obj2cam, num_frames, cid1, cid2,
+                                                    max_pair_frames)
+            cam_pair_best_fid[cid1, cid2] = fid_pair
+            cam_pair_best_score[cid1, cid2] = s_rel
 
     # 3. Build observation graph and use djikstra to estimate relative camera poses
     observation_graph = Graph()
@@ -351,8 +360,7 @@ def estimate_extrinsics_pnp(tagpose_estimator,
     score_accumulated = [0 for _ in range(num_cams)]  # accumulate score for each cam
     for cid1 in range(num_cams):
         for cid2 in range(cid1+1, num_cams):
-            fid_pair = cam_pair_best_fid[cid1, cid2]
-            s = scores_rel_calib[fid_pair][cid1, cid2]
+            s = cam_pair_best_score[cid1, cid2]
             observation_graph.add_edge(cid1, cid2, s)
             observation_graph.add_edge(cid2, cid1, s)
             score_accumulated[cid1] += s
@@ -449,115 +457,65 @@ def estimate_extrinsics_pnp(tagpose_estimator,
     return cam_extrinsic, point3d_coord, pid2d_to_pid3d, object_poses
 
 
-def _dump_bal_json_pnp(file_path,
-                       cam_intrinsic, cam_dist, cam_extrinsic,
-                       calib_object_points3d, object_poses, img_shapes,
-                       point2d_coord, point2d_cid, point2d_fid, point2d_mid,
-                       verbose):
-    """ Writes data to file_path as json file, which can be read by my ceres BundleAdjuster. """
+def _pack_bal_pnp(cam_intrinsic, cam_dist, cam_extrinsic,
+                  calib_object_points3d, object_poses, img_shapes,
+                  point2d_coord, point2d_cid, point2d_fid, point2d_mid,
+                  obs_index=None):
+    """ Converts the problem into the flat arrays my ceres BundleAdjuster works on. """
     num_cams = len(cam_intrinsic)
-    num_obs = point2d_coord.shape[0]
 
-    # write camera parameters
-    cameraList = list()
+    if obs_index is None:
+        obs_index = ObservationIndex(point2d_fid, point2d_cid, num_cams=num_cams)
+
+    # camera parameters
+    cameras = np.zeros((num_cams, 17), dtype=np.float64)
     for cid in range(num_cams):
-        cam = list()
         K = cam_intrinsic[cid]
-        cam.append(float(K[0, 0]))  #fx
-        cam.append(float(K[1, 1]))  #fy
-        cam.append(float(K[0, 2]))  #ppx
-        cam.append(float(K[1, 2]))  #ppy
-        cam.append(float(cam_dist[cid][0, 0]))  #rad1
-        cam.append(float(cam_dist[cid][0, 1]))  #rad2
-        cam.append(float(cam_dist[cid][0, 2]))  #tang1
-        cam.append(float(cam_dist[cid][0, 3]))  #tang2
-        cam.append(float(cam_dist[cid][0, 4]))  #rad3
-
-        M = cam_extrinsic[cid]
-        M = np.linalg.inv(M)
-        t_r = M[:3, -1]
-        t = t_r
+        cameras[cid, :4] = K[0, 0], K[1, 1], K[0, 2], K[1, 2]  # fx, fy, ppx, ppy
+        cameras[cid, 4:9] = np.reshape(cam_dist[cid], [-1])[:5]  # rad1, rad2, tang1, tang2, rad3
+
+        M = np.linalg.inv(cam_extrinsic[cid])
         r, _ = cv2.Rodrigues(M[:3, :3])
-        cam.append(float(r[0]))  #r1
-        cam.append(float(r[1]))  #r2
-        cam.append(float(r[2]))  #r3
-        cam.append(float(t[0]))  #tx
-        cam.append(float(t[1]))  #ty
-        cam.append(float(t[2]))  #tz
-
-        cam.append(int(img_shapes[cid][1]))  #width
-        cam.append(int(img_shapes[cid][0]))  #height
-
-        cameraList.append(cam)
-
-    # write model points
-    modelPointList = list()
-    for point3d in calib_object_points3d:
-        modelPointList.append([float(point3d[0]), float(point3d[1]), float(point3d[2])])
-
-    # write object poses
-    obj_poses = list()
-    for T in object_poses:
-        if T is None:
-            T = np.eye(4)
-        obj = list()
-        R = T[:3, :3]
-        t = T[:, -1:]
-        r, _ = cv2.Rodrigues(R)
-        obj.append(float(r[0]))  #r1
-        obj.append(float(r[1]))  #r2
-        obj.append(float(r[2]))  #r3
-        obj.append(float(t[0]))  #tx
-        obj.append(float(t[1]))  #ty
-        obj.append(float(t[2]))  #tz
-        obj_poses.append(obj)
-
-    # write 2d observations
-    observedPointList, observedPointPointId, observedPointCamId, observedPointFrameId = list(), list(), list(), list()
-    for pid2d in range(num_obs):
-        # check if object pose is available
-        if object_poses[int(point2d_fid[pid2d])] is None:
-            fid = point2d_fid[pid2d]
-            cid = point2d_cid[pid2d]
-            mask = np.logical_and(point2d_cid == cid, point2d_fid == fid)
-            assert object_poses[fid] is not None, "should not happen"
+        cameras[cid, 9:12] = r[:, 0]  # r1, r2, r3
+        cameras[cid, 12:15] = M[:3, -1]  # tx, ty, tz
 
-        observedPointList.append([float(point2d_coord[pid2d, 0]),
-                                  float(point2d_coord[pid2d, 1])])
-        observedPointPointId.append(int(point2d_mid[pid2d]))
-        observedPointCamId.append(int(point2d_cid[pid2d]))
-        observedPointFrameId.append(int(point2d_fid[pid2d]))
+        cameras[cid, 15] = int(img_shapes[cid][1])  # width
+        cameras[cid, 16] = int(img_shapes[cid][0])  # height
 
-    data_dict = {'Camera': cameraList,
-                 'ModelPoints': modelPointList,
-                 'ObjectPoses': obj_poses,
-                 'ObservedPoints': { 'coords': observedPointList,
-                                     'pid': observedPointPointId,
-                                     'cid': observedPointCamId,
-                                     'fid': observedPointFrameId} }
+    # model points
+    model_points = np.ascontiguousarray(calib_object_points3d, dtype=np.float64)
 
-    with open(file_path, 'w') as fo:
-        json.dump(data_dict, fo, sort_keys=True, indent=4)
+    # object poses
+    poses = np.zeros((len(object_poses), 6), dtype=np.float64)
+    for fid, T in enumerate(object_poses):
+        if T is None:
+            T = np.eye(4)
+        r, _ = cv2.Rodrigues(T[:3, :3])
+        poses[fid, :3] = r[:, 0]  # r1, r2, r3
+        poses[fid, 3:] = T[:3, -1]  # tx, ty, tz
 
-    if verbose:
-        print('Saved problem as: %s' % file_path)
+    # check if object pose is available for all frames with observations
+    for fid in range(obs_index.num_frames):
+        if obs_index.count_frame(fid) > 0:
+            assert object_poses[fid] is not None, "should not happen"
 
+    # 2d observations
+    points2d = np.ascontiguousarray(point2d_coord, dtype=np.float64)
+    points2d_pid = np.ascontiguousarray(point2d_mid, dtype=np.uint32)
+    points2d_cid = np.ascontiguousarray(point2d_cid, dtype=np.uint32)
+    points2d_fid = np.ascontiguousarray(point2d_fid, dtype=np.uint32)
 
-def load_json_pnp(file_path, verbose):
-    """ Loads 3d points and cameras from a json file. """
-    with open(file_path, 'r') as fi:
-        data_dict = json.load(fi)
+    return cameras, model_points, poses, points2d, points2d_pid, points2d_cid, points2d_fid
 
-    if verbose:
-        print('- Loaded data from: %s' % file_path)
 
+def _unpack_bal_pnp(cameras, poses):
+    """ Inverse of _pack_bal_pnp for the optimized parameters. """
     cam_intrinsic = list()
     cam_extrinsic = list()
     cam_dist = list()
 
     # cameras
-    cameraList = data_dict['Camera']
-    for cid, cam_data in enumerate(cameraList):
+    for cam_data in cameras:
         K = np.eye(3)
         K[0, 0] = cam_data[0]
         K[1, 1] = cam_data[1]
@@ -575,10 +533,9 @@ def load_json_pnp(file_path, verbose):
         M[:3, 3] = t
         cam_extrinsic.append(np.linalg.inv(M))
 
-    # world points
+    # object poses
     object_poses = list()
-    objectPoses = data_dict['ObjectPoses']
-    for pose in objectPoses:
+    for pose in poses:
         r = np.array(pose[:3])
         t = np.array(pose[3:])
         R, _ = cv2.Rodrigues(r)
@@ -590,48 +547,236 @@ def load_json_pnp(file_path, verbose):
     return cam_intrinsic, cam_dist, cam_extrinsic, object_poses
 
 
+def _dump_bal_json_pnp(file_path,
+                       cam_intrinsic, cam_dist, cam_extrinsic,
+                       calib_object_points3d, object_poses, img_shapes,
+                       point2d_coord, point2d_cid, point2d_fid, point2d_mid,
+                       verbose, obs_index=None):
+    """ Writes data to file_path as json file, which can be read by my ceres BundleAdjuster. """
+    cameras, model_points, poses, \
+    points2d, points2d_pid, points2d_cid, points2d_fid = _pack_bal_pnp(cam_intrinsic, cam_dist, cam_extrinsic,
+                                                                       calib_object_points3d, object_poses, img_shapes,
+                                                                       point2d_coord, point2d_cid, point2d_fid,
+                                                                       point2d_mid, obs_index=obs_index)
+
+    # image sizes are written as integers
+    cameraList = [cam[:15] + [int(cam[15]), int(cam[16])] for cam in cameras.tolist()]
+
+    data_dict = {'Camera': cameraList,
+                 'ModelPoints': model_points.tolist(),
+                 'ObjectPoses': poses.tolist(),
+                 'ObservedPoints': { 'coords': points2d.tolist(),
+                                     'pid': points2d_pid.tolist(),
+                                     'cid': points2d_cid.tolist(),
+                                     'fid': points2d_fid.tolist()} }
+
+    with open(file_path, 'w') as fo:
+        json.dump(data_dict, fo, sort_keys=True, indent=4)
+
+    if verbose:
+        print('Saved problem as: %s' % file_path)
+
+
+def load_json_pnp(file_path, verbose):
+    """ Loads cameras, object poses and the ids of rejected observations from a json file. """
+    with open(file_path, 'r') as fi:
+        data_dict = json.load(fi)
+
+    if verbose:
+        print('- Loaded data from: %s' % file_path)
+
+    rejected = np.array(data_dict.get('Rejected', []), dtype=np.int64)
+    return _unpack_bal_pnp(data_dict['Camera'], data_dict['ObjectPoses']) + (rejected, )
+
+
+def _dump_bal_bin_pnp(file_path,
+                      cam_intrinsic, cam_dist, cam_extrinsic,
+                      calib_object_points3d, object_poses, img_shapes,
+                      point2d_coord, point2d_cid, point2d_fid, point2d_mid,
+                      verbose, obs_index=None):
+    """ Writes data to file_path in the binary format of my ceres BundleAdjuster (see Bundle/include/BinaryFormat.h).
+        Much smaller and faster to read/write than the json version for large problems. """
+    cameras, model_points, poses, \
+    points2d, points2d_pid, points2d_cid, points2d_fid = _pack_bal_pnp(cam_intrinsic, cam_dist, cam_extrinsic,
+                                                                       calib_object_points3d, object_poses, img_shapes,
+                                                                       point2d_coord, point2d_cid, point2d_fid,
+                                                                       point2d_mid, obs_index=obs_index)
+
+    header = np.array([BAL_BIN_VERSION, cameras.shape[0], model_points.shape[0], poses.shape[0], points2d.shape[0]],
+                      dtype='<u4')
+    with open(file_path, 'wb') as fo:
+        fo.write(BAL_BIN_MAGIC)
+        fo.write(header.tobytes())
+        for x in [cameras, model_points, poses, points2d]:
+            fo.write(x.astype('<f8').tobytes())
+        for x in [points2d_pid, points2d_cid, points2d_fid]:
+            fo.write(x.astype('<u4').tobytes())
+
+    if verbose:
+        print('Saved problem as: %s' % file_path)
+
+
+def _read_bal_bin_header(data):
+    """ Returns the counts stored in the header of a binary bundle adjustment file (as np.uint8 array). """
+    assert data[:4].tobytes() == BAL_BIN_MAGIC, 'Not a binary bundle adjustment file.'
+    version, num_cams, num_model_points, num_frames, num_points2d = np.frombuffer(data, dtype='<u4', count=5, offset=4)
+    assert version == BAL_BIN_VERSION, 'Unknown version of the binary format.'
+    return num_cams, num_model_points, num_frames, num_points2d
+
+
+def _load_bal_bin_problem_pnp(file_path):
+    """ Reads a problem written by _dump_bal_bin_pnp, returns the flat arrays of _pack_bal_pnp. """
+    data = np.fromfile(file_path, dtype=np.uint8)
+    num_cams, num_model_points, num_frames, num_points2d = _read_bal_bin_header(data)
+    assert data.shape[0] == BAL_BIN_HEADER_SIZE + 8*(17*num_cams + 3*num_model_points + 6*num_frames + 2*num_points2d) \
+                           + 4*3*num_points2d, 'Binary bundle adjustment file has the wrong size.'
+
+    output = list()
+    offset = BAL_BIN_HEADER_SIZE
+    for n, dim in [(num_cams, 17), (num_model_points, 3), (num_frames, 6), (num_points2d, 2)]:
+        output.append(np.frombuffer(data, dtype='<f8', count=n*dim, offset=offset).reshape([n, dim]))
+        offset += output[-1].nbytes
+    for _ in range(3):
+        output.append(np.frombuffer(data, dtype='<u4', count=num_points2d, offset=offset))
+        offset += output[-1].nbytes
+    return tuple(output)
+
+
+def load_bal_bin_pnp(file_path, verbose):
+    """ Loads cameras, object poses and the ids of rejected observations from a binary file written by my
+        ceres BundleAdjuster. """
+    data = np.fromfile(file_path, dtype=np.uint8)
+    num_cams, num_model_points, num_frames, num_points2d = _read_bal_bin_header(data)
+
+    offset = BAL_BIN_HEADER_SIZE
+    cameras = np.frombuffer(data, dtype='<f8', count=num_cams*17, offset=offset).reshape([num_cams, 17])
+    offset += cameras.nbytes + num_model_points*3*8
+    poses = np.frombuffer(data, dtype='<f8', count=num_frames*6, offset=offset).reshape([num_frames, 6])
+    offset += poses.nbytes
+    # results contain the rejected observations instead of the observations
+    rejected = np.frombuffer(data, dtype='<u4', count=num_points2d, offset=offset).astype(np.int64)
+
+    if verbose:
+        print('- Loaded data from: %s' % file_path)
+
+    return _unpack_bal_pnp(cameras, poses) + (rejected, )
+
+
 def run_bundle_adjust_pnp(cam_intrinsic, cam_dist, cam_extrinsic,
                           point2d_coord, point2d_cid, point2d_fid, point2d_mid,
                           calib_object_points3d, object_poses, img_shapes,
                           optimize_intrinsic=True, optimize_distortion=True,
                           optimize_extrinsic=True, shared_camera_model=False,
-                          verbose=0):
-    """ Run bundle adjustment. """
+                          obs_index=None, linear_solver='DENSE_SCHUR', preconditioner='JACOBI', num_threads=1,
+                          max_iterations=50, function_tolerance=1e-4, gradient_tolerance=1e-10,
+                          parameter_tolerance=1e-8, loss='none', loss_scale=1.0, outlier_rounds=0,
+                          outlier_threshold=3.0, analytic_jacobians=False, return_rejected=False,
+                          use_extension=True, problem_format='binary', verbose=0):
+    """ Run bundle adjustment.
+
+        Runs in process when the BundleAdjusterPnP extension is built (see Bundle/setupBundle.py),
+        otherwise the problem is passed to the ceres_librarypnp binary via binary files.
+        Invalid solver settings raise a ValueError in process and a RuntimeError from the binary.
+
+        linear_solver: str, Ceres linear solver, DENSE_SCHUR is fine for small rigs, use SPARSE_SCHUR or
+            ITERATIVE_SCHUR (together with a preconditioner like SCHUR_JACOBI) for many object poses.
+        num_threads: int, Number of threads used for evaluating residuals and jacobians.
+        max_iterations, function_tolerance, gradient_tolerance, parameter_tolerance: Stopping criteria of ceres.
+        loss: str, Robust loss applied to each observation: 'none', 'huber' or 'cauchy'.
+        loss_scale: float, Scale of the robust loss in pixels.
+        outlier_rounds: int, After each solve observations with a reprojection error larger than outlier_threshold
+            times the RMS error are discarded and the problem is solved again, starting from the current solution.
+        analytic_jacobians: bool, Use hand derived jacobians of the reprojection error instead of automatic
+            differentiation, which speeds up residual and jacobian evaluation.
+        return_rejected: bool, Additionally return the ids of the discarded observations.
+        use_extension: bool, Use the BundleAdjusterPnP extension if it is built. Set to False to always call the
+            ceres_librarypnp binary.
+        problem_format: str, How the problem is passed to the ceres_librarypnp binary: 'binary' or 'json'. The json
+            files are larger and slower to read, but human readable, which helps debugging.
+    """
+    assert problem_format in ['binary', 'json'], 'Unknown problem format.'
+    in_process = use_extension and (PyBundleAdjuster is not None)
 
     if verbose > 0:
         print('\n\n------------')
         print('- Running bundle adjustment on PNP problem to optimize parameters jointly')
+        if in_process:
+            print('- Using the BundleAdjusterPnP extension')
+        else:
+            print('- Using the ceres_librarypnp binary')
+
+    if in_process:
+        cameras, model_points, poses, \
+        points2d, points2d_pid, points2d_cid, points2d_fid = _pack_bal_pnp(cam_intrinsic, cam_dist, cam_extrinsic,
+                                                                           calib_object_points3d, object_poses, img_shapes,
+                                                                           point2d_coord, point2d_cid, point2d_fid,
+                                                                           point2d_mid, obs_index=obs_index)
+        adjuster = PyBundleAdjuster(cameras, model_points, poses,
+                                    points2d, points2d_cid, points2d_pid, points2d_fid,
+                                    optimize_intrinsic, optimize_distortion, optimize_extrinsic,
+                                    shared_camera_model=shared_camera_model, verbose=verbose > 0)
+        adjuster.set_solver_settings(linear_solver, preconditioner, num_threads, max_iterations,
+                                     function_tolerance, gradient_tolerance, parameter_tolerance,
+                                     loss, loss_scale, outlier_rounds, outlier_threshold,
+                                     analytic_jacobians=analytic_jacobians)
+        adjuster.optimize()  # cameras and poses are updated in place
+        cam_intrinsic, cam_dist, cam_extrinsic, object_poses_new = _unpack_bal_pnp(cameras, poses)
+        rejected = adjuster.get_rejected()
 
-    out_file = './guess.json'
-    in_file = './optim.json'
-
-    _dump_bal_json_pnp(out_file,
-                       cam_intrinsic, cam_dist, cam_extrinsic,
-                       calib_object_points3d, object_poses, img_shapes,
-                       point2d_coord, point2d_cid, point2d_fid, point2d_mid,
-                       verbose)
-
-    command = list()
-    path_to_this_file = os.path.dirname(os.path.realpath(__file__))
-    command.append(os.path.join(path_to_this_file, '../Bundle/build/ceres_librarypnp'))
-    if optimize_intrinsic:
-        command.append('-k')
-    if optimize_distortion:
-        command.append('-r')
-    if optimize_extrinsic:
-        command.append('-m')
-    if shared_camera_model:
-        command.append('-s')
-    command.append('-i%s' % out_file)
-    command.append('-o%s' % in_file)
-
-    # Call bundle adjust program
-    if verbose == 0:
-        subprocess.call(command, stdout=open(os.devnull, 'wb'))
     else:
-        subprocess.call(command)
+        if problem_format == 'json':
+            out_file, in_file = './guess.json', './optim.json'
+            dump_problem, load_result = _dump_bal_json_pnp, load_json_pnp
+        else:
+            out_file, in_file = './guess.bin', './optim.bin'
+            dump_problem, load_result = _dump_bal_bin_pnp, load_bal_bin_pnp
+
+        dump_problem(out_file,
+                     cam_intrinsic, cam_dist, cam_extrinsic,
+                     calib_object_points3d, object_poses, img_shapes,
+                     point2d_coord, point2d_cid, point2d_fid, point2d_mid,
+                     verbose, obs_index=obs_index)
+
+        command = list()
+        path_to_this_file = os.path.dirname(os.path.realpath(__file__))
+        command.append(os.path.join(path_to_this_file, '../Bundle/build/ceres_librarypnp'))
+        if optimize_intrinsic:
+            command.append('-k')
+        if optimize_distortion:
+            command.append('-r')
+        if optimize_extrinsic:
+            command.append('-m')
+        if shared_camera_model:
+            command.append('-s')
+        command.append('-l%s' % linear_solver)
+        command.append('-p%s' % preconditioner)
+        command.append('-t%d' % num_threads)
+        command.append('-n%d' % max_iterations)
+        command.append('-f%e' % function_tolerance)
+        command.append('-g%e' % gradient_tolerance)
+        command.append('-x%e' % parameter_tolerance)
+        command.append('-L%s' % loss)
+        command.append('-S%e' % loss_scale)
+        command.append('-R%d' % outlier_rounds)
+        command.append('-N%e' % outlier_threshold)
+        if analytic_jacobians:
+            command.append('-a')
+        command.append('-i%s' % out_file)
+        command.append('-o%s' % in_file)
+
+        # Call bundle adjust program, its output tells why it failed
+        if verbose == 0:
+            proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            ret, output = proc.returncode, proc.stdout.decode('utf-8', 'replace')
+        else:
+            ret, output = subprocess.call(command), ''
+        if ret != 0:
+            os.remove(out_file)
+            raise RuntimeError('Bundle adjustment binary failed with exit code %d. %s' % (ret, output.strip()))
 
-    cam_intrinsic, cam_dist, cam_extrinsic, object_poses_new = load_json_pnp(in_file, verbose)
+        cam_intrinsic, cam_dist, cam_extrinsic, object_poses_new, rejected = load_result(in_file, verbose)
+        os.remove(out_file)
+        os.remove(in_file)
 
     # replace invalid object poses with None
     object_poses_new2 = list()
@@ -645,7 +790,10 @@ def run_bundle_adjust_pnp(cam_intrinsic, cam_dist, cam_extrinsic,
     cam_extrinsic, object_poses = _center_extrinsics(cam_extrinsic=cam_extrinsic, object_poses=object_poses)
     point3d_coord, _ = calc_3d_object_points(calib_object_points3d, object_poses,
                                              point2d_fid, point2d_cid, point2d_mid)
-    os.remove(out_file)
-    os.remove(in_file)
 
+    if verbose > 0 and outlier_rounds > 0:
+        print('- Bundle adjustment rejected %d of %d observations' % (rejected.shape[0], point2d_coord.shape[0]))
+
+    if return_rejected:
+        return cam_intrinsic, cam_dist, cam_extrinsic, point3d_coord, rejected
     return cam_intrinsic, cam_dist, cam_extrinsic, point3d_coord
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class ObservationIndex(object):
+    """ Groups the flat arrays of 2D observations by (frame, camera) pairs, so that all observations of a
+        view can be looked up in O(1) instead of masking the complete observation array.
+
+        Stores the observation ids sorted by view together with CSR style offsets: The observations of
+        frame fid in camera cid are order[offsets[k]:offsets[k+1]] with k = fid*num_cams + cid.
+    """
+    def __init__(self, point2d_fid, point2d_cid, num_frames=None, num_cams=None):
+        point2d_fid = np.array(point2d_fid, dtype=np.int64)
+        point2d_cid = np.array(point2d_cid, dtype=np.int64)
+        assert len(point2d_fid.shape) == 1, "Shape mismatch."
+        assert len(point2d_cid.shape) == 1, "Shape mismatch."
+        assert point2d_fid.shape[0] == point2d_cid.shape[0], "Shape mismatch."
+
+        if num_frames is None:
+            num_frames = int(np.max(point2d_fid)) + 1 if point2d_fid.shape[0] > 0 else 0
+        if num_cams is None:
+            num_cams = int(np.max(point2d_cid)) + 1 if point2d_cid.shape[0] > 0 else 0
+        assert np.all(point2d_fid < num_frames), "Frame id out of range."
+        assert np.all(point2d_cid < num_cams), "Camera id out of range."
+        self.num_frames = num_frames
+        self.num_cams = num_cams
+        self.num_obs = point2d_fid.shape[0]
+
+        # stable sort keeps the original order of observations within a view
+        view_id = point2d_fid * num_cams + point2d_cid
+        self.order = np.argsort(view_id, kind='stable')
+
+        counts = np.bincount(view_id, minlength=num_frames*num_cams)
+        self.offsets = np.zeros((num_frames*num_cams + 1, ), dtype=np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+
+    def get(self, fid, cid):
+        """ Returns the ids of all observations camera cid made in frame fid. """
+        k = fid*self.num_cams + cid
+        return self.order[self.offsets[k]:self.offsets[k+1]]
+
+    def count(self, fid, cid):
+        """ Returns how many observations camera cid made in frame fid. """
+        k = fid*self.num_cams + cid
+        return int(self.offsets[k+1] - self.offsets[k])
+
+    def count_frame(self, fid):
+        """ Returns how many observations all cameras made in frame fid. """
+        return int(self.offsets[(fid+1)*self.num_cams] - self.offsets[fid*self.num_cams])
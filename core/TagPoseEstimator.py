@@ -1,5 +1,8 @@
 import numpy as np
 import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+from core.ObservationIndex import ObservationIndex
 
 
 class TagPoseEstimator(object):
@@ -8,8 +11,14 @@ class TagPoseEstimator(object):
         self.object_points = object_points
         self.verbose = verbose
 
-    def estimate_relative_cam_pose(self, camera_intrinsic, camera_dist, points2d_cam, point_ids):
-        """ Estimates the relative camera pose between two cameras from some given point correspondences. """
+    def estimate_relative_cam_pose(self, camera_intrinsic, camera_dist, points2d_cam, point_ids,
+                                   r_guess=None, t_guess=None, max_residual=2.0):
+        """ Estimates the relative camera pose between two cameras from some given point correspondences.
+
+            When an initial guess (r_guess, t_guess) is given, e.g. the pose of the previous video frame, PnP is
+            warm started from it. If the mean reprojection residual of the warm started solution exceeds max_residual
+            pixels it falls back to solving from scratch.
+        """
         # Check inputs
         assert len(camera_intrinsic.shape) == 2, "camera_intrinsic shape mismatch. Should be (3,3)"
         assert camera_intrinsic.shape[0] == 3, "camera_intrinsic shape mismatch. Should be (3,3)"
@@ -32,9 +41,120 @@ class TagPoseEstimator(object):
         object_points_det = self.object_points[point_ids, :]
 
         # # calculate PNP (to get an estimate for the 3D point location)
-        success, r_rel, t_rel = cv2.solvePnP(np.expand_dims(object_points_det, 1), np.expand_dims(points2d_cam, 1),
-                                             camera_intrinsic, distCoeffs=camera_dist,
-                                             flags=cv2.SOLVEPNP_ITERATIVE)
+        r_rel, t_rel, _ = self._solve_pnp(object_points_det, points2d_cam, camera_intrinsic, camera_dist,
+                                          r_guess, t_guess, max_residual)
+
+        R, _ = cv2.Rodrigues(r_rel)
+        points3d_pred = np.matmul(object_points_det, np.transpose(R)) + np.transpose(t_rel)
+
+        return points3d_pred, R, t_rel
+
+    def estimate_poses_batch(self, point2d_coord, point2d_cid, point2d_fid, point2d_mid,
+                             cam_intrinsic, cam_dist, obs_index=None, num_frames=None, min_points=4,
+                             num_workers=1, temporal=False, max_residual=2.0, check_calib=False):
+        """ Estimates the pose of the object in all views (frame, camera) of a set of flat observation arrays.
+
+            Inputs are checked once for the complete batch. Views with less than min_points observations are skipped.
+            With num_workers > 1 the views are solved in a pool of threads (OpenCV releases the GIL).
+            With temporal=True frames are assumed to be consecutive video frames: Each cameras frames are solved in
+            order and PnP is warm started from the previous pose of the same camera (see estimate_relative_cam_pose).
+            Then parallelization happens across cameras.
+            With check_calib=True the calibrations are checked like in estimate_relative_cam_pose (similar focal
+            lengths, 4 or 5 distortion parameters). Otherwise any calibration solvePnP accepts can be used.
+
+            Returns:
+                poses: np.array, (F, C, 4, 4), Trafo from model to camera frame, identity for invalid views.
+                valid: np.array, (F, C), bool, True where a pose was estimated.
+                residuals: np.array, (F, C), Mean reprojection error in pixels, NaN for invalid views.
+        """
+        num_cams = len(cam_intrinsic)
+        point2d_coord = np.array(point2d_coord, dtype=np.float64)
+        point2d_mid = np.array(point2d_mid, dtype=np.int64)
+        assert len(point2d_coord.shape) == 2, "Shape mismatch."
+        assert point2d_coord.shape[1] == 2, "Shape mismatch."
+        assert point2d_mid.shape[0] == point2d_coord.shape[0], "Shape mismatch."
+        assert len(point2d_cid) == point2d_coord.shape[0], "Shape mismatch."
+        assert len(point2d_fid) == point2d_coord.shape[0], "Shape mismatch."
+        assert len(cam_dist) == num_cams, "Shape mismatch."
+        assert min_points >= 4, "PnP needs at least 4 points."
+
+        cam_intrinsic = [np.array(K, dtype=np.float64) for K in cam_intrinsic]
+        cam_dist = [np.squeeze(np.array(d, dtype=np.float64)) for d in cam_dist]
+        for K, d in zip(cam_intrinsic, cam_dist):
+            assert K.shape == (3, 3), "camera_intrinsic shape mismatch. Should be (3,3)"
+            if check_calib:
+                assert np.abs((K[0, 0] - K[1, 1])/K[1, 1]) < 0.1, "camera_intrinsic needs to be symmetric focal length wise."
+                assert (len(d.shape) == 1) and (d.shape[0] in [4, 5]), "camera_dist shape mismatch. Should be of length 4 or 5."
+
+        if obs_index is None:
+            obs_index = ObservationIndex(point2d_fid, point2d_cid, num_frames=num_frames, num_cams=num_cams)
+        num_frames = obs_index.num_frames
+
+        poses = np.tile(np.eye(4), [num_frames, num_cams, 1, 1])
+        valid = np.zeros((num_frames, num_cams), dtype=bool)
+        residuals = np.full((num_frames, num_cams), np.nan)
+
+        def _solve_views(views):
+            r_guess, t_guess = None, None
+            for fid, cid in views:
+                obs = obs_index.get(fid, cid)
+                r_rel, t_rel, res = self._solve_pnp(self.object_points[point2d_mid[obs], :], point2d_coord[obs, :],
+                                                    cam_intrinsic[cid], cam_dist[cid],
+                                                    r_guess, t_guess, max_residual, calc_residual=True)
+                if temporal:
+                    r_guess, t_guess = r_rel, t_rel
+
+                # each view is written by exactly one job
+                poses[fid, cid, :3, :3] = cv2.Rodrigues(r_rel)[0]
+                poses[fid, cid, :3, -1:] = t_rel
+                residuals[fid, cid] = res
+                valid[fid, cid] = True
+
+        views = [(fid, cid) for fid in range(num_frames) for cid in range(num_cams)
+                 if obs_index.count(fid, cid) >= min_points]
+        if temporal:
+            # one sequential job per camera, ordered by frame
+            jobs = [[v for v in views if v[1] == cid] for cid in range(num_cams)]
+        else:
+            jobs = [[v] for v in views]
+
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                list(executor.map(_solve_views, jobs))
+        else:
+            for job in jobs:
+                _solve_views(job)
+
+        return poses, valid, residuals
+
+    def _solve_pnp(self, object_points_det, points2d_cam, camera_intrinsic, camera_dist,
+                   r_guess=None, t_guess=None, max_residual=2.0, calc_residual=False):
+        """ Solves PnP, warm started from the guess if given. Returns rvec, tvec and the mean residual (or None). """
+        residual = None
+        success = False
+        if (r_guess is not None) and (t_guess is not None):
+            success, r_rel, t_rel = cv2.solvePnP(np.expand_dims(object_points_det, 1), np.expand_dims(points2d_cam, 1),
+                                                 camera_intrinsic, distCoeffs=camera_dist,
+                                                 rvec=np.array(r_guess, dtype=np.float64).reshape([3, 1]),
+                                                 tvec=np.array(t_guess, dtype=np.float64).reshape([3, 1]),
+                                                 useExtrinsicGuess=True,
+                                                 flags=cv2.SOLVEPNP_ITERATIVE)
+            if success:
+                residual = self._calc_residual(object_points_det, points2d_cam,
+                                               camera_intrinsic, camera_dist, r_rel, t_rel)
+                success = residual <= max_residual
+
+            if self.verbose and not success:
+                print('Warm started PnP failed, solving from scratch.')
+
+        if not success:
+            success, r_rel, t_rel = cv2.solvePnP(np.expand_dims(object_points_det, 1), np.expand_dims(points2d_cam, 1),
+                                                 camera_intrinsic, distCoeffs=camera_dist,
+                                                 flags=cv2.SOLVEPNP_ITERATIVE)
+            residual = None
+            if calc_residual:
+                residual = self._calc_residual(object_points_det, points2d_cam,
+                                               camera_intrinsic, camera_dist, r_rel, t_rel)
 
         # # This function is BUGGY in OpenCV 3.3
         # success, r_rel, t_rel, inliers = cv2.solvePnPRansac(np.expand_dims(object_points_det, 1), np.expand_dims(points2d_cam, 1),
@@ -42,8 +162,11 @@ class TagPoseEstimator(object):
         #                                                     # flags=cv2.SOLVEPNP_EPNP)
         #                                                     # flags=cv2.SOLVEPNP_DLS)
         #                                                     flags=cv2.SOLVEPNP_ITERATIVE)
+        return r_rel, t_rel, residual
 
-        R, _ = cv2.Rodrigues(r_rel)
-        points3d_pred = np.matmul(object_points_det, np.transpose(R)) + np.transpose(t_rel)
-
-        return points3d_pred, R, t_rel
+    @staticmethod
+    def _calc_residual(object_points, points2d, camera_intrinsic, camera_dist, r_rel, t_rel):
+        """ Mean reprojection error in pixels of the object points given the pose r_rel, t_rel. """
+        points2d_proj, _ = cv2.projectPoints(np.expand_dims(object_points, 1), r_rel, t_rel,
+                                             camera_intrinsic, camera_dist)
+        return np.mean(np.sqrt(np.sum(np.square(points2d_proj[:, 0, :] - points2d), -1)))
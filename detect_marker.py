@@ -1,33 +1,40 @@
 import cv2
 import argparse, os
+import multiprocessing
 
-from core.BoardDetector import BoardDetector
+from core.BoardDetector import get_board_detector
 from utils.general_util import find_images, json_dump, json_load
 
 
-def _detect_marker_video(marker_path, vid_data_path):
+def _detect_marker_video(marker_path, vid_data_path, frame_stride=1, min_motion=0.0, downsampling=1, refine_corners=False):
     # set up detector
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path, frame_stride=frame_stride, min_motion=min_motion,
+                                  downsampling=downsampling, refine_corners=refine_corners)
 
-    # detect board in images
+    # detect board in images (one entry per frame, also for skipped ones, so frame indices stay the same)
     points2d, point_ids = detector.process_video(vid_data_path)
 
     # image shape
+    img_shape = _get_video_shape(vid_data_path)
+    return points2d, point_ids, img_shape, vid_data_path, os.path.dirname(vid_data_path)
+
+
+def _get_video_shape(vid_data_path):
+    """ Returns the frame shape of a video as (H, W). """
     cap = cv2.VideoCapture(vid_data_path)
     w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    img_shape = (h, w)
-    return points2d, point_ids, img_shape, vid_data_path, os.path.dirname(vid_data_path)
+    return h, w
 
 
-def _detect_marker_img_folder(marker_path, img_data_path, verbose):
+def _detect_marker_img_folder(marker_path, img_data_path, verbose, downsampling=1, refine_corners=False):
     # check for image files
     img_list = find_images(img_data_path)
     if verbose > 1:
         print('Found %s images for marker detection.' % len(img_list))
 
     # set up detector
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path, downsampling=downsampling, refine_corners=refine_corners)
 
     # detect board in images
     points2d, point_ids = detector.process_image_batch(img_list)
@@ -39,7 +46,15 @@ def _detect_marker_img_folder(marker_path, img_data_path, verbose):
     return points2d, point_ids, img_shape, files, img_data_path
 
 
-def detect_marker(marker_path, data_path, output_file=None, cache=False, verbose=0):
+def detect_marker(marker_path, data_path, output_file=None, cache=False, verbose=0, frame_stride=1, min_motion=0.0,
+                  downsampling=1, refine_corners=False):
+    """ Detects the marker in a folder of images or a video file.
+
+        For videos frame_stride > 1 only detects every n-th frame and min_motion > 0 skips frames in which the image
+        moved less than min_motion pixels since the last detected frame. Skipped frames have no detections.
+        downsampling > 1 searches tags on images downsampled by this factor, with refine_corners their corners are
+        refined on the full resolution images.
+    """
     # check if folder/image or video case
     if os.path.isdir(data_path):
         # folder case
@@ -64,12 +79,15 @@ def detect_marker(marker_path, data_path, output_file=None, cache=False, verbose
     if os.path.isdir(data_path):
         if verbose > 0:
             print('\tAssuming: Folder of images.')
-        points2d, point_ids, img_shape, files, base_dir = _detect_marker_img_folder(marker_path, data_path, verbose)
+        points2d, point_ids, img_shape, files, base_dir = _detect_marker_img_folder(marker_path, data_path, verbose,
+                                                                                    downsampling, refine_corners)
 
     else:
         if verbose > 0:
             print('\tAssuming: Video file.')
-        points2d, point_ids, img_shape, files, base_dir = _detect_marker_video(marker_path, data_path)
+        points2d, point_ids, img_shape, files, base_dir = _detect_marker_video(marker_path, data_path,
+                                                                               frame_stride, min_motion,
+                                                                               downsampling, refine_corners)
 
     # save detections
     det = {'p2d': points2d,
@@ -83,6 +101,73 @@ def detect_marker(marker_path, data_path, output_file=None, cache=False, verbose
     return det
 
 
+def detect_marker_rig(marker_path, data_paths, output_files=None, cache=False, verbose=0, frame_stride=1,
+                      num_workers=None, min_motion=0.0, downsampling=1, refine_corners=False):
+    """ Detects the marker for all cameras of a rig at once.
+
+        Instead of running one detector per camera, the frames of all cameras are processed by one pool of
+        num_workers threads (default: number of cores). So cameras with few frames don't leave cores idle.
+        data_paths and output_files give the folder/video and detection file name of each camera,
+        a list of detections in the same order is returned. The other arguments are the same as for detect_marker,
+        note that min_motion selects keyframes per camera, so the cameras don't keep the same frames.
+    """
+    if output_files is None:
+        output_files = [None for _ in data_paths]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    assert num_workers > 0, 'At least one worker is needed.'
+
+    # cameras with stored detections are loaded, the others are detected
+    det = [None for _ in data_paths]
+    img_cams, vid_cams = list(), list()
+    for i, (data_path, output_file) in enumerate(zip(data_paths, output_files)):
+        base_dir = data_path if os.path.isdir(data_path) else os.path.dirname(data_path)
+        if cache and (output_file is not None) and os.path.exists(os.path.join(base_dir, output_file)):
+            det[i] = detect_marker(marker_path, data_path, output_file, cache=True, verbose=verbose)
+        elif os.path.isdir(data_path):
+            img_cams.append(i)
+        else:
+            vid_cams.append(i)
+
+    if len(img_cams) + len(vid_cams) == 0:
+        return det
+
+    if verbose > 0:
+        print('Detecting marker for %d cameras with %d workers.' % (len(img_cams) + len(vid_cams), num_workers))
+    detector = get_board_detector(marker_path, num_parallel_jobs=num_workers, frame_stride=frame_stride,
+                                  min_motion=min_motion, downsampling=downsampling, refine_corners=refine_corners)
+
+    # all images of all cameras in one batch
+    if len(img_cams) > 0:
+        img_lists = [find_images(data_paths[i]) for i in img_cams]
+        points2d, point_ids = detector.process_image_batch([x for img_list in img_lists for x in img_list])
+        start = 0
+        for i, img_list in zip(img_cams, img_lists):
+            end = start + len(img_list)
+            det[i] = {'p2d': points2d[start:end],
+                      'pid': point_ids[start:end],
+                      'img_shape': cv2.imread(img_list[0]).shape[:2],
+                      'files': [os.path.basename(x) for x in img_list]}
+            start = end
+
+    # all videos at once
+    if len(vid_cams) > 0:
+        results = detector.process_video_batch([data_paths[i] for i in vid_cams])
+        for i, (points2d, point_ids) in zip(vid_cams, results):
+            det[i] = {'p2d': points2d,
+                      'pid': point_ids,
+                      'img_shape': _get_video_shape(data_paths[i]),
+                      'files': data_paths[i]}
+
+    # save detections
+    for i in img_cams + vid_cams:
+        if output_files[i] is not None:
+            base_dir = data_paths[i] if os.path.isdir(data_paths[i]) else os.path.dirname(data_paths[i])
+            json_dump(os.path.join(base_dir, output_files[i]), det[i], verbose=verbose > 0)
+
+    return det
+
+
 if __name__ == "__main__":
     """
         python detect_marker.py tags/marker_32h11b2_4x4x_7cm.json blender_scene/K_test/cam0/ -v2 --output_file detections.json
@@ -92,8 +177,16 @@ if __name__ == "__main__":
     parser.add_argument('data_path', type=str, help='Path to where the recorded data is.')
     parser.add_argument('--output_file', type=str, default='detections.json', help='File to store detections in.'
                                                                                    ' If none is given doesnt save to disk.')
+    parser.add_argument('--frame_stride', type=int, default=1, help='Only detect every n-th frame of a video.')
+    parser.add_argument('--min_motion', type=float, default=0.0, help='Skip video frames that moved less than this'
+                                                                      ' many pixels since the last detected frame.')
+    parser.add_argument('--downsampling', type=int, default=1, help='Search tags on images downsampled by this factor.')
+    parser.add_argument('--refine_corners', action='store_true', help='Refine the corners found on downsampled images'
+                                                                      ' on the full resolution images.')
     parser.add_argument('-c', '--cache', action='store_true', help='Use stored version.')
     parser.add_argument('-v', '--verbosity', type=int, default=1, help='Verbosity level, higher is more ouput.')
     args = parser.parse_args()
 
-    detect_marker(args.marker, args.data_path, args.output_file, args.cache, args.verbosity)
+    detect_marker(args.marker, args.data_path, args.output_file, args.cache, args.verbosity,
+                  frame_stride=args.frame_stride, min_motion=args.min_motion,
+                  downsampling=args.downsampling, refine_corners=args.refine_corners)
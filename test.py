@@ -98,6 +98,153 @@ def test_board_pose_estimator(show=False):
     print('SUCCESS: test_board_pose_estimator')
 
 
+def test_board_detector_stream():
+    """ Test that streaming detection gives the same result as batch detection. """
+    from core.BoardDetector import BoardDetector
+    img_list = ['./data/calib_test_data/real/april_board_tags_sample.JPG',
+                './data/calib_test_data/real/aprilboard_sample.png'] * 2
+
+    detector = BoardDetector('./data/calib_test_data/marker_32h11b2_4x4x_7cm.json', num_parallel_jobs=2)
+    point_coords_frames, point_ids_frames = detector.process_image_batch(img_list)
+
+    seen = set()
+    for fid, point_coords, point_ids in detector.iter_image_batch(img_list):
+        assert fid not in seen, 'Image reported twice.'
+        seen.add(fid)
+        _same(point_coords, point_coords_frames[fid])
+        _same(point_ids, point_ids_frames[fid])
+    assert len(seen) == len(img_list), 'Images missing.'
+
+    # closing the stream early stops the detector, afterwards it can be used again
+    stream = detector.iter_image_batch(img_list)
+    next(stream)
+    stream.close()
+    for point_ids, point_ids_gt in zip(detector.process_image_batch(img_list)[1], point_ids_frames):
+        _same(point_ids, point_ids_gt)
+
+    print('SUCCESS: test_board_detector_stream')
+
+
+def _write_board_video(video_path, num_frames=12):
+    """ Writes a short video of a 4x4 board of 36h11 tags (ids 0..15) that moves by a few pixels each frame. """
+    import cv2
+    tag_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    tag_size, tag_space = 80, 20
+    board = np.full((4*tag_size + 5*tag_space, 4*tag_size + 5*tag_space), 255, dtype=np.uint8)
+    for tag_id in range(16):
+        y0 = tag_space + (tag_id // 4) * (tag_size + tag_space)
+        x0 = tag_space + (tag_id % 4) * (tag_size + tag_space)
+        board[y0:y0+tag_size, x0:x0+tag_size] = cv2.aruco.generateImageMarker(tag_dict, tag_id, tag_size, borderBits=2)
+
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 10.0, (640, 480))
+    assert writer.isOpened(), 'Could not write the test video.'
+    for i in range(num_frames):
+        frame = np.full((480, 640), 255, dtype=np.uint8)
+        frame[20+2*i:20+2*i+board.shape[0], 40+5*i:40+5*i+board.shape[1]] = board
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+
+
+def test_board_detector_video():
+    """ Test streaming, parallel reading and frame stride on a generated video against batch detection. """
+    import tempfile
+    from core.BoardDetector import BoardDetector
+    marker = './data/calib_test_data/marker_32h11b2_4x4x_7cm.json'
+    num_frames = 12
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = os.path.join(tmp_dir, 'board.avi')
+        _write_board_video(video_path, num_frames)
+
+        detector = BoardDetector(marker, num_parallel_jobs=2)
+        point_coords_frames, point_ids_frames = detector.process_video_batch([video_path])[0]
+        assert len(point_ids_frames) == num_frames, 'Frames missing.'
+        assert all(len(point_ids) > 0 for point_ids in point_ids_frames), 'Board not detected.'
+
+        # streaming gives the same detections per frame
+        seen = set()
+        for fid, point_coords, point_ids in detector.iter_video(video_path):
+            assert fid not in seen, 'Frame reported twice.'
+            seen.add(fid)
+            _same(point_coords, point_coords_frames[fid])
+            _same(point_ids, point_ids_frames[fid])
+        assert len(seen) == num_frames, 'Frames missing.'
+
+        # several readers on the same video
+        detector = BoardDetector(marker, num_parallel_jobs=2, num_video_readers=2)
+        point_coords_frames2, point_ids_frames2 = detector.process_video(video_path)
+        assert len(point_ids_frames2) == num_frames, 'Frames missing.'
+        for fid in range(num_frames):
+            _same(point_coords_frames2[fid], point_coords_frames[fid])
+            _same(point_ids_frames2[fid], point_ids_frames[fid])
+
+        # skipped frames stay empty, the others are unchanged
+        detector = BoardDetector(marker, num_parallel_jobs=2, frame_stride=2)
+        point_coords_frames2, point_ids_frames2 = detector.process_video(video_path)
+        assert len(point_ids_frames2) == num_frames, 'Frames missing.'
+        for fid in range(num_frames):
+            if fid % 2 == 1:
+                assert len(point_ids_frames2[fid]) == 0, 'Skipped frame has detections.'
+                assert point_coords_frames2[fid].shape == (0, 2), 'Skipped frame has detections.'
+            else:
+                _same(point_coords_frames2[fid], point_coords_frames[fid])
+                _same(point_ids_frames2[fid], point_ids_frames[fid])
+
+    print('SUCCESS: test_board_detector_video')
+
+
+def test_board_detector_refine():
+    """ Test that corners found on a downsampled image and refined in full resolution match the full resolution ones. """
+    from core.BoardDetector import BoardDetector
+    img_list = ['./data/calib_test_data/real/april_board_tags_sample.JPG']
+
+    detector = BoardDetector('./data/calib_test_data/marker_32h11b2_4x4x_7cm.json', downsampling=2, refine_corners=True)
+    point_coords_frames, point_ids_frames = detector.process_image_batch(img_list)
+    gt1 = json_load('data/calib_test_data/real/gt_det1.json')
+    gt_coords = dict(zip(gt1['i'], gt1['c']))
+    assert len(point_ids_frames[0]) > 0, 'No tags detected.'
+    for point_id, point_coord in zip(point_ids_frames[0], point_coords_frames[0]):
+        assert point_id in gt_coords, 'Detected a tag that is not there.'
+        _same(point_coord, gt_coords[point_id], atol=1.0)
+
+    print('SUCCESS: test_board_detector_refine')
+
+
+def test_board_detector_shared():
+    """ Test that detectors are shared between calls with the same marker and settings. """
+    from core.BoardDetector import get_board_detector
+    marker = './data/calib_test_data/marker_32h11b2_4x4x_7cm.json'
+    detector = get_board_detector(marker)
+    assert get_board_detector(marker) is detector, 'Detector not shared.'
+    assert get_board_detector(marker, num_parallel_jobs=2) is not detector, 'Detector shared across settings.'
+    assert get_board_detector('./data/calib_test_data/marker_16h5b1_4x4x_15cm.json') is not detector, \
+        'Detector shared across markers.'
+
+    print('SUCCESS: test_board_detector_shared')
+
+
+def test_detect_marker_rig():
+    """ Test that detecting all cameras in one batch gives the same detections as detecting them one by one. """
+    from calib_M import find_data
+    from detect_marker import detect_marker, detect_marker_rig
+    marker = './data/calib_test_data/marker_32h11b2_4x4x_7cm.json'
+    _, _, data, _ = find_data('data/calib_test_data/rendered/M_test/', 'cam%d', 'run%03d')
+    assert len(data) > 1, 'Test needs several cameras.'
+
+    det_rig = detect_marker_rig(marker, data, num_workers=2)
+    assert len(det_rig) == len(data), 'Number of cameras mismatch.'
+    for x, det in zip(data, det_rig):
+        det_gt = detect_marker(marker, x)
+        assert det['files'] == det_gt['files'], 'Files mismatch.'
+        assert tuple(det['img_shape']) == tuple(det_gt['img_shape']), 'Image shape mismatch.'
+        assert len(det['p2d']) == len(det_gt['p2d']), 'Number of frames mismatch.'
+        for p2d, pid, p2d_gt, pid_gt in zip(det['p2d'], det['pid'], det_gt['p2d'], det_gt['pid']):
+            _same(p2d, p2d_gt)
+            _same(pid, pid_gt)
+
+    print('SUCCESS: test_detect_marker_rig')
+
+
 def test_calib_K_no_dist():
     from calib_K import calc_intrinsics
     K, dist = calc_intrinsics('./data/calib_test_data/marker_32h11b2_4x4x_7cm.json',
@@ -176,15 +323,424 @@ def test_calib_M_dist():
     print('SUCCESS: test_calib_M_dist')
 
 
+def test_calib_M_refine():
+    """ Test that refining a perturbed calibration reduces the reprojection error, also through the command line. """
+    import subprocess, sys, tempfile
+    import cv2
+    from calib_M import refine_extrinsics, load_calib, _save_calib
+    marker_path = './data/calib_test_data/marker_32h11b2_4x4x_7cm.json'
+    data_path = 'data/calib_test_data/rendered/M_test/'
+    calib_gt = json_load(data_path + 'calib.json')
+    cam_names = sorted(calib_gt['K'].keys(), key=lambda x: int(x[3:]))
+    cam_ids = [int(x[3:]) for x in cam_names]
+
+    # rotate and shift all but the first camera a bit
+    np.random.seed(0)
+    K, dist, M = list(), list(), list()
+    for i, cam_name in enumerate(cam_names):
+        T = np.linalg.inv(np.array(calib_gt['M'][cam_name]))
+        if i > 0:
+            dT = np.eye(4)
+            dT[:3, :3], _ = cv2.Rodrigues(np.random.randn(3) * 0.01)
+            dT[:3, 3] = np.random.randn(3) * 0.01
+            T = np.matmul(T, dT)
+        K.append(np.array(calib_gt['K'][cam_name]))
+        dist.append(np.array(calib_gt['dist'][cam_name]))
+        M.append(T)
+
+    def _max_dist_gt(M):
+        return max([np.abs(np.array(calib_gt['M'][cam_name]) - np.linalg.inv(T))[:3, 3].max()
+                    for cam_name, T in zip(cam_names, M)])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        calib_path = os.path.join(tmp_dir, 'M.json')
+        _save_calib(calib_path, cam_ids, K, dist, M, verbose=0)
+
+        K_ref, dist_ref, M_ref, \
+        error_init, error = refine_extrinsics(marker_path, data_path,
+                                              'cam%d', 'run%03d', det_file_name=None, calib_path=calib_path,
+                                              calib_out_file_name=None, cache=False, verbose=0,
+                                              return_error=True)
+        assert error < error_init, 'Refinement did not reduce the reprojection error.'
+        assert _max_dist_gt(M_ref) < _max_dist_gt(M), 'Refinement did not move the cameras towards the ground truth.'
+
+        # same through the command line
+        calib_out_path = os.path.join(tmp_dir, 'M_refined.json')
+        subprocess.check_call([sys.executable, 'calib_M.py', marker_path, data_path, '--refine', calib_path,
+                               '--calib_out_file_name', calib_out_path,
+                               '--det_file_name', os.path.join(tmp_dir, 'detections_cam%d.json'), '-v', '0'])
+        calib_cli = load_calib(calib_out_path)
+        assert list(calib_cli['cid']) == cam_ids, 'Cameras mismatch.'
+        for cid in range(len(cam_ids)):
+            _same(M_ref[cid], calib_cli['M'][cid], atol=0.001, rtol=0.01)
+
+    print('SUCCESS: test_calib_M_refine')
+
+
+def test_observation_index():
+    """ Test the lookup of observations by view on hand written frame and camera ids. """
+    from core.ObservationIndex import ObservationIndex
+    fid = np.array([2, 0, 0, 2, 1, 0, 2])
+    cid = np.array([1, 0, 2, 1, 2, 0, 0])
+    index = ObservationIndex(fid, cid, num_frames=5, num_cams=3)
+
+    gt = {(0, 0): [1, 5], (0, 2): [2], (1, 2): [4], (2, 0): [6], (2, 1): [0, 3]}
+    for f in range(5):
+        for c in range(3):
+            obs = gt.get((f, c), [])
+            assert list(index.get(f, c)) == obs, 'Observation mismatch.'  # in original order
+            assert index.count(f, c) == len(obs), 'Count mismatch.'
+        assert index.count_frame(f) == sum([len(gt.get((f, c), [])) for c in range(3)]), 'Frame count mismatch.'
+    assert index.count_frame(3) == 0 and index.count_frame(4) == 0, 'Frames without observations.'
+
+    # sizes inferred from the ids
+    index = ObservationIndex(fid, cid)
+    assert index.num_frames == 3 and index.num_cams == 3, 'Size mismatch.'
+    assert list(index.get(2, 1)) == [0, 3], 'Observation mismatch.'
+
+    # no observations at all
+    index = ObservationIndex(np.zeros((0, )), np.zeros((0, )), num_frames=2, num_cams=2)
+    assert index.get(1, 1).shape[0] == 0, 'Observation mismatch.'
+    assert index.count(1, 1) == 0 and index.count_frame(1) == 0, 'Count mismatch.'
+
+    print('SUCCESS: test_observation_index')
+
+
+def test_find_best_frame_pair():
+    """ Test that the chunked scoring of frame pairs picks the same frames as the nested loops it replaced. """
+    import cv2
+    from core.EstimateM import _find_best_frame_pair
+
+    def _random_pose(scale):
+        T = np.eye(4)
+        T[:3, :3], _ = cv2.Rodrigues(np.random.randn(3) * scale)
+        T[:3, 3] = np.random.randn(3) * scale
+        return T
+
+    def _reference(T_obj2cam, num_frames, cid1, cid2):
+        """ Per pair scoring as before vectorization. """
+        min_fid, min_v = None, float('inf')
+        for fid1 in range(num_frames):
+            for fid2 in range(fid1, num_frames):
+                if (T_obj2cam[fid1][cid2] is None) or (T_obj2cam[fid1][cid1] is None) or \
+                        (T_obj2cam[fid2][cid2] is None) or (T_obj2cam[fid2][cid1] is None):
+                    s_rel = float('inf')
+                else:
+                    T12_fid1 = np.matmul(T_obj2cam[fid1][cid2], np.linalg.inv(T_obj2cam[fid1][cid1]))
+                    T21_fid2 = np.matmul(T_obj2cam[fid2][cid1], np.linalg.inv(T_obj2cam[fid2][cid2]))
+                    s_rel = np.sum(np.abs(np.matmul(T12_fid1, T21_fid2) - np.eye(4)))
+                if (min_fid is None) or (min_v > s_rel):
+                    min_fid, min_v = (fid1, fid2), s_rel
+        return min_fid, min_v
+
+    # noisy object poses of a rig, some views did not see the object
+    np.random.seed(0)
+    num_frames, num_cams = 9, 3
+    M = [_random_pose(1.0) for _ in range(num_cams)]
+    T_obj2cam, scores_object = list(), list()
+    for fid in range(num_frames):
+        T_obj = _random_pose(1.0)
+        T_obj2cam.append([np.matmul(np.matmul(_random_pose(0.01), M[cid]), T_obj) if np.random.rand() > 0.2 else None
+                          for cid in range(num_cams)])
+        scores_object.append([np.random.randint(4, 16) for _ in range(num_cams)])
+
+    for max_chunk_elements in [2**18, 2*num_frames]:  # one chunk or chunks of two rows
+        for cid1 in range(num_cams):
+            for cid2 in range(cid1+1, num_cams):
+                pair, score = _find_best_frame_pair(scores_object, T_obj2cam, num_frames, cid1, cid2,
+                                                    max_pair_frames=None, max_chunk_elements=max_chunk_elements)
+                pair_ref, score_ref = _reference(T_obj2cam, num_frames, cid1, cid2)
+                assert pair == pair_ref, 'Frame pair mismatch.'
+                # batched matmuls may round differently than single ones
+                assert np.isclose(score, score_ref, rtol=1e-12, atol=0.0), 'Score mismatch.'
+
+    print('SUCCESS: test_find_best_frame_pair')
+
+
+def test_reprojection_error():
+    """ Test the reprojection error on a synthetic rig with a known offset between projection and observation. """
+    import cv2
+    import utils.CamLib as cl
+    from core.EstimateM import calculate_reprojection_error
+
+    np.random.seed(0)
+    num_cams, num_pts = 3, 200
+    K = [np.array([[800.0, 0.0, 320.0], [0.0, 800.0, 240.0], [0.0, 0.0, 1.0]]) for _ in range(num_cams)]
+    dist = [np.random.randn(1, 5) * 0.01 for _ in range(num_cams)]
+    M = list()
+    for _ in range(num_cams):
+        T = np.eye(4)
+        T[:3, :3], _ = cv2.Rodrigues(np.random.randn(3) * 0.1)
+        T[:3, 3] = np.random.randn(3) * 0.1
+        M.append(T)
+    point3d_coord = np.random.randn(num_pts, 3) * 0.3 + np.array([[0.0, 0.0, 3.0]])
+
+    # every 3D point is seen by every camera, observations are shifted by one pixel
+    p2d, cid, pid2d_to_pid3d = list(), list(), list()
+    for c in range(num_cams):
+        p3d_cam = cl.trafo_coords(point3d_coord, np.linalg.inv(M[c]))
+        p2d.append(cl.project(p3d_cam, K[c], dist[c]) + np.array([[1.0, 0.0]]))
+        cid.extend([c for _ in range(num_pts)])
+        pid2d_to_pid3d.extend(range(num_pts))
+    p2d, cid, pid2d_to_pid3d = np.concatenate(p2d, 0), np.array(cid), np.array(pid2d_to_pid3d)
+
+    err, err_cam = calculate_reprojection_error(p2d, point3d_coord, pid2d_to_pid3d,
+                                                K, dist, M, cid, return_cam_wise=True)
+    _same(err, 1.0, atol=1e-6)
+    assert sorted(err_cam.keys()) == list(range(num_cams)), 'Camera ids differ.'
+    for c in range(num_cams):
+        _same(err_cam[c], np.ones((num_pts, )), atol=1e-6)
+
+    print('SUCCESS: test_reprojection_error')
+
+
+def test_pose_batch():
+    """ Test batched board pose estimation on synthetic views of a planar board. """
+    import cv2
+    import utils.CamLib as cl
+    from core.TagPoseEstimator import TagPoseEstimator
+
+    np.random.seed(0)
+    num_frames, num_cams = 5, 2
+    object_points = np.stack(np.meshgrid(np.arange(4), np.arange(4)), -1).reshape([-1, 2]) * 0.07
+    object_points = np.concatenate([object_points, np.zeros((16, 1))], 1)
+    K = [np.array([[800.0, 0.0, 320.0], [0.0, 800.0, 240.0], [0.0, 0.0, 1.0]]) for _ in range(num_cams)]
+    dist = [np.zeros((1, 5)) for _ in range(num_cams)]
+
+    p2d, cid, fid, mid, poses_gt = list(), list(), list(), list(), np.zeros((num_frames, num_cams, 4, 4))
+    for f in range(num_frames):
+        for c in range(num_cams):
+            T = np.eye(4)
+            T[:3, :3], _ = cv2.Rodrigues(np.array([np.pi + 0.05*f, 0.1*c, 0.0]))
+            T[:3, 3] = np.array([-0.1, 0.1, 1.0 + 0.1*f])
+            poses_gt[f, c] = T
+            n = 3 if (f, c) == (2, 1) else 16  # this view has too few points
+            p2d.append(cl.project(cl.trafo_coords(object_points[:n], T), K[c], dist[c]))
+            cid.extend([c for _ in range(n)])
+            fid.extend([f for _ in range(n)])
+            mid.extend(range(n))
+    p2d, cid, fid, mid = np.concatenate(p2d, 0), np.array(cid), np.array(fid), np.array(mid)
+
+    estimator = TagPoseEstimator(object_points)
+    for temporal in [False, True]:
+        poses, valid, residuals = estimator.estimate_poses_batch(p2d, cid, fid, mid, K, dist,
+                                                                 num_workers=2, temporal=temporal)
+        assert valid.sum() == num_frames*num_cams - 1 and not valid[2, 1], 'Validity mask mismatch.'
+        assert np.isnan(residuals[2, 1]), 'Residual of invalid view should be NaN.'
+        _same(poses[valid], poses_gt[valid], atol=1e-4)
+        _same(residuals[valid], np.zeros((valid.sum(), )), atol=1e-3)
+
+    print('SUCCESS: test_pose_batch')
+
+
+def test_pose_batch_workers():
+    """ Test that batched board pose estimation gives the same results for any number of workers. """
+    from core.TagPoseEstimator import TagPoseEstimator
+    K, dist, _, p2d, cid, fid, mid, object_points, _, _ = _synthetic_rig_problem(num_frames=8, num_cams=3, noise=0.5)
+
+    # one view with too few points
+    m = ~((fid == 3) & (cid == 1) & (mid >= 3))
+    p2d, cid, fid, mid = p2d[m], cid[m], fid[m], mid[m]
+
+    estimator = TagPoseEstimator(object_points)
+    for temporal in [False, True]:
+        results = [estimator.estimate_poses_batch(p2d, cid, fid, mid, K, dist,
+                                                  num_workers=num_workers, temporal=temporal)
+                   for num_workers in [1, 4]]
+        assert not results[0][1][3, 1] and results[0][1].sum() == 8*3 - 1, 'Validity mask mismatch.'
+        for x, y in zip(*results):
+            assert np.array_equal(x, y, equal_nan=True), 'Results depend on the number of workers.'
+
+    print('SUCCESS: test_pose_batch_workers')
+
+
+def _synthetic_rig_problem(num_frames=4, num_cams=2, noise=0.0):
+    """ Board seen by a rig of cameras in several frames, returns the inputs of run_bundle_adjust_pnp. """
+    import cv2
+    import utils.CamLib as cl
+    np.random.seed(0)
+    object_points = np.stack(np.meshgrid(np.arange(4), np.arange(4)), -1).reshape([-1, 2]) * 0.07
+    object_points = np.concatenate([object_points, np.zeros((16, 1))], 1)
+    K = [np.array([[800.0, 0.0, 320.0], [0.0, 800.0, 240.0], [0.0, 0.0, 1.0]]) for _ in range(num_cams)]
+    dist = [np.zeros((1, 5)) for _ in range(num_cams)]
+    M = list()
+    for c in range(num_cams):
+        T = np.eye(4)
+        T[:3, :3], _ = cv2.Rodrigues(np.array([0.0, 0.2*c, 0.0]))
+        T[:3, 3] = np.array([0.3*c, 0.0, 0.0])
+        M.append(T)
+    object_poses = list()
+    for f in range(num_frames):
+        T = np.eye(4)
+        T[:3, :3], _ = cv2.Rodrigues(np.array([np.pi + 0.1*f, 0.05*f, 0.0]))
+        T[:3, 3] = np.array([-0.1 + 0.02*f, 0.1, 1.5])
+        object_poses.append(T)
+
+    p2d, cid, fid, mid = list(), list(), list(), list()
+    for f in range(num_frames):
+        for c in range(num_cams):
+            p3d_cam = cl.trafo_coords(cl.trafo_coords(object_points, object_poses[f]), np.linalg.inv(M[c]))
+            p2d.append(cl.project(p3d_cam, K[c], dist[c]) + np.random.randn(object_points.shape[0], 2)*noise)
+            cid.extend([c for _ in range(object_points.shape[0])])
+            fid.extend([f for _ in range(object_points.shape[0])])
+            mid.extend(range(object_points.shape[0]))
+    p2d, cid, fid, mid = np.concatenate(p2d, 0), np.array(cid), np.array(fid), np.array(mid)
+    img_shapes = [(480, 640) for _ in range(num_cams)]
+    return K, dist, M, p2d, cid, fid, mid, object_points, object_poses, img_shapes
+
+
+def test_bal_bin_format():
+    """ Test that a problem written in the binary bundle adjustment format is read back unchanged. """
+    import tempfile
+    from core.EstimateM import _pack_bal_pnp, _dump_bal_bin_pnp, _load_bal_bin_problem_pnp
+    K, dist, M, p2d, cid, fid, mid, object_points, object_poses, img_shapes = _synthetic_rig_problem()
+
+    packed = _pack_bal_pnp(K, dist, M, object_points, object_poses, img_shapes, p2d, cid, fid, mid)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'problem.bin')
+        _dump_bal_bin_pnp(file_path, K, dist, M, object_points, object_poses, img_shapes, p2d, cid, fid, mid,
+                          verbose=False)
+        loaded = _load_bal_bin_problem_pnp(file_path)
+
+    assert len(loaded) == len(packed), 'Number of arrays mismatch.'
+    for x, y in zip(packed, loaded):
+        assert x.shape == y.shape, 'Shape mismatch.'
+        assert np.array_equal(x, y), 'Value mismatch.'
+
+    print('SUCCESS: test_bal_bin_format')
+
+
+def _bundle_adjust_paths(test_name):
+    """ Returns the use_extension values of run_bundle_adjust_pnp that can run here, reports the others as skipped. """
+    import core.EstimateM as em
+    paths = list()
+    if em.PyBundleAdjuster is not None:
+        paths.append(True)
+    else:
+        print('SKIPPED: %s (extension), BundleAdjusterPnP is not built.' % test_name)
+    if os.path.exists(os.path.join(os.path.dirname(em.__file__), '../Bundle/build/ceres_librarypnp')):
+        paths.append(False)
+    else:
+        print('SKIPPED: %s (binary), Bundle/build/ceres_librarypnp is not built.' % test_name)
+    return paths
+
+
+def test_bundle_adjust_paths():
+    """ Test that each available bundle adjustment path recovers a perturbed camera and that both paths agree. """
+    from core.EstimateM import run_bundle_adjust_pnp
+    K, dist, M, p2d, cid, fid, mid, object_points, object_poses, img_shapes = _synthetic_rig_problem(noise=0.5)
+
+    # start from a slightly wrong second camera
+    M_init = [T.copy() for T in M]
+    M_init[1][:3, 3] += np.array([0.01, -0.01, 0.02])
+
+    results = list()
+    for use_extension in _bundle_adjust_paths('test_bundle_adjust_paths'):
+        results.append(run_bundle_adjust_pnp([k.copy() for k in K], [d.copy() for d in dist],
+                                             [T.copy() for T in M_init],
+                                             p2d, cid, fid, mid,
+                                             object_points, object_poses, img_shapes,
+                                             optimize_intrinsic=False, optimize_distortion=False,
+                                             use_extension=use_extension))
+        _same(results[-1][2][1], M[1], atol=5e-3)
+
+    if len(results) == 2:
+        for x, y in zip(*results):
+            _same(x, y, rtol=1e-4, atol=1e-6)
+
+    print('SUCCESS: test_bundle_adjust_paths')
+
+
+def test_bundle_adjust_solver_options():
+    """ Test that other solver settings give the same result and that invalid ones raise. """
+    from core.EstimateM import run_bundle_adjust_pnp
+    K, dist, M, p2d, cid, fid, mid, object_points, object_poses, img_shapes = _synthetic_rig_problem(noise=0.5)
+    M_init = [T.copy() for T in M]
+    M_init[1][:3, 3] += np.array([0.01, -0.01, 0.02])
+
+    def _run(use_extension, **kwargs):
+        return run_bundle_adjust_pnp([k.copy() for k in K], [d.copy() for d in dist], [T.copy() for T in M_init],
+                                     p2d, cid, fid, mid,
+                                     object_points, object_poses, img_shapes,
+                                     optimize_intrinsic=False, optimize_distortion=False,
+                                     use_extension=use_extension, **kwargs)
+
+    for use_extension in _bundle_adjust_paths('test_bundle_adjust_solver_options'):
+        result = _run(use_extension)
+        result_other = _run(use_extension, linear_solver='ITERATIVE_SCHUR', preconditioner='SCHUR_JACOBI',
+                            num_threads=2, max_iterations=100, function_tolerance=1e-8, gradient_tolerance=1e-12,
+                            parameter_tolerance=1e-10)
+        for x, y in zip(result, result_other):
+            _same(x, y, rtol=1e-3, atol=1e-4)
+
+        try:
+            _run(use_extension, linear_solver='NO_SUCH_SOLVER')
+            raise AssertionError('Invalid linear solver was accepted.')
+        except (ValueError if use_extension else RuntimeError):
+            pass
+        assert not os.path.exists('./guess.bin'), 'Problem file was not removed.'
+
+    print('SUCCESS: test_bundle_adjust_solver_options')
+
+
+def test_bundle_adjust_outliers():
+    """ Test that a robust loss with outlier rejection discards exactly the injected gross outliers. """
+    from core.EstimateM import run_bundle_adjust_pnp, calc_3d_object_points, calculate_reprojection_error
+    K, dist, M, p2d, cid, fid, mid, object_points, object_poses, img_shapes = _synthetic_rig_problem(noise=0.5)
+    M_init = [T.copy() for T in M]
+    M_init[1][:3, 3] += np.array([0.01, -0.01, 0.02])
+
+    # move a few observations far away
+    outliers = np.array([3, 40, 77, 101, 120])
+    p2d = p2d.copy()
+    p2d[outliers] += 100.0 * np.stack([np.cos(outliers), np.sin(outliers)], 1)
+    _, pid2d_to_pid3d = calc_3d_object_points(object_points, object_poses, fid, cid, mid)
+
+    for use_extension in _bundle_adjust_paths('test_bundle_adjust_outliers'):
+        K_ba, dist_ba, M_ba, \
+        point3d_coord, rejected = run_bundle_adjust_pnp([k.copy() for k in K], [d.copy() for d in dist],
+                                                        [T.copy() for T in M_init],
+                                                        p2d, cid, fid, mid,
+                                                        object_points, object_poses, img_shapes,
+                                                        optimize_intrinsic=False, optimize_distortion=False,
+                                                        loss='huber', loss_scale=2.0,
+                                                        outlier_rounds=2, outlier_threshold=4.0,
+                                                        return_rejected=True, use_extension=use_extension)
+        assert sorted(rejected.tolist()) == outliers.tolist(), 'Rejected observations mismatch.'
+
+        # the remaining observations fit well
+        m = np.ones((p2d.shape[0], ), dtype=bool)
+        m[rejected] = False
+        _, err_cam = calculate_reprojection_error(p2d[m], point3d_coord, pid2d_to_pid3d[m],
+                                                  K_ba, dist_ba, M_ba, cid[m], return_cam_wise=True)
+        err = np.concatenate(list(err_cam.values()))
+        rms = np.sqrt(np.mean(np.square(err)))
+        assert rms < 1.0, 'Reprojection error too large.'
+        assert err.max() < 4.0 * rms, 'Observations above the outlier threshold remain.'
+
+    print('SUCCESS: test_bundle_adjust_outliers')
+
+
 if __name__ == '__main__':
     test_tag_detector(show=False)
     test_board_pose_estimator(show=False)
+    test_board_detector_stream()
+    test_board_detector_video()
+    test_board_detector_shared()
+    test_board_detector_refine()
+    test_detect_marker_rig()
     test_calib_K_no_dist()
     test_calib_K_dist1()
     test_calib_K_dist2()
     test_calib_M()
     test_calib_M_dist()
-
-
-
-
+    test_calib_M_refine()
+    test_observation_index()
+    test_find_best_frame_pair()
+    test_reprojection_error()
+    test_pose_batch()
+    test_pose_batch_workers()
+    test_bal_bin_format()
+    test_bundle_adjust_paths()
+    test_bundle_adjust_solver_options()
+    test_bundle_adjust_outliers()
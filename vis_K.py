@@ -5,25 +5,20 @@ import cv2
 import matplotlib.pyplot as plt
 from matplotlib import cm
 
-from core.BoardDetector import BoardDetector
+from core.BoardDetector import get_board_detector
+from core.TagPoseEstimator import TagPoseEstimator
 from utils.general_util import find_images, json_load, fig2data
 import utils.CamLib as cl
 
 
-def _calc_board_stats(points2d_obs, model_point3d_coord_obs, K, dist, img=None):
-    success, r_rel, t_rel = cv2.solvePnP(np.expand_dims(model_point3d_coord_obs, 1),
-                                         np.expand_dims(points2d_obs, 1),
-                                         K, distCoeffs=dist, flags=cv2.SOLVEPNP_ITERATIVE)
-
+def _calc_board_stats(points2d_obs, model_point3d_coord_obs, M_w2c, K, dist, img=None):
     # get normal vector from tag rotation
-    R, _ = cv2.Rodrigues(r_rel)
+    R = M_w2c[:3, :3]
     n = np.matmul(R, np.array([0.0, 0.0, 1.0]))  # normal wrt camera
     n = np.clip(np.sum(n), -1.0, 1.0)
     angle = np.arccos(n)*180.0/np.pi
 
     # calculate points in camera frame
-    M_w2c = np.concatenate([R, t_rel], 1)
-    M_w2c = np.concatenate([M_w2c, np.array([[0.0, 0.0, 0.0, 1.0]])], 0)
     p3d = cl.trafo_coords(model_point3d_coord_obs, M_w2c)
 
     # reprojection error
@@ -131,23 +126,40 @@ def show_intrinsic_calib(marker_path, data_path, det_file_name, calib_file_name,
     img = _read_first_frame(data_path, det)
 
     # set up detector
-    detector = BoardDetector(marker_path)
-
-    # calculate statistics
+    detector = get_board_detector(marker_path)
+    tagpose = TagPoseEstimator(detector.object_points)
+
+    # estimate board poses for all frames at once
+    p2d_all, fid_all, mid_all = list(), list(), list()
+    for fid, (p2d, pid) in enumerate(zip(det['p2d'], det['pid'])):
+        p2d_all.extend(p2d)
+        mid_all.extend(pid)
+        fid_all.extend([fid for _ in pid])
+    p2d_all = np.reshape(np.array(p2d_all, dtype=np.float64), [-1, 2])
+    poses, valid, _ = tagpose.estimate_poses_batch(p2d_all, np.zeros_like(fid_all), fid_all, mid_all,
+                                                   [K], [dist], num_frames=len(det['p2d']))
+
+    # calculate statistics, frames with less than 4 points have no pose and are skipped
     err, angle, depths = list(), list(), list()
-    for p2d, pid in tqdm(zip(det['p2d'], det['pid']),
-                         total=len(det['p2d']), desc='Calculating stats'):
-        if len(pid) == 0:
+    num_skipped = 0
+    for fid, (p2d, pid) in tqdm(enumerate(zip(det['p2d'], det['pid'])),
+                                total=len(det['p2d']), desc='Calculating stats'):
+        if not valid[fid, 0]:
+            if len(pid) > 0:
+                num_skipped += 1
             continue
 
         p3d_m = detector.object_points[pid]
         a, d, e = _calc_board_stats(np.array(p2d),
-                                    p3d_m,
+                                    p3d_m, poses[fid, 0],
                                     K, dist)
         angle.append(a)
         depths.extend(d)
         err.extend(e)
 
+    if num_skipped > 0:
+        print('Skipped %d frames with detections, but too few points to estimate the board pose.' % num_skipped)
+
     # Print reprojection error
     err = np.array(err)
     print('Reprojection error: min=%.2f, mean=%.2f, max=%.2f (px)' % (err.min(), err.mean(), err.max()))
@@ -2,7 +2,7 @@ import argparse, os
 import numpy as np
 import cv2
 
-from core.BoardDetector import BoardDetector
+from core.BoardDetector import get_board_detector
 from utils.general_util import find_images, json_load
 
 
@@ -36,7 +36,7 @@ def _show_marker_det_img_folder(marker_path, img_data_path, det_file_name, block
     assert len(det['pid']) == len(img_list), 'Number of detections and number of images differs.'
 
     # set up detector
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path)
 
     # show
     for idx, img_p in enumerate(img_list):
@@ -69,7 +69,7 @@ def _show_marker_det_video(marker_path, video_path, det_file_name, block):
     assert len(det['pid']) == num_frames, 'Number of detections and number of frames differs.'
 
     # set up detector
-    detector = BoardDetector(marker_path)
+    detector = get_board_detector(marker_path)
 
     # show
     idx = 0